@@ -0,0 +1,402 @@
+"""
+Pub/sub backplane so a room can span several worker processes.
+
+ConnectionManager and the WebRTC signaling manager always deliver to their
+own sockets directly. When the backplane is distributed they also publish
+each room message once, and every other worker holding members of that room
+delivers it to its own sockets. Presence (who is in a room, on any worker)
+lives in the backplane too.
+
+BACKPLANE_URL picks the implementation:
+    unset / memory://          InProcessBackplane (single worker, the default)
+    redis://[:password@]host:port/db   RedisBackplane, which speaks plain RESP
+                                       to Redis or any compatible server
+"""
+import os
+import asyncio
+import uuid
+from collections import deque
+from typing import Callable, Dict, Optional
+from urllib.parse import urlparse
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BACKPLANE_URL = os.getenv("BACKPLANE_URL", "memory://")
+# Set on the workers dispatcher.py starts; uvicorn --workers N reads WEB_CONCURRENCY
+MULTI_WORKER = os.getenv("DISPATCH_WORKER") is not None or int(os.getenv("WEB_CONCURRENCY", "1")) > 1
+# Presence hashes expire if every worker holding the room goes away
+PRESENCE_TTL_SECONDS = int(os.getenv("BACKPLANE_PRESENCE_TTL", "3600"))
+# A worker's presence entries stop counting this many seconds after its last
+# heartbeat (it refreshes every third of that while connected)
+BACKPLANE_WORKER_TTL = int(os.getenv("BACKPLANE_WORKER_TTL", "30"))
+# Commands waiting to be written to Redis before new publishes are dropped
+BACKPLANE_QUEUE_SIZE = int(os.getenv("BACKPLANE_QUEUE_SIZE", "10000"))
+
+# Identifies this process in published messages so it can skip its own echo
+WORKER_ID = uuid.uuid4().hex[:12]
+
+Handler = Callable[[bytes], None]
+
+
+class Backplane:
+    """Interface shared by the backplane implementations"""
+
+    # True when other processes may hold members of the same room
+    distributed = False
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def publish(self, channel: str, message: bytes):
+        """Send a message to every subscriber of channel, without waiting"""
+        raise NotImplementedError
+
+    def subscribe(self, channel: str, handler: Handler):
+        raise NotImplementedError
+
+    def unsubscribe(self, channel: str):
+        raise NotImplementedError
+
+    async def subscribed(self, channel: str):
+        """Wait until what is published on channel from now on reaches this
+        process's handler"""
+
+    async def presence_add(self, key: str, member_id: str, value: str):
+        raise NotImplementedError
+
+    async def presence_remove(self, key: str, member_id: str):
+        raise NotImplementedError
+
+    async def presence_list(self, key: str) -> Dict[str, str]:
+        raise NotImplementedError
+
+
+class InProcessBackplane(Backplane):
+    """Pub/sub and presence for managers living in one process"""
+
+    def __init__(self):
+        self._handlers: Dict[str, Handler] = {}
+        self._presence: Dict[str, Dict[str, str]] = {}
+
+    def publish(self, channel: str, message: bytes):
+        handler = self._handlers.get(channel)
+        if handler is not None:
+            asyncio.get_running_loop().call_soon(handler, message)
+
+    def subscribe(self, channel: str, handler: Handler):
+        self._handlers[channel] = handler
+
+    def unsubscribe(self, channel: str):
+        self._handlers.pop(channel, None)
+
+    async def presence_add(self, key: str, member_id: str, value: str):
+        self._presence.setdefault(key, {})[member_id] = value
+
+    async def presence_remove(self, key: str, member_id: str):
+        members = self._presence.get(key)
+        if members is not None:
+            members.pop(member_id, None)
+            if not members:
+                del self._presence[key]
+
+    async def presence_list(self, key: str) -> Dict[str, str]:
+        return dict(self._presence.get(key, {}))
+
+
+class RedisError(Exception):
+    pass
+
+
+def _encode_command(*args) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        elif isinstance(arg, int):
+            arg = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def _read_reply(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Backplane connection closed")
+    prefix, rest = line[:1], line[1:-2]
+    if prefix == b"+":
+        return rest.decode()
+    if prefix == b"-":
+        return RedisError(rest.decode())
+    if prefix == b":":
+        return int(rest)
+    if prefix == b"$":
+        length = int(rest)
+        if length == -1:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if prefix == b"*":
+        length = int(rest)
+        if length == -1:
+            return None
+        return [await _read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"Unexpected backplane reply: {line!r}")
+
+
+class RedisBackplane(Backplane):
+    """Backplane over the Redis protocol (RESP), using two connections.
+
+    Commands (PUBLISH, presence hashes) go through one queue to a writer task,
+    which pipelines them on one connection and waits for the socket to drain;
+    replies are matched to callers in order. Pushed messages arrive on a
+    second, SUBSCRIBE-only connection. Both reconnect on failure and
+    subscriptions are restored. Publishes made while disconnected, or while
+    BACKPLANE_QUEUE_SIZE commands are already waiting, are dropped.
+
+    Each presence entry is stored with the worker that added it, and every
+    worker keeps a heartbeat key alive while it is connected. Entries whose
+    worker has no heartbeat (it crashed) are left out of presence_list and
+    deleted, so they don't linger for as long as the room key is refreshed.
+    """
+
+    distributed = True
+
+    def __init__(self, url: str):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.worker_id = WORKER_ID
+        self._handlers: Dict[str, Handler] = {}
+        self._pending: deque = deque()  # Futures of written commands, in order
+        self._outbox: Optional[asyncio.Queue] = None  # (encoded command, future) for the writer
+        self._sub_writer: Optional[asyncio.StreamWriter] = None
+        self._confirming: Dict[str, asyncio.Future] = {}  # channel: resolved once the server confirms SUBSCRIBE
+        self._connected = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.dropped = 0  # Publishes dropped while disconnected or backed up
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            try:
+                await asyncio.wait_for(self._connected.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                print(f"Backplane not reachable at {self.host}:{self.port}, retrying in background")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            try:
+                # Gone on purpose: nobody needs to wait out the heartbeat
+                reader, writer = await self._open(select_db=True)
+                writer.write(_encode_command("DEL", self._heartbeat_key(self.worker_id)))
+                await writer.drain()
+                await _read_reply(reader)
+                writer.close()
+            except (OSError, ConnectionError, asyncio.IncompleteReadError):
+                pass
+
+    # ---- connection handling ----
+    async def _open(self, select_db: bool):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(_encode_command("AUTH", self.password))
+            if isinstance(await _read_reply(reader), RedisError):
+                raise ConnectionError("Backplane authentication failed")
+        if select_db and self.db:
+            writer.write(_encode_command("SELECT", self.db))
+            await _read_reply(reader)
+        return reader, writer
+
+    async def _run(self):
+        while True:
+            cmd_writer = None
+            tasks = []
+            try:
+                cmd_reader, cmd_writer = await self._open(select_db=True)
+                sub_reader, self._sub_writer = await self._open(select_db=False)
+                for channel in self._handlers:
+                    self._sub_writer.write(_encode_command("SUBSCRIBE", channel))
+                self._outbox = asyncio.Queue(maxsize=BACKPLANE_QUEUE_SIZE)
+                tasks = [
+                    asyncio.create_task(self._write_commands(cmd_writer, self._outbox)),
+                    asyncio.create_task(self._read_replies(cmd_reader)),
+                    asyncio.create_task(self._read_messages(sub_reader)),
+                    asyncio.create_task(self._heartbeat())
+                ]
+                self._connected.set()
+                # Any of them failing means the connection is gone: stop the rest too
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                for task in done:
+                    task.result()
+            except (OSError, ConnectionError, asyncio.IncompleteReadError) as e:
+                print(f"Backplane connection lost: {e}")
+            finally:
+                self._connected.clear()
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                for writer in (cmd_writer, self._sub_writer):
+                    if writer is not None:
+                        writer.close()
+                self._sub_writer = None
+                self._fail_waiting(ConnectionError("Backplane connection lost"))
+            await asyncio.sleep(1)
+
+    def _fail_waiting(self, error: Exception):
+        outbox, self._outbox = self._outbox, None
+        futures = list(self._pending)
+        self._pending.clear()
+        while outbox is not None and not outbox.empty():
+            futures.append(outbox.get_nowait()[1])
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    async def _write_commands(self, writer: asyncio.StreamWriter, outbox: asyncio.Queue):
+        while True:
+            command, future = await outbox.get()
+            writer.write(command)
+            self._pending.append(future)
+            # Write whatever else is waiting before paying for one drain
+            while not outbox.empty():
+                command, future = outbox.get_nowait()
+                writer.write(command)
+                self._pending.append(future)
+            await writer.drain()
+
+    async def _read_replies(self, reader: asyncio.StreamReader):
+        while True:
+            reply = await _read_reply(reader)
+            future = self._pending.popleft() if self._pending else None
+            if future is None or future.done():
+                continue
+            if isinstance(reply, RedisError):
+                future.set_exception(reply)
+            else:
+                future.set_result(reply)
+
+    async def _read_messages(self, reader: asyncio.StreamReader):
+        while True:
+            push = await _read_reply(reader)
+            if not isinstance(push, list) or len(push) != 3:
+                continue
+            if push[0] == b"subscribe":
+                confirmed = self._confirming.pop(push[1].decode(), None)
+                if confirmed is not None and not confirmed.done():
+                    confirmed.set_result(None)
+                continue
+            if push[0] != b"message":
+                continue
+            handler = self._handlers.get(push[1].decode())
+            if handler is not None:
+                try:
+                    handler(push[2])
+                except Exception as e:
+                    print(f"Backplane handler error: {e}")
+
+    async def _heartbeat(self):
+        """Keep this worker's heartbeat key alive while connected"""
+        while True:
+            try:
+                await self._command("SET", self._heartbeat_key(self.worker_id), "1", "EX", BACKPLANE_WORKER_TTL)
+            except RedisError as e:
+                print(f"Backplane heartbeat failed: {e}")
+            await asyncio.sleep(BACKPLANE_WORKER_TTL / 3)
+
+    @staticmethod
+    def _heartbeat_key(worker_id: str) -> str:
+        return f"backplane:worker:{worker_id}"
+
+    def _send(self, *args) -> asyncio.Future:
+        """Queue a command for the writer; the future gets its reply"""
+        future = asyncio.get_running_loop().create_future()
+        if self._outbox is None:
+            future.set_exception(ConnectionError("Backplane not connected"))
+            return future
+        try:
+            self._outbox.put_nowait((_encode_command(*args), future))
+        except asyncio.QueueFull:
+            future.set_exception(ConnectionError("Backplane command queue full"))
+        return future
+
+    async def _command(self, *args):
+        return await self._send(*args)
+
+    # ---- pub/sub ----
+    def publish(self, channel: str, message: bytes):
+        future = self._send("PUBLISH", channel, message)
+        # Fire and forget; read the outcome so failures aren't reported as unhandled
+        future.add_done_callback(self._published)
+
+    def _published(self, future: asyncio.Future):
+        if future.exception() is not None:
+            self.dropped += 1
+
+    def subscribe(self, channel: str, handler: Handler):
+        self._handlers[channel] = handler
+        # Confirmed on this connection or, if it's down, after the reconnect
+        self._confirming[channel] = asyncio.get_running_loop().create_future()
+        if self._sub_writer is not None:
+            self._sub_writer.write(_encode_command("SUBSCRIBE", channel))
+
+    def unsubscribe(self, channel: str):
+        self._confirming.pop(channel, None)
+        if self._handlers.pop(channel, None) is not None and self._sub_writer is not None:
+            self._sub_writer.write(_encode_command("UNSUBSCRIBE", channel))
+
+    async def subscribed(self, channel: str):
+        confirming = self._confirming.get(channel)
+        if confirming is not None:
+            await asyncio.shield(confirming)
+
+    # ---- presence ----
+    async def presence_add(self, key: str, member_id: str, value: str):
+        await self._command("HSET", key, member_id, f"{self.worker_id} {value}")
+        await self._command("EXPIRE", key, PRESENCE_TTL_SECONDS)
+
+    async def presence_remove(self, key: str, member_id: str):
+        await self._command("HDEL", key, member_id)
+
+    async def presence_list(self, key: str) -> Dict[str, str]:
+        flat = await self._command("HGETALL", key) or []
+        entries = {}  # member: (worker, value)
+        for i in range(0, len(flat) - 1, 2):
+            worker, _, value = flat[i + 1].decode().partition(" ")
+            entries[flat[i].decode()] = (worker, value)
+        workers = sorted({worker for worker, _ in entries.values()})
+        if not workers:
+            return {}
+        beats = await self._command("MGET", *(self._heartbeat_key(worker) for worker in workers))
+        alive = {worker for worker, beat in zip(workers, beats) if beat is not None}
+        gone = [member for member, (worker, _) in entries.items() if worker not in alive]
+        if gone:
+            # Left behind by a worker that stopped without cleaning up
+            self._send("HDEL", key, *gone).add_done_callback(lambda f: f.exception())
+        return {member: value for member, (worker, value) in entries.items() if worker in alive}
+
+
+def create_backplane(url: str) -> Backplane:
+    if url.startswith("redis://"):
+        return RedisBackplane(url)
+    return InProcessBackplane()
+
+
+backplane = create_backplane(BACKPLANE_URL)
+
+
+def shared_workers() -> bool:
+    """True when other processes may serve the same room's HTTP requests, so
+    state kept in this process's memory can't stand in for the database"""
+    return MULTI_WORKER or backplane.distributed
@@ -1,17 +1,37 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from app.models.db import get_db
+import os
+import json
+import gzip
+import hashlib
+from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.models.db import get_db, state_etag, SNAPSHOT_GZIP_LEVEL
 from app.routers.auth import get_current_user
 from pydantic import BaseModel
+from .websockets import manager
+from .save_buffer import save_buffer
+from .stroke_codec import expand_state_json, expand_strokes
+from .state_cache import body_cache
+from .state_stream import snapshot_stream_plan, stream_snapshot, save_canvas_stream_service
+from .tile_service import tile_service, CANVAS_TILE_LEVELS, CANVAS_TILE_MAX_INDEX
+from .spatial_index import room_indexes
 from .drawings_service import (
     clear_canvas_service,
     save_canvas_snapshot_service,
     list_snapshots_service,
-    load_snapshot_service,
-    save_canvas_state_service,
-    load_canvas_state_service
+    load_snapshot_service
 )
 
+try:
+    import brotli
+except ImportError:  # br is optional; gzip is always offered
+    brotli = None
+
+# Load responses smaller than this are sent uncompressed
+CANVAS_COMPRESS_MIN_BYTES = int(os.getenv("CANVAS_COMPRESS_MIN_BYTES", "1024"))
+
 router = APIRouter(
     prefix="/canvas",
     tags=["Canvas Persistence"]
@@ -27,24 +47,112 @@ class CanvasSaveRequest(BaseModel):
     room_id: str
     state_json: str
 
+# State is stored with freehand strokes compacted. Clients that render the
+# compact "stroke" shape ask for ?strokes=compact; everyone else gets segments.
+def render_state(state_json: str, strokes: str) -> str:
+    if strokes == "compact":
+        return state_json
+    return expand_state_json(state_json)
+
+def accepted_codings(request: Request) -> set:
+    codings = set()
+    for part in request.headers.get("accept-encoding", "").split(","):
+        coding, _, params = part.strip().partition(";")
+        try:
+            q = float(params.split("=", 1)[1]) if "=" in params else 1.0
+        except ValueError:
+            q = 1.0
+        if coding.strip() and q > 0:
+            codings.add(coding.strip().lower())
+    return codings
+
+def choose_coding(request: Request):
+    codings = accepted_codings(request)
+    if brotli is not None and "br" in codings:
+        return "br"
+    if "gzip" in codings or "*" in codings:
+        return "gzip"
+    return None
+
+def compress_body(body: bytes, coding: str):
+    """Returns (body, Content-Encoding or None)"""
+    if coding is None or len(body) < CANVAS_COMPRESS_MIN_BYTES:
+        return body, None
+    if coding == "br":
+        return brotli.compress(body, quality=5), "br"
+    return gzip.compress(body, SNAPSHOT_GZIP_LEVEL, mtime=0), "gzip"
+
+# One strong ETag per representation: the stored state hash plus everything
+# else that changes the bytes (stroke format, raw or wrapped, encoding, room
+# and time). Not the row id, which a buffered save doesn't have yet; the
+# written row keeps its state and time, so the ETag holds across the write.
+def response_etag(snapshot, variant: str) -> str:
+    base = snapshot.etag or state_etag(snapshot.state_json)
+    extra = f"{variant}|{snapshot.room_id}|{snapshot.created_at}"
+    return f'"{base}-{hashlib.blake2b(extra.encode(), digest_size=4).hexdigest()}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in header.split(",")]
+    return etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+# Load responses carry an ETag; a request whose If-None-Match still matches
+# gets a bodyless 304. Bodies are compressed when large and cached by ETag.
+# With ?raw=true the body is the strokes array itself, with the room and time
+# in headers. A compressed compact keyframe then goes out exactly as stored,
+# with Content-Encoding, so it is never decompressed and compressed again.
+def state_response(request: Request, snapshot, strokes: str, raw: bool, content=None) -> Response:
+    coding = choose_coding(request)
+    etag = response_etag(snapshot, f"{strokes}|{raw}|{coding}")
+    headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if raw:
+        headers["X-Room-Id"] = snapshot.room_id
+        if snapshot.created_at:
+            headers["X-Created-At"] = snapshot.created_at.isoformat()
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    cached = body_cache.get(etag)
+    if cached is None:
+        if raw and strokes == "compact" and coding == "gzip" and snapshot.is_keyframe and snapshot.codec == "gzip":
+            cached = (snapshot.state_data, "gzip")
+        elif raw:
+            cached = compress_body(render_state(snapshot.state_json, strokes).encode(), coding)
+        else:
+            cached = compress_body(json.dumps(jsonable_encoder(content())).encode(), coding)
+        body_cache.put(etag, cached)
+    body, used = cached
+    if used:
+        headers["Content-Encoding"] = used
+    return Response(body, media_type="application/json", headers=headers)
+
 # ---- OWNER-ONLY CLEAR CANVAS ----
 @router.post("/clear/{room_id}", status_code=status.HTTP_200_OK)
-def clear_canvas(
+async def clear_canvas(
     room_id: str,
     current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    new_snapshot = clear_canvas_service(db, room_id, current_user["user_id"])
+    async with save_buffer.replacing(room_id):
+        new_snapshot = await clear_canvas_service(db, room_id, current_user["user_id"])
+    # Reset the live room log and clear everyone's canvas
+    await manager.broadcast_clear(room_id, current_user)
     return {"message": "Canvas cleared.", "room_id": room_id, "snapshot_id": new_snapshot.id}
 
 # ---- SAVE SNAPSHOT (CREATE new version) - PROTECTED ----
 @router.post("/snapshot", status_code=status.HTTP_201_CREATED)
-def save_canvas_snapshot(
+async def save_canvas_snapshot(
     payload: CanvasSnapshotRequest,
     current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    snapshot = save_canvas_snapshot_service(db, payload, current_user["email"])
+    # The new version is stored against the room's latest state, so write that first
+    await save_buffer.flush(payload.room_id)
+    snapshot = await save_canvas_snapshot_service(db, payload, current_user["email"])
     return {
         "message": "Snapshot saved.",
         "snapshot_id": snapshot.id,
@@ -52,14 +160,32 @@ def save_canvas_snapshot(
         "saved_by": current_user["email"]
     }
 
+# Paging cursor for snapshot listings: "<created_at ISO>,<id>" of the last row seen
+def parse_cursor(before: str):
+    created_at, _, snapshot_id = before.rpartition(",")
+    try:
+        return datetime.fromisoformat(created_at), int(snapshot_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid 'before' cursor.")
+
+def format_cursor(cursor) -> str:
+    return f"{cursor[0].isoformat()},{cursor[1]}"
+
 # ---- LIST SNAPSHOTS FOR ROOM - PROTECTED ----
 @router.get("/snapshots/{room_id}", status_code=status.HTTP_200_OK)
-def list_snapshots(
+async def list_snapshots(
     room_id: str,
+    response: Response,
+    before: str = Query(None),
+    limit: int = Query(50, ge=1, le=200),
     current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    snapshots = list_snapshots_service(db, room_id)
+    snapshots, next_cursor = await list_snapshots_service(
+        db, room_id, parse_cursor(before) if before else None, limit
+    )
+    if next_cursor is not None:
+        response.headers["X-Next-Before"] = format_cursor(next_cursor)
     return [
         {
             "snapshot_id": snap.id,
@@ -71,41 +197,155 @@ def list_snapshots(
 
 # ---- LOAD SPECIFIC SNAPSHOT BY ID - PROTECTED ----
 @router.get("/snapshot/{snapshot_id}", status_code=status.HTTP_200_OK)
-def load_snapshot(
+async def load_snapshot(
+    request: Request,
     snapshot_id: int,
+    strokes: str = Query("legacy"),
+    raw: bool = Query(False),
     current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    snapshot = load_snapshot_service(db, snapshot_id)
-    return {
+    snapshot = await load_snapshot_service(db, snapshot_id)
+    return state_response(request, snapshot, strokes, raw, lambda: {
         "snapshot_id": snapshot.id,
         "room_id": snapshot.room_id,
-        "state_json": snapshot.state_json,
+        "state_json": render_state(snapshot.state_json, strokes),
         "created_at": snapshot.created_at
-    }
+    })
+
+# ---- STREAM SPECIFIC SNAPSHOT BY ID - PROTECTED ----
+# Same body as ?raw=true, but read from the database and sent in chunks, so a
+# large canvas is never held in memory whole
+@router.get("/snapshot/{snapshot_id}/stream", status_code=status.HTTP_200_OK)
+async def stream_snapshot_state(
+    snapshot_id: int,
+    strokes: str = Query("legacy"),
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    snapshot, keyframe, pieces, rest = await snapshot_stream_plan(db, snapshot_id)
+    headers = {"X-Room-Id": snapshot.room_id}
+    if snapshot.created_at:
+        headers["X-Created-At"] = snapshot.created_at.isoformat()
+    return StreamingResponse(
+        stream_snapshot(keyframe, pieces, rest, strokes), media_type="application/json", headers=headers
+    )
 
 # ---- SAVE CURRENT CANVAS STATE - PROTECTED ----
 @router.post("/save", status_code=status.HTTP_201_CREATED)
-def save_canvas_state(
+async def save_canvas_state(
     payload: CanvasSaveRequest,
-    current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: dict = Depends(get_current_user)
 ):
-    state = save_canvas_state_service(db, payload)
+    # Buffered per room and written once the room goes quiet (see save_buffer)
+    await save_buffer.save(payload)
     return {"message": "Canvas state saved", "room_id": payload.room_id}
 
+# ---- SAVE CURRENT CANVAS STATE FROM A STREAMED BODY - PROTECTED ----
+# The body is the strokes array itself, parsed as it arrives. Written straight
+# away as a new keyframe; any buffered save for the room is older, so dropped.
+@router.post("/save/stream", status_code=status.HTTP_201_CREATED)
+async def save_canvas_state_stream(
+    request: Request,
+    room_id: str = Query(...),
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    async with save_buffer.replacing(room_id):
+        await save_canvas_stream_service(db, room_id, request.stream())
+    return {"message": "Canvas state saved", "room_id": room_id}
+
 # ---- LOAD CURRENT CANVAS STATE - PROTECTED ----
 @router.get("/load/{room_id}", status_code=status.HTTP_200_OK)
-def load_canvas_state(
+async def load_canvas_state(
+    request: Request,
     room_id: str,
+    strokes: str = Query("legacy"),
+    raw: bool = Query(False),
     current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    latest = load_canvas_state_service(db, room_id)
+    latest = await save_buffer.load(db, room_id)
     if not latest:
+        if raw:
+            return Response("[]", media_type="application/json")
         return {"state_json": "[]", "room_id": room_id}
-    return {
-        "state_json": latest.state_json,
+    return state_response(request, latest, strokes, raw, lambda: {
+        "state_json": render_state(latest.state_json, strokes),
         "room_id": latest.room_id,
         "last_updated": latest.created_at
-    }
+    })
+
+# ---- STROKES INSIDE A VIEWPORT - PROTECTED ----
+# Only the strokes whose bounding box meets [x0, x1) x [y0, y1), in drawing
+# order, from the room's spatial index. "z" gives each one's position in the
+# full state, so a client loading the canvas piece by piece can merge pieces
+# in order and skip strokes it already has. With legacy strokes, a compact
+# stroke expands to several segments that share its z.
+@router.get("/viewport/{room_id}", status_code=status.HTTP_200_OK)
+async def canvas_viewport(
+    request: Request,
+    room_id: str,
+    x0: float = Query(...),
+    y0: float = Query(...),
+    x1: float = Query(...),
+    y1: float = Query(...),
+    strokes: str = Query("legacy"),
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    if x1 <= x0 or y1 <= y0:
+        raise HTTPException(status_code=400, detail="Viewport must have x1 > x0 and y1 > y0.")
+    latest = await save_buffer.load(db, room_id)
+    coding = choose_coding(request)
+    headers = {"Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if latest is not None:
+        headers["ETag"] = response_etag(latest, f"viewport|{x0},{y0},{x1},{y1}|{strokes}|{coding}")
+        if etag_matches(request, headers["ETag"]):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    index = room_indexes.sync(room_id, latest)
+    z, items = [], []
+    for position in index.query(x0, y0, x1, y1).tolist():
+        shown = [index.strokes[position]] if strokes == "compact" else expand_strokes([index.strokes[position]])
+        items.extend(shown)
+        z.extend([position] * len(shown))
+    body, used = compress_body(json.dumps({
+        "room_id": room_id,
+        "total": len(index.strokes),
+        "bounds": index.extent(),
+        "z": z,
+        "strokes": items
+    }).encode(), coding)
+    if used:
+        headers["Content-Encoding"] = used
+    return Response(body, media_type="application/json", headers=headers)
+
+# ---- RENDERED TILES OF THE CURRENT CANVAS - PROTECTED ----
+@router.get("/tiles/{room_id}", status_code=status.HTTP_200_OK)
+async def canvas_tile_info(
+    room_id: str,
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    latest = await save_buffer.load(db, room_id)
+    return tile_service.info(room_id, latest)
+
+@router.get("/tiles/{room_id}/{z}/{x}/{y}.png", status_code=status.HTTP_200_OK)
+async def canvas_tile(
+    request: Request,
+    room_id: str,
+    z: int,
+    x: int,
+    y: int,
+    current_user: dict = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    if not (0 <= z < CANVAS_TILE_LEVELS and 0 <= x < CANVAS_TILE_MAX_INDEX and 0 <= y < CANVAS_TILE_MAX_INDEX):
+        raise HTTPException(status_code=404, detail="Tile out of range.")
+    latest = await save_buffer.load(db, room_id)
+    png, etag = await tile_service.tile(room_id, latest, z, x, y)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(png, media_type="image/png", headers=headers)
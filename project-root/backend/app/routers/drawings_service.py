@@ -1,50 +1,223 @@
-from sqlalchemy.orm import Session
+import os
+import json
+from difflib import SequenceMatcher
+from itertools import islice
+from sqlalchemy import select, or_, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import HTTPException, status
-from app.models.db import CanvasSnapshot, Room
+from fastapi.concurrency import run_in_threadpool
+from app.models.db import CanvasSnapshot, Room, state_etag
 from datetime import datetime
+from .stroke_codec import compact_state_json
+from .history_compaction import compact_history_json
+from .state_cache import state_cache
 
-def clear_canvas_service(db: Session, room_id: str, user_id: int):
-    room = db.query(Room).filter(Room.id == room_id, Room.is_active == True).first()
+# A version is stored as a delta against the previous one unless the chain
+# since the last keyframe is this long, or the delta isn't much smaller
+SNAPSHOT_KEYFRAME_INTERVAL = int(os.getenv("SNAPSHOT_KEYFRAME_INTERVAL", "20"))
+SNAPSHOT_DELTA_MAX_RATIO = float(os.getenv("SNAPSHOT_DELTA_MAX_RATIO", "0.5"))
+
+# ==================== KEYFRAMES AND DELTAS ====================
+def compact_for_storage(state_json: str) -> str:
+    """A state as it is stored: compact strokes, simplified, history folded in"""
+    return compact_history_json(compact_state_json(state_json))
+
+def diff_strokes(old: list, new: list) -> dict:
+    """Delta turning old into new: {"remove": [...], "add": [...]}.
+
+    remove lists the indexes of old's strokes that are gone, ascending; add
+    lists [index in new, stroke] pairs for the strokes that are new, ascending.
+    Canvases mostly change at the end or by a few strokes in between (new
+    strokes, an undone stroke, an eraser folded in), so the delta stays small.
+    """
+    start = 0
+    limit = min(len(old), len(new))
+    while start < limit and old[start] == new[start]:
+        start += 1
+    old_end, new_end = len(old), len(new)
+    while old_end > start and new_end > start and old[old_end - 1] == new[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+
+    remove, add = [], []
+    matcher = SequenceMatcher(None, [_stroke_key(stroke) for stroke in old[start:old_end]],
+                              [_stroke_key(stroke) for stroke in new[start:new_end]], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != "equal":
+            remove.extend(range(start + i1, start + i2))
+            add.extend([start + j, new[start + j]] for j in range(j1, j2))
+    return {"remove": remove, "add": add}
+
+def _stroke_key(stroke) -> str:
+    return json.dumps(stroke, sort_keys=True, separators=(",", ":"))
+
+def apply_delta(strokes: list, delta: dict) -> list:
+    if "keep" in delta:
+        # Written before deltas listed removals: a kept prefix, then new strokes
+        return strokes[:delta["keep"]] + delta["add"]
+    removed = set(delta["remove"])
+    kept = iter([stroke for i, stroke in enumerate(strokes) if i not in removed])
+    result = []
+    for index, stroke in delta["add"]:
+        result.extend(islice(kept, index - len(result)))
+        result.append(stroke)
+    result.extend(kept)
+    return result
+
+async def _resolve_state(db: AsyncSession, snapshot: CanvasSnapshot) -> str:
+    """Full state of a version: its keyframe with the chain's deltas applied"""
+    if snapshot.is_keyframe:
+        return snapshot.payload
+    if snapshot.resolved_state is not None:
+        return snapshot.resolved_state
+    chain = await db.scalars(select(CanvasSnapshot).where(
+        or_(CanvasSnapshot.key_id == snapshot.key_id, CanvasSnapshot.id == snapshot.key_id)
+    ))
+    by_id = {row.id: row for row in chain}
+    path = []
+    current = snapshot
+    while not current.is_keyframe:
+        path.append(current)
+        current = by_id[current.parent_id]
+    strokes = json.loads(current.payload)
+    for row in reversed(path):
+        strokes = apply_delta(strokes, json.loads(row.payload))
+    snapshot.resolved_state = json.dumps(strokes, separators=(",", ":"))
+    return snapshot.resolved_state
+
+async def _store_version(db: AsyncSession, snapshot: CanvasSnapshot, parent: CanvasSnapshot, state_json: str):
+    """Write state_json into snapshot, as a delta against parent when that pays off"""
+    depth = 0 if parent is None or parent.is_keyframe else parent.depth
+    if parent is not None and depth < SNAPSHOT_KEYFRAME_INTERVAL:
+        try:
+            old = json.loads(await _resolve_state(db, parent))
+            new = json.loads(state_json)
+        except (TypeError, ValueError):
+            old = new = None
+        if isinstance(old, list) and isinstance(new, list):
+            delta_json = json.dumps(diff_strokes(old, new), separators=(",", ":"))
+            if len(delta_json) < SNAPSHOT_DELTA_MAX_RATIO * len(state_json):
+                snapshot.kind = "delta"
+                snapshot.parent_id = parent.id
+                snapshot.key_id = parent.id if parent.is_keyframe else parent.key_id
+                snapshot.depth = depth + 1
+                snapshot.payload = delta_json
+                snapshot.etag = state_etag(state_json)
+                snapshot.resolved_state = state_json
+                return
+    snapshot.state_json = state_json
+    snapshot.resolved_state = None
+
+async def _latest_snapshot(db: AsyncSession, room_id: str):
+    return await db.scalar(select(CanvasSnapshot).where(CanvasSnapshot.room_id == room_id).order_by(CanvasSnapshot.created_at.desc()).limit(1))
+# ==============================================================
+
+async def clear_canvas_service(db: AsyncSession, room_id: str, user_id: int):
+    room = await db.scalar(select(Room).where(Room.id == room_id, Room.is_active == True))
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
     if room.owner_id != user_id:
         raise HTTPException(status_code=403, detail="Only the room owner can clear the canvas.")
 
     blank_state = "[]"
-    new_snapshot = CanvasSnapshot(room_id=room_id, state_json=blank_state, created_by=user_id)
+    new_snapshot = CanvasSnapshot(room_id=room_id, state_json=blank_state, created_by=user_id, created_at=datetime.now())
     db.add(new_snapshot)
-    db.commit()
+    await db.commit()
+    state_cache.invalidate_room(room_id)
     return new_snapshot
 
-def save_canvas_snapshot_service(db: Session, payload, user_email: str):
-    snapshot = CanvasSnapshot(room_id=payload.room_id, state_json=payload.state_json, created_at=datetime.now())
+async def save_canvas_snapshot_service(db: AsyncSession, payload, user_email: str):
+    state_json = await run_in_threadpool(compact_for_storage, payload.state_json)
+    parent = await _latest_snapshot(db, payload.room_id)
+    snapshot = CanvasSnapshot(room_id=payload.room_id, created_at=datetime.now())
+    await _store_version(db, snapshot, parent, state_json)
     db.add(snapshot)
-    db.commit()
-    db.refresh(snapshot)
+    await db.commit()
+    state_cache.invalidate_room(payload.room_id)
+    await db.refresh(snapshot)
     return snapshot
 
-def list_snapshots_service(db: Session, room_id: str):
-    snapshots = db.query(CanvasSnapshot).filter(CanvasSnapshot.room_id == room_id).order_by(CanvasSnapshot.created_at.desc()).all()
-    return snapshots
+async def list_snapshots_service(db: AsyncSession, room_id: str, before: tuple = None, limit: int = 50):
+    """One page of a room's versions, newest first, without their state.
 
-def load_snapshot_service(db: Session, snapshot_id: int):
-    snapshot = db.query(CanvasSnapshot).filter(CanvasSnapshot.id == snapshot_id).first()
+    before is the (created_at, id) of the last row of the previous page.
+    Returns (rows, cursor for the next page or None).
+    """
+    query = (
+        select(CanvasSnapshot.id, CanvasSnapshot.room_id, CanvasSnapshot.created_at)
+        .where(CanvasSnapshot.room_id == room_id)
+        .order_by(CanvasSnapshot.created_at.desc(), CanvasSnapshot.id.desc())
+        .limit(limit + 1)
+    )
+    if before is not None:
+        query = query.where(tuple_(CanvasSnapshot.created_at, CanvasSnapshot.id) < tuple_(*before))
+    rows = (await db.execute(query)).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, (rows[-1].created_at, rows[-1].id)
+
+async def load_snapshot_service(db: AsyncSession, snapshot_id: int):
+    cached = state_cache.get(("snapshot", snapshot_id))
+    if cached is not None:
+        return cached
+    version = state_cache.version
+    snapshot = await db.get(CanvasSnapshot, snapshot_id)
     if not snapshot:
         raise HTTPException(status_code=404, detail="Snapshot not found.")
+    await _resolve_state(db, snapshot)
+    state_cache.put_snapshot(("snapshot", snapshot_id), snapshot, version)
     return snapshot
 
-def save_canvas_state_service(db: Session, payload):
-    existing = db.query(CanvasSnapshot).filter(CanvasSnapshot.room_id == payload.room_id).order_by(CanvasSnapshot.created_at.desc()).first()
-    if existing:
-        existing.state_json = payload.state_json
-        db.commit()
+async def save_canvas_state_service(db: AsyncSession, payload, buffered: CanvasSnapshot = None):
+    """Store an autosave. buffered is the save_buffer's snapshot of it, whose
+    state is already compacted and whose time the row takes."""
+    if buffered is not None:
+        state_json, saved_at = buffered.state_json, buffered.created_at
+    else:
+        state_json, saved_at = await run_in_threadpool(compact_for_storage, payload.state_json), datetime.now()
+    existing = await _latest_snapshot(db, payload.room_id)
+    if existing and existing.autosave and not existing.is_keyframe:
+        # Rewrite the last autosave against its own parent, so the write is
+        # the size of the changes. Keyframes and saved versions stay as they are.
+        parent = await db.get(CanvasSnapshot, existing.parent_id)
+        await _store_version(db, existing, parent, state_json)
+        existing.created_at = saved_at
+        await db.commit()
+        state_cache.invalidate_room(payload.room_id)
         return existing
     else:
-        new_state = CanvasSnapshot(room_id=payload.room_id, state_json=payload.state_json, created_at=datetime.now())
+        new_state = CanvasSnapshot(room_id=payload.room_id, created_at=saved_at, autosave=True)
+        await _store_version(db, new_state, existing, state_json)
         db.add(new_state)
-        db.commit()
+        await db.commit()
+        state_cache.invalidate_room(payload.room_id)
         return new_state
 
-def load_canvas_state_service(db: Session, room_id: str):
-    latest = db.query(CanvasSnapshot).filter(CanvasSnapshot.room_id == room_id).order_by(CanvasSnapshot.created_at.desc()).first()
+async def latest_etag_service(db: AsyncSession, room_id: str):
+    """etag of a room's latest state, or None if it has none. Reads just that
+    column, unless the row was written before states had one."""
+    cached = state_cache.get(("room", room_id))
+    if cached is not None:
+        return cached.etag or state_etag(cached.state_json)
+    row = (await db.execute(
+        select(CanvasSnapshot.id, CanvasSnapshot.etag).where(CanvasSnapshot.room_id == room_id)
+        .order_by(CanvasSnapshot.created_at.desc()).limit(1)
+    )).first()
+    if row is None:
+        return None
+    if row.etag is not None:
+        return row.etag
+    latest = await load_canvas_state_service(db, room_id)
+    return state_etag(latest.state_json)
+
+async def load_canvas_state_service(db: AsyncSession, room_id: str):
+    cached = state_cache.get(("room", room_id))
+    if cached is not None:
+        return cached
+    version = state_cache.version
+    latest = await _latest_snapshot(db, room_id)
+    if latest:
+        await _resolve_state(db, latest)
+    state_cache.put_snapshot(("room", room_id), latest, version)
     return latest
@@ -0,0 +1,206 @@
+"""
+Compaction of a room's drawing history down to what can still be seen.
+
+Two passes, both keeping the order of what survives:
+
+    fold_history   replays "clear" and "undo" entries the way clients do (a
+                   clear empties the canvas, an undo replaces it with its
+                   shapes) and returns just the strokes left standing.
+    drop_covered   removes strokes that later eraser strokes paint over
+                   completely. The eraser paints an opaque background-colored
+                   line, so the canvas looks the same without what is under
+                   it. Rectangles and ellipses are outlines, so erasers are
+                   the only strokes that can hide others entirely.
+
+drop_covered walks the strokes newest first, painting each eraser into one
+mask of everything erased later on. A stroke is tested against that mask
+drawn COVERAGE_MARGIN pixels wider than it is, so it is only dropped when no
+pixel of it could show. Most strokes are ruled out by one pixel: their first
+point.
+"""
+import os
+import json
+from typing import List, Set
+import numpy as np
+from PIL import Image, ImageDraw
+from .tile_renderer import stroke_bounds, paint_mask
+
+# Erasers spread over a larger box than this (in canvas pixels) aren't
+# looked at, and nothing is dropped
+CANVAS_COMPACT_MAX_AREA = int(os.getenv("CANVAS_COMPACT_MAX_AREA", str(4096 * 4096)))
+# Extra pixels a stroke is drawn wider when testing whether it is covered
+COVERAGE_MARGIN = 2
+
+HISTORY_TYPES = {"clear", "undo"}
+
+
+def is_eraser(stroke) -> bool:
+    return isinstance(stroke, dict) and (
+        stroke.get("type") == "eraser" or (stroke.get("type") == "stroke" and stroke.get("tool") == "eraser")
+    )
+
+
+def fold_history(ops: List) -> List:
+    """The strokes a client ends up drawing after replaying ops in order"""
+    start = None
+    for position in range(len(ops) - 1, -1, -1):
+        if isinstance(ops[position], dict) and ops[position].get("type") in HISTORY_TYPES:
+            start = position
+            break
+    if start is None:
+        return ops
+    last = ops[start]
+    shapes = last.get("shapes") if last.get("type") == "undo" else None
+    base = [shape for shape in shapes if isinstance(shape, dict)] if isinstance(shapes, list) else []
+    return base + ops[start + 1:]
+
+
+def drop_covered(strokes: List, skip: Set[int] = frozenset()) -> List:
+    """strokes without those that later erasers paint over completely.
+    Erasers at the positions in skip hide nothing."""
+    erasers = [position for position, stroke in enumerate(strokes) if is_eraser(stroke) and position not in skip]
+    area = _eraser_area([strokes[position] for position in erasers])
+    if area is None:
+        return strokes
+    x0, y0, width, height = area
+
+    erased = np.zeros((height, width), dtype=bool)  # Everything erased after the current stroke
+    dropped = set()
+    for position in range(erasers[-1], -1, -1):
+        stroke = strokes[position]
+        if position < erasers[-1] and _is_hidden(stroke, erased, x0, y0):
+            dropped.add(position)
+        if is_eraser(stroke) and position not in skip:
+            paint = _eraser_paint(stroke, x0, y0)
+            if paint is not None:
+                erased[paint[0]] |= paint[1]
+    if not dropped:
+        return strokes
+    return [stroke for position, stroke in enumerate(strokes) if position not in dropped]
+
+
+class CoveredStrokes:
+    """drop_covered for strokes that can't all be held at once.
+
+    Strokes go through twice, in the same order: note() each one, then
+    start(), then hidden() each one again. Only the erasers are kept; instead
+    of the newest-first walk, a count of how many erasers still lie ahead
+    covers each pixel is taken down as the second pass goes by them.
+    """
+
+    def __init__(self):
+        self._erasers = []
+        self._last = -1   # Position of the last eraser
+        self._position = 0
+        self._ahead = None
+
+    def note(self, stroke):
+        if is_eraser(stroke):
+            self._erasers.append(stroke)
+            self._last = self._position
+        self._position += 1
+
+    def start(self) -> bool:
+        """Get ready for the second pass; False when nothing can be hidden"""
+        area = _eraser_area(self._erasers)
+        if area is None:
+            return False
+        self._x0, self._y0, width, height = area
+        self._ahead = np.zeros((height, width), dtype=np.uint16 if len(self._erasers) < 2 ** 16 else np.uint32)
+        for stroke in self._erasers:
+            paint = _eraser_paint(stroke, self._x0, self._y0)
+            if paint is not None:
+                self._ahead[paint[0]] += paint[1]
+        self._erasers = []
+        self._position = 0
+        return True
+
+    def hidden(self, stroke) -> bool:
+        position = self._position
+        self._position += 1
+        if is_eraser(stroke):
+            paint = _eraser_paint(stroke, self._x0, self._y0)
+            if paint is not None:
+                self._ahead[paint[0]] -= paint[1]
+        return position < self._last and _is_hidden(stroke, self._ahead, self._x0, self._y0)
+
+
+def _eraser_area(erasers: List):
+    """(x0, y0, width, height) of the box the erasers reach, or None when
+    there are none or it is larger than CANVAS_COMPACT_MAX_AREA"""
+    if not erasers:
+        return None
+    reach = stroke_bounds(erasers)
+    reach = reach[~np.isnan(reach[:, 0])]
+    if not len(reach):
+        return None
+    x0, y0 = int(np.floor(reach[:, 0].min())), int(np.floor(reach[:, 1].min()))
+    width = int(np.ceil(reach[:, 2].max())) - x0 + 1
+    height = int(np.ceil(reach[:, 3].max())) - y0 + 1
+    if width * height > CANVAS_COMPACT_MAX_AREA:
+        return None
+    return x0, y0, width, height
+
+
+def _eraser_paint(stroke: dict, x0: int, y0: int):
+    """(region, pixels) an eraser paints in a mask starting at (x0, y0), or None"""
+    box = stroke_bounds([stroke])[0]
+    if np.isnan(box[0]):
+        return None
+    left, top = int(np.floor(box[0])) - x0, int(np.floor(box[1])) - y0
+    right, bottom = int(np.ceil(box[2])) - x0 + 1, int(np.ceil(box[3])) - y0 + 1
+    painted = Image.new("L", (right - left, bottom - top), 0)
+    paint_mask(ImageDraw.Draw(painted), [stroke], left + x0, top + y0)
+    return (slice(top, bottom), slice(left, right)), np.asarray(painted) > 0
+
+
+def _first_point(stroke: dict):
+    """A point the stroke paints, without working out the rest of them"""
+    try:
+        if stroke.get("type") in ("stroke", "text"):
+            return float(stroke["x"]), float(stroke["y"])
+        return float(stroke["fromX"]), float(stroke["fromY"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _is_hidden(stroke, erased: np.ndarray, x0: int, y0: int) -> bool:
+    """Whether the erased mask (nonzero where erased) covers every pixel of stroke"""
+    first = _first_point(stroke) if isinstance(stroke, dict) else None
+    if first is None:
+        return False
+    height, width = erased.shape
+    # Inside the erased area at all? Checked on one pixel first
+    px, py = int(np.floor(first[0])) - x0, int(np.floor(first[1])) - y0
+    if not (0 <= px < width and 0 <= py < height) or not erased[py, px]:
+        return False
+    box = stroke_bounds([stroke])[0]
+    if np.isnan(box[0]):
+        return False
+    left, top = int(np.floor(box[0])) - x0 - COVERAGE_MARGIN, int(np.floor(box[1])) - y0 - COVERAGE_MARGIN
+    right, bottom = int(np.ceil(box[2])) - x0 + COVERAGE_MARGIN, int(np.ceil(box[3])) - y0 + COVERAGE_MARGIN
+    if left < 0 or top < 0 or right > width or bottom > height:
+        return False  # Reaches past every eraser
+    shown = Image.new("L", (right - left, bottom - top), 0)
+    paint_mask(ImageDraw.Draw(shown), [stroke], left + x0, top + y0, grow=COVERAGE_MARGIN)
+    hidden = erased[top:bottom, left:right] > 0
+    return not ((np.asarray(shown) > 0) & ~hidden).any()
+
+
+def compact_history(ops: List) -> List:
+    """Only the strokes that are still visible, in drawing order"""
+    return drop_covered(fold_history(ops))
+
+
+def compact_history_json(state_json: str) -> str:
+    """compact_history over a serialized strokes list; anything else is kept as-is"""
+    try:
+        strokes = json.loads(state_json)
+    except (TypeError, ValueError):
+        return state_json
+    if not isinstance(strokes, list):
+        return state_json
+    compacted = compact_history(strokes)
+    if compacted is strokes:
+        return state_json
+    return json.dumps(compacted, separators=(",", ":"))
@@ -1,7 +1,41 @@
 from fastapi import APIRouter
+from app.models.db import pool_stats
+from app.routers.save_buffer import save_buffer
+from app.routers.state_cache import state_cache, body_cache
+from app.routers import retention_service
+from app.routers.tile_service import tile_service
+from app.routers.spatial_index import room_indexes
+from app.routers.thumbnail_service import thumbnail_service
 
 router = APIRouter()
 
 @router.get("/hello")
 async def say_hello():
     return {"message": "Hello from the /hello endpoint"}
+
+@router.get("/health/db")
+async def db_pool_status():
+    """Connection pool usage: open, checked out and overflow connections"""
+    return pool_stats()
+
+
+@router.get("/health/saves")
+async def save_buffer_status():
+    """Canvas saves received, coalesced and written by the write-behind buffer"""
+    return {**save_buffer.stats, "pending": len(save_buffer.pending)}
+
+@router.get("/health/cache")
+async def canvas_cache_status():
+    """Entries, hits and misses of the canvas state, response body, tile and thumbnail caches"""
+    return {
+        "states": state_cache.stats(),
+        "bodies": body_cache.stats(),
+        "tiles": {**tile_service.tiles.stats(), **tile_service.stats},
+        "indexes": {"rooms": len(room_indexes), **room_indexes.stats},
+        "thumbnails": {**thumbnail_service.thumbnails.stats(), **thumbnail_service.stats}
+    }
+
+@router.get("/health/retention")
+async def retention_status():
+    """Totals from the last snapshot retention run (rooms, deleted, reclaimed_bytes)"""
+    return retention_service.last_run or {"message": "Retention has not run yet"}
@@ -0,0 +1,190 @@
+"""
+Snapshot retention: thin out old canvas versions in the background.
+
+SNAPSHOT_RETENTION_TIERS lists "max_age:step" pairs in seconds, youngest
+first. A version younger than a tier's max_age falls in that tier and is kept
+if it is the newest one in its step-sized time bucket; step 0 keeps every
+version. "*" as max_age means any age. The default keeps everything for an
+hour, one version an hour for a day, then one a day.
+
+A room's newest version and the one it is based on are always kept. Kept
+deltas whose parent goes are re-stored against the previous kept version
+before anything is deleted. Deletes then run newest first in small batches,
+each in its own short transaction, so a busy room is never locked for long.
+"""
+import os
+import asyncio
+from datetime import datetime
+from typing import List, Tuple
+from sqlalchemy import select, delete, func, text
+from app.models.db import CanvasSnapshot, AsyncSessionLocal, async_engine
+from .drawings_service import _resolve_state, _store_version
+from .state_cache import state_cache
+
+SNAPSHOT_RETENTION_TIERS = os.getenv("SNAPSHOT_RETENTION_TIERS", "3600:0,86400:3600,*:86400")
+SNAPSHOT_RETENTION_INTERVAL = int(os.getenv("SNAPSHOT_RETENTION_INTERVAL", "3600"))  # Seconds between runs; 0 = off
+SNAPSHOT_RETENTION_BATCH = int(os.getenv("SNAPSHOT_RETENTION_BATCH", "100"))          # Rows per transaction
+
+# Held for the whole run on PostgreSQL so only one worker compacts at a time
+RETENTION_LOCK_KEY = 0x63616e76
+
+# Totals from the last run, for /health/retention
+last_run = {}
+
+
+def parse_tiers(spec: str) -> List[Tuple[float, float]]:
+    tiers = []
+    for part in spec.split(","):
+        max_age, _, step = part.strip().partition(":")
+        tiers.append((float("inf") if max_age == "*" else float(max_age), float(step or 0)))
+    return tiers
+
+
+def versions_to_keep(rows, tiers, now: datetime = None) -> set:
+    """Ids to keep out of a room's versions (oldest first)"""
+    keep = set()
+    newest_in_bucket = {}
+    for row in rows:
+        if row.created_at is None:
+            keep.add(row.id)
+            continue
+        age = ((now or datetime.now(row.created_at.tzinfo)) - row.created_at).total_seconds()
+        for index, (max_age, step) in enumerate(tiers):
+            if age < max_age:
+                if step <= 0:
+                    keep.add(row.id)
+                else:
+                    # Later rows overwrite earlier ones, so the newest wins
+                    newest_in_bucket[(index, int(row.created_at.timestamp() // step))] = row.id
+                break
+        else:
+            keep.add(row.id)  # Older than every tier: tiers don't cover it, so leave it
+    keep.update(newest_in_bucket.values())
+    keep.add(rows[-1].id)
+    if rows[-1].parent_id is not None:
+        keep.add(rows[-1].parent_id)
+    return keep
+
+
+def _stored_size(snapshot: CanvasSnapshot) -> int:
+    return len(snapshot.state_data or b"") + len(snapshot.state_text or "")
+
+
+async def compact_room(room_id: str, tiers) -> dict:
+    """Apply the retention tiers to one room; returns what was done"""
+    stats = {"deleted": 0, "rewritten": 0, "reclaimed_bytes": 0}
+    size = func.coalesce(func.length(CanvasSnapshot.state_data), 0) + func.coalesce(func.length(CanvasSnapshot.state_text), 0)
+    async with AsyncSessionLocal() as db:
+        rows = (await db.execute(
+            select(CanvasSnapshot.id, CanvasSnapshot.created_at, CanvasSnapshot.kind, CanvasSnapshot.parent_id, size.label("size"))
+            .where(CanvasSnapshot.room_id == room_id)
+            .order_by(CanvasSnapshot.created_at, CanvasSnapshot.id)
+        )).all()
+        if len(rows) < 2:
+            return stats
+        keep = versions_to_keep(rows, tiers)
+        doomed = [row for row in rows if row.id not in keep]
+        if not doomed:
+            return stats
+
+        # Kept deltas whose parent goes get re-stored against the previous kept
+        # version. Resolve every state involved first, while all chains are intact.
+        kept = [row for row in rows if row.id in keep]
+        rebase = {}  # kept delta: previous kept version (None: becomes a keyframe)
+        previous = None
+        for row in kept:
+            if row.kind == "delta" and row.parent_id not in keep:
+                rebase[row.id] = previous.id if previous else None
+            previous = row
+        loaded = {None: None}
+        for row_id in set(rebase) | set(rebase.values()) - {None}:
+            loaded[row_id] = await db.get(CanvasSnapshot, row_id)
+            await _resolve_state(db, loaded[row_id])
+
+        # Walk the kept versions in order, re-storing the rebased ones and fixing
+        # the chain position (key_id, depth) of deltas whose parent changed
+        changed = set()
+        pending = 0
+        for row in kept:
+            if row.id in rebase:
+                snapshot = loaded[row.id]
+                before = _stored_size(snapshot)
+                await _store_version(db, snapshot, loaded[rebase[row.id]], snapshot.resolved_state)
+                stats["reclaimed_bytes"] += before - _stored_size(snapshot)
+            elif row.kind == "delta" and row.parent_id in changed:
+                snapshot = await db.get(CanvasSnapshot, row.id)
+                parent = await db.get(CanvasSnapshot, row.parent_id)
+                snapshot.key_id = parent.id if parent.is_keyframe else parent.key_id
+                snapshot.depth = (0 if parent.is_keyframe else parent.depth) + 1
+            else:
+                continue
+            changed.add(row.id)
+            stats["rewritten"] += 1
+            pending += 1
+            if pending >= SNAPSHOT_RETENTION_BATCH:
+                await db.commit()
+                pending = 0
+        await db.commit()
+
+        # Children before parents, so no batch leaves a dangling parent_id
+        for start in range(len(doomed), 0, -SNAPSHOT_RETENTION_BATCH):
+            batch = doomed[max(0, start - SNAPSHOT_RETENTION_BATCH):start]
+            await db.execute(delete(CanvasSnapshot).where(CanvasSnapshot.id.in_([row.id for row in batch])))
+            await db.commit()
+            stats["deleted"] += len(batch)
+            stats["reclaimed_bytes"] += sum(row.size for row in batch)
+            await asyncio.sleep(0)  # Let requests in between batches
+    state_cache.invalidate_room(room_id)
+    return stats
+
+
+async def _try_lock(conn) -> bool:
+    if conn.dialect.name != "postgresql":
+        return True
+    return await conn.scalar(text("SELECT pg_try_advisory_lock(:key)"), {"key": RETENTION_LOCK_KEY})
+
+
+async def run_retention(tiers_spec: str = SNAPSHOT_RETENTION_TIERS) -> dict:
+    """One pass over every room with more than one version"""
+    tiers = parse_tiers(tiers_spec)
+    totals = {"rooms": 0, "deleted": 0, "rewritten": 0, "reclaimed_bytes": 0, "skipped": False}
+    started = datetime.now()
+    async with async_engine.connect() as lock_conn:
+        if not await _try_lock(lock_conn):
+            totals["skipped"] = True  # Another worker is running it
+            return totals
+        try:
+            async with AsyncSessionLocal() as db:
+                room_ids = (await db.scalars(
+                    select(CanvasSnapshot.room_id).group_by(CanvasSnapshot.room_id).having(func.count() > 1)
+                )).all()
+            for room_id in room_ids:
+                try:
+                    stats = await compact_room(room_id, tiers)
+                except Exception as e:
+                    print(f"Snapshot retention failed for room {room_id}: {e}")
+                    continue
+                totals["rooms"] += 1
+                for key, value in stats.items():
+                    totals[key] += value
+        finally:
+            if lock_conn.dialect.name == "postgresql":
+                await lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": RETENTION_LOCK_KEY})
+    totals["finished_at"] = datetime.now().isoformat()
+    totals["seconds"] = round((datetime.now() - started).total_seconds(), 3)
+    last_run.clear()
+    last_run.update(totals)
+    return totals
+
+
+async def retention_loop():
+    """Started with the app when SNAPSHOT_RETENTION_INTERVAL > 0"""
+    while True:
+        await asyncio.sleep(SNAPSHOT_RETENTION_INTERVAL)
+        try:
+            totals = await run_retention()
+            if totals["deleted"]:
+                print(f"Snapshot retention: deleted {totals['deleted']} versions in {totals['rooms']} rooms, "
+                      f"reclaimed {totals['reclaimed_bytes']} bytes")
+        except Exception as e:
+            print(f"Snapshot retention run failed: {e}")
@@ -0,0 +1,178 @@
+"""
+Write-behind buffer for /canvas/save.
+
+Autosaves from every member of a room land on the same row. Instead of
+writing each one, the latest state per room is held here and written once:
+
+    - when the room has had no new save for CANVAS_SAVE_IDLE_MS,
+    - at the latest CANVAS_SAVE_WINDOW_MS after the first unwritten save,
+    - when the room's last WebSocket member leaves,
+    - on shutdown,
+    - before anything that needs the stored state to be current (a new
+      snapshot, a clear).
+
+Loads read the buffered state first, so a client always sees its own save.
+A save is compacted once, as it arrives, with the same pipeline the stored
+state goes through; loads return that and the write stores it unchanged,
+so a room's etag doesn't move when the buffered save lands.
+CANVAS_SAVE_WINDOW_MS=0 turns buffering off and every save is written through.
+So does running several workers (the dispatcher, uvicorn --workers, or a
+distributed backplane): /canvas requests for one room may then reach any of
+them, and a save held in one process would be invisible to the others.
+"""
+import os
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Set
+from datetime import datetime
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.models.db import AsyncSessionLocal, CanvasSnapshot
+from fastapi.concurrency import run_in_threadpool
+from .drawings_service import (
+    save_canvas_state_service, load_canvas_state_service, latest_etag_service, compact_for_storage
+)
+from .backplane import shared_workers
+
+CANVAS_SAVE_WINDOW_MS = float(os.getenv("CANVAS_SAVE_WINDOW_MS", "2000"))
+CANVAS_SAVE_IDLE_MS = float(os.getenv("CANVAS_SAVE_IDLE_MS", "500"))
+
+
+class SaveBuffer:
+    def __init__(self):
+        self.pending: Dict[str, tuple] = {}           # room: (latest save payload, its compacted snapshot)
+        self._order: Dict[str, int] = {}              # room: count of saves and replacements begun
+        self._deadlines: Dict[str, float] = {}        # room: latest time it must be written by
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}     # One write per room at a time, in order
+        self._flushing: Set[asyncio.Task] = set()     # Background flushes still running
+        self.stats = {
+            "received": 0,    # Saves accepted
+            "coalesced": 0,   # Saves replaced by a newer one (or a clear) before being written
+            "flushed": 0,     # Database writes made
+            "failed": 0       # Writes that raised (the state is kept and retried)
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return CANVAS_SAVE_WINDOW_MS > 0 and not shared_workers()
+
+    async def save(self, payload):
+        """Accept a save; written now if buffering is off, otherwise later"""
+        self.stats["received"] += 1
+        if not self.enabled:
+            await self._write(payload.room_id, payload)
+            return
+        room = payload.room_id
+        ticket = self._order[room] = self._order.get(room, 0) + 1
+        state_json = await run_in_threadpool(compact_for_storage, payload.state_json)
+        if self._order[room] != ticket:
+            # A newer save or a replacement started while this one compacted
+            self.stats["coalesced"] += 1
+            return
+        if room in self.pending:
+            self.stats["coalesced"] += 1
+        # Not added to a session, so it is never written from here
+        snapshot = CanvasSnapshot(room_id=room, state_json=state_json, created_at=datetime.now())
+        self.pending[room] = (payload, snapshot)
+
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        deadline = self._deadlines.setdefault(room, now + CANVAS_SAVE_WINDOW_MS / 1000)
+        timer = self._timers.pop(room, None)
+        if timer:
+            timer.cancel()
+        delay = min(CANVAS_SAVE_IDLE_MS / 1000, max(0, deadline - now))
+        self._timers[room] = loop.call_later(delay, self.flush_soon, room)
+
+    async def load(self, db: AsyncSession, room: str):
+        """Latest canvas state: the unwritten save if there is one, else the stored row"""
+        entry = self.pending.get(room)
+        if entry is None:
+            return await load_canvas_state_service(db, room)
+        return entry[1]
+
+    async def etag(self, db: AsyncSession, room: str):
+        """etag of what load would return, or None if there is nothing,
+        without loading the stored state"""
+        entry = self.pending.get(room)
+        if entry is None:
+            return await latest_etag_service(db, room)
+        return entry[1].etag
+
+    @asynccontextmanager
+    async def replacing(self, room: str):
+        """Hold a room's writes while its state is replaced some other way (a
+        clear, a streamed save). The unwritten save is older than what
+        replaces it, so it is dropped if the block succeeds and written after
+        all if it fails."""
+        self._cancel_timer(room)
+        self._order[room] = self._order.get(room, 0) + 1
+        entry = self.pending.pop(room, None)
+        lock = self._locks.setdefault(room, asyncio.Lock())
+        try:
+            async with lock:
+                yield
+        except BaseException:
+            if entry is not None and room not in self.pending:
+                self.pending[room] = entry
+                self.flush_soon(room)
+            raise
+        if entry is not None:
+            self.stats["coalesced"] += 1
+
+    def flush_soon(self, room: str):
+        if room in self.pending:
+            task = asyncio.create_task(self.flush(room))
+            self._flushing.add(task)
+            task.add_done_callback(self._flushing.discard)
+
+    async def flush(self, room: str):
+        """Write a room's pending save now, if there is one"""
+        self._cancel_timer(room)
+        entry = self.pending.pop(room, None)
+        if entry is not None:
+            await self._write(room, entry[0], entry[1])
+        else:
+            await self._settle(room)
+
+    async def flush_all(self):
+        """Write every pending save and wait for background flushes (shutdown)"""
+        await asyncio.gather(
+            *(self.flush(room) for room in list(self.pending)),
+            *list(self._flushing)
+        )
+
+    def _cancel_timer(self, room: str):
+        self._deadlines.pop(room, None)
+        timer = self._timers.pop(room, None)
+        if timer:
+            timer.cancel()
+
+    async def _settle(self, room: str):
+        lock = self._locks.get(room)
+        if lock is not None and lock.locked():
+            async with lock:
+                pass
+
+    async def _write(self, room: str, payload, snapshot: CanvasSnapshot = None):
+        """Store a save; snapshot is its already compacted state, if any"""
+        lock = self._locks.setdefault(room, asyncio.Lock())
+        try:
+            async with lock:
+                async with AsyncSessionLocal() as db:
+                    await save_canvas_state_service(db, payload, snapshot)
+                self.stats["flushed"] += 1
+        except Exception as e:
+            self.stats["failed"] += 1
+            print(f"Could not write canvas state for room {room}: {e}")
+            if not self.enabled:
+                raise
+            # Keep it for the next attempt unless a newer save arrived meanwhile
+            if room not in self.pending:
+                self.pending[room] = (payload, snapshot)
+                self._timers[room] = asyncio.get_running_loop().call_later(
+                    CANVAS_SAVE_WINDOW_MS / 1000, self.flush_soon, room
+                )
+
+
+save_buffer = SaveBuffer()
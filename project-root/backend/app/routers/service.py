@@ -1,9 +1,11 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import HTTPException, status
 from app.models.db import Room, UserRoom, UserRole
+from .thumbnail_service import thumbnail_service
 import uuid
 
-def create_room_service(db: Session, user_id: int, room_data):
+async def create_room_service(db: AsyncSession, user_id: int, room_data):
     new_room_id = f"room-{str(uuid.uuid4())[:8]}"
     room = Room(
         id=new_room_id,
@@ -13,32 +15,32 @@ def create_room_service(db: Session, user_id: int, room_data):
         max_users=room_data.max_users,
     )
     db.add(room)
-    db.commit()
-    db.refresh(room)
+    await db.commit()
+    await db.refresh(room)
     owner_membership = UserRoom(
         user_id=user_id,
         room_id=new_room_id,
         role=UserRole.OWNER
     )
     db.add(owner_membership)
-    db.commit()
+    await db.commit()
     return room
 
-def join_room_service(db: Session, user_id: int, room_id: str):
-    room = db.query(Room).filter(Room.id == room_id, Room.is_active == True).first()
+async def join_room_service(db: AsyncSession, user_id: int, room_id: str):
+    room = await db.scalar(select(Room).where(Room.id == room_id, Room.is_active == True))
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
-    membership = db.query(UserRoom).filter(
+    membership = await db.scalar(select(UserRoom).where(
         UserRoom.room_id == room_id,
         UserRoom.user_id == user_id,
         UserRoom.is_active == True
-    ).first()
+    ).limit(1))
     if membership:
         return "Already a member"
-    members_count = db.query(UserRoom).filter(
+    members_count = await db.scalar(select(func.count()).select_from(UserRoom).where(
         UserRoom.room_id == room_id,
         UserRoom.is_active == True
-    ).count()
+    ))
     if members_count >= room.max_users:
         raise HTTPException(status_code=403, detail="Room is full")
     new_member = UserRoom(
@@ -47,73 +49,79 @@ def join_room_service(db: Session, user_id: int, room_id: str):
         role=UserRole.MEMBER
     )
     db.add(new_member)
-    db.commit()
+    await db.commit()
     return "Joined"
 
-def leave_room_service(db: Session, user_id: int, room_id: str):
-    membership = db.query(UserRoom).filter(
+async def leave_room_service(db: AsyncSession, user_id: int, room_id: str):
+    membership = await db.scalar(select(UserRoom).where(
         UserRoom.room_id == room_id,
         UserRoom.user_id == user_id,
         UserRoom.is_active == True,
-    ).first()
+    ).limit(1))
     if not membership:
         raise HTTPException(status_code=404, detail="Membership not found")
     membership.is_active = False
-    db.commit()
+    await db.commit()
     return "Left room"
 
-def delete_room_service(db: Session, user_id: int, room_id: str):
-    room = db.query(Room).filter(Room.id == room_id, Room.is_active == True).first()
+async def delete_room_service(db: AsyncSession, user_id: int, room_id: str):
+    room = await db.scalar(select(Room).where(Room.id == room_id, Room.is_active == True))
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
     if room.owner_id != user_id:
         raise HTTPException(status_code=403, detail="Only the room owner can delete this room.")
     room.is_active = False
-    memberships = db.query(UserRoom).filter(UserRoom.room_id == room_id).all()
+    memberships = await db.scalars(select(UserRoom).where(UserRoom.room_id == room_id))
     for m in memberships:
         m.is_active = False
-    db.commit()
+    await db.commit()
     return "Room deleted successfully."
 
-def remove_member_service(db: Session, owner_id: int, req):
-    room = db.query(Room).filter(Room.id == req.room_id, Room.is_active == True).first()
+async def remove_member_service(db: AsyncSession, owner_id: int, req):
+    room = await db.scalar(select(Room).where(Room.id == req.room_id, Room.is_active == True))
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
     if room.owner_id != owner_id:
         raise HTTPException(status_code=403, detail="Only the owner can remove a member.")
     if owner_id == req.user_id:
         raise HTTPException(status_code=403, detail="Owner cannot remove themselves.")
-    membership = db.query(UserRoom).filter(
+    membership = await db.scalar(select(UserRoom).where(
         UserRoom.room_id == req.room_id,
         UserRoom.user_id == req.user_id,
         UserRoom.is_active == True
-    ).first()
+    ).limit(1))
     if not membership:
         raise HTTPException(status_code=404, detail="Membership not found")
     membership.is_active = False
-    db.commit()
+    await db.commit()
     return "Member removed successfully."
 
-def list_my_rooms_service(db: Session, user_id: int):
-    memberships = db.query(UserRoom).filter(
-        UserRoom.user_id == user_id, UserRoom.is_active == True
-    ).all()
+async def list_my_rooms_service(db: AsyncSession, user_id: int):
+    # One query for memberships and their rooms instead of one per room
+    rows = await db.execute(
+        select(UserRoom, Room)
+        .join(Room, Room.id == UserRoom.room_id)
+        .where(UserRoom.user_id == user_id, UserRoom.is_active == True)
+        .order_by(UserRoom.id)
+    )
     result = []
-    for m in memberships:
-        room = db.query(Room).filter(Room.id == m.room_id).first()
+    for m, room in rows:
         result.append({
             "room_id": room.id,
             "name": room.name,
             "role": m.role.value,
-            "owner_id": room.owner_id
+            "owner_id": room.owner_id,
+            # Last rendered preview (a data: URI) or None; brought up to date in the background
+            "thumbnail": thumbnail_service.thumbnail(room.id)
         })
+    thumbnail_service.request_refresh(entry["room_id"] for entry in result)
     return result
 
-def get_room_details_service(db: Session, room_id: str):
-    room = db.query(Room).filter(Room.id == room_id).first()
+async def get_room_details_service(db: AsyncSession, room_id: str):
+    room = await db.get(Room, room_id)
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
-    members = db.query(UserRoom).filter(UserRoom.room_id == room_id, UserRoom.is_active == True).all()
+    members = await db.scalars(select(UserRoom).where(UserRoom.room_id == room_id, UserRoom.is_active == True))
     return {
         "room_id": room.id,
         "name": room.name,
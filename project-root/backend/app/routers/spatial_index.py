@@ -0,0 +1,158 @@
+"""
+Spatial index over each room's strokes, for viewport queries and tiles.
+
+StrokeIndex files every stroke's bounding box under the CANVAS_INDEX_CELL
+sized grid squares it touches, so a query only looks at strokes near the
+box asked for. Boxes that would touch more than CANVAS_INDEX_MAX_CELLS
+squares (a canvas-sized rectangle, say) are kept in one list that every
+query checks instead.
+
+room_indexes keeps the index of each recently used room's latest state.
+When a room's state changes, the strokes that were removed or added are
+diffed out; the index is updated for just those, and listeners (the tile
+cache) are told which region of the canvas changed.
+"""
+import os
+import json
+import math
+from collections import OrderedDict
+from itertools import product
+from typing import Callable, List
+import numpy as np
+from .drawings_service import diff_strokes
+from .tile_renderer import stroke_bounds, in_region
+
+CANVAS_INDEX_CELL = int(os.getenv("CANVAS_INDEX_CELL", "256"))
+CANVAS_INDEX_ROOMS = int(os.getenv("CANVAS_INDEX_ROOMS", os.getenv("CANVAS_TILE_ROOMS", "64")))  # Rooms indexed at once
+# Strokes whose box spans more grid squares than this go in the shared list
+CANVAS_INDEX_MAX_CELLS = 64
+
+
+class StrokeIndex:
+    """A room state's strokes and a grid of their bounding boxes"""
+
+    def __init__(self, strokes: List[dict], etag: str = None, cell: int = CANVAS_INDEX_CELL):
+        self.etag = etag
+        self.strokes = strokes
+        self.cell = cell
+        self.bounds = np.empty((0, 4))
+        self.cells = {}   # (cx, cy): indexes of the strokes touching that square, ascending
+        self.large = np.empty(0, dtype=np.int64)  # Strokes too big to file by square, ascending
+        self._add(stroke_bounds(strokes))
+
+    def _add(self, bounds: np.ndarray):
+        start = len(self.bounds)
+        self.bounds = np.concatenate([self.bounds, bounds])
+        with np.errstate(invalid="ignore"):
+            spans = np.floor(bounds / self.cell)
+        added = {}
+        for offset, (cx0, cy0, cx1, cy1) in enumerate(spans.tolist()):
+            if cx0 != cx0:
+                continue  # NaN: draws nothing
+            index = start + offset
+            if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > CANVAS_INDEX_MAX_CELLS:
+                self.large = np.append(self.large, index)
+                continue
+            for key in product(range(int(cx0), int(cx1) + 1), range(int(cy0), int(cy1) + 1)):
+                added.setdefault(key, []).append(index)
+        for key, ids in added.items():
+            ids = np.array(ids, dtype=np.int64)
+            self.cells[key] = np.concatenate([self.cells[key], ids]) if key in self.cells else ids
+
+    def updated(self, strokes: List[dict], etag: str, keep: int) -> "StrokeIndex":
+        """Index of a newer state whose first `keep` strokes are this one's.
+        Returns a new index; this one is left as it was for readers still using it."""
+        index = StrokeIndex.__new__(StrokeIndex)
+        index.etag, index.strokes, index.cell = etag, strokes, self.cell
+        index.bounds = self.bounds[:keep]
+        index.cells = {}
+        for key, ids in self.cells.items():
+            cut = np.searchsorted(ids, keep)
+            if cut:
+                index.cells[key] = ids[:cut]
+        index.large = self.large[:np.searchsorted(self.large, keep)]
+        index._add(stroke_bounds(strokes[keep:]))
+        return index
+
+    def query(self, x0: float, y0: float, x1: float, y1: float) -> np.ndarray:
+        """Indexes of the strokes whose box overlaps [x0, x1) x [y0, y1), in
+        drawing order (later strokes are drawn on top)"""
+        cx0, cy0 = math.floor(x0 / self.cell), math.floor(y0 / self.cell)
+        cx1, cy1 = math.floor(x1 / self.cell), math.floor(y1 / self.cell)
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) >= len(self.cells):
+            # Box covers most of the canvas: walking the filled squares is cheaper
+            found = [ids for (cx, cy), ids in self.cells.items() if cx0 <= cx <= cx1 and cy0 <= cy <= cy1]
+        else:
+            found = [self.cells[key] for key in product(range(cx0, cx1 + 1), range(cy0, cy1 + 1)) if key in self.cells]
+        candidates = np.sort(np.concatenate([self.large, *found]))
+        # A stroke filed under several squares comes up once per square
+        candidates = candidates[np.concatenate([[True], candidates[1:] != candidates[:-1]])] if len(candidates) else candidates
+        return candidates[in_region(self.bounds[candidates], x0, y0, x1, y1)]
+
+    def extent(self):
+        """[min_x, min_y, max_x, max_y] over all strokes, or None when empty"""
+        if not len(self.bounds) or np.isnan(self.bounds[:, 0]).all():
+            return None
+        return [float(v) for v in (*np.nanmin(self.bounds[:, :2], axis=0), *np.nanmax(self.bounds[:, 2:], axis=0))]
+
+
+class RoomIndexes:
+    def __init__(self, size: int = CANVAS_INDEX_ROOMS):
+        self.size = size
+        self._rooms: "OrderedDict[str, StrokeIndex]" = OrderedDict()
+        # Called with (room_id, region) when a room's strokes change; region is
+        # [min_x, min_y, max_x, max_y] of what changed, or None for anything
+        self.listeners: List[Callable] = []
+        self.stats = {"built": 0, "updated": 0}
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def current(self, room_id: str):
+        """The room's index as last synced, or None"""
+        return self._rooms.get(room_id)
+
+    def sync(self, room_id: str, snapshot) -> StrokeIndex:
+        """Bring a room's index up to its current snapshot"""
+        etag = snapshot.etag if snapshot is not None else None
+        index = self._rooms.get(room_id)
+        if index is not None and index.etag == etag:
+            self._rooms.move_to_end(room_id)
+            return index
+
+        try:
+            strokes = json.loads(snapshot.state_json) if snapshot is not None else []
+        except ValueError:
+            strokes = []
+        if not isinstance(strokes, list):
+            strokes = []
+        if index is None:
+            current = StrokeIndex(strokes, etag)
+            self.stats["built"] += 1
+            self._changed(room_id, None)
+        else:
+            delta = diff_strokes(index.strokes, strokes)
+            removed = np.array(delta["remove"], dtype=np.int64)
+            added = np.array([i for i, _ in delta["add"]], dtype=np.int64)
+            # Strokes after the first change may have moved, so they're refiled
+            keep = min([len(strokes), *removed[:1], *added[:1]])
+            current = index.updated(strokes, etag, int(keep))
+            self.stats["updated"] += 1
+            changed = np.concatenate([index.bounds[removed], current.bounds[added]])
+            changed = changed[~np.isnan(changed[:, 0])]
+            if len(changed):
+                self._changed(room_id, (*changed[:, :2].min(axis=0), *changed[:, 2:].max(axis=0)))
+
+        self._rooms[room_id] = current
+        self._rooms.move_to_end(room_id)
+        while len(self._rooms) > self.size:
+            old_room, _ = self._rooms.popitem(last=False)
+            self._changed(old_room, None)
+        return current
+
+    def _changed(self, room_id: str, region):
+        for listener in self.listeners:
+            listener(room_id, region)
+
+
+room_indexes = RoomIndexes()
@@ -0,0 +1,84 @@
+"""
+In-process LRU caches for canvas loads.
+
+    state_cache  recently loaded snapshot rows, by ("room", room_id) for the
+                 latest state and ("snapshot", id) for a version. The snapshot
+                 services fill it and drop a room's entries whenever they
+                 write to that room, so a hot room is served without the DB.
+    body_cache   encoded response bodies by ETag. The ETag names one exact
+                 representation, so these never go stale.
+
+Writes made by another worker aren't seen here, so a room's latest state
+is only cached when no other worker can write to it (see
+backplane.shared_workers). Saved versions don't change once written, but an
+autosave row is rewritten in place by every autosave until a new version
+starts, so autosaves by id are only cached under the same condition. Every
+entry also expires after CANVAS_CACHE_TTL seconds.
+"""
+import os
+import time
+from collections import OrderedDict
+from .backplane import shared_workers
+
+CANVAS_CACHE_SIZE = int(os.getenv("CANVAS_CACHE_SIZE", "256"))
+CANVAS_CACHE_TTL = float(os.getenv("CANVAS_CACHE_TTL", "30"))
+
+
+class LRUCache:
+    def __init__(self, size: int = CANVAS_CACHE_SIZE, ttl: float = None):
+        self.size = size
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()  # key: (value, stored at)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or (self.ttl is not None and time.monotonic() - entry[1] > self.ttl):
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self._entries[key] = (value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def discard_where(self, predicate):
+        for key in [key for key, (value, _) in self._entries.items() if predicate(key, value)]:
+            del self._entries[key]
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+class StateCache(LRUCache):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Bumped on every write, so a load that raced a write doesn't put
+        # what it read back into the cache
+        self.version = 0
+
+    def put_snapshot(self, key, snapshot, version: int):
+        if (key[0] == "room" or (snapshot is not None and snapshot.autosave)) and shared_workers():
+            return  # Another worker may rewrite it without invalidating here
+        if snapshot is not None and self.version == version:
+            self.put(key, snapshot)
+
+    def invalidate_room(self, room_id: str):
+        """Forget everything loaded for a room; called after every write to it"""
+        self.version += 1
+        self.discard_where(lambda key, snapshot: snapshot.room_id == room_id)
+
+
+state_cache = StateCache(ttl=CANVAS_CACHE_TTL)
+body_cache = LRUCache()
@@ -0,0 +1,324 @@
+"""
+Streaming canvas state in and out, for canvases too big to hold in memory.
+
+Downloads read a keyframe's stored bytes from the database a slice at a time
+(substr on the column), decompress them incrementally and pass them on. A
+delta version streams its keyframe's strokes, leaving out the ones its chain
+removed and splicing in the ones it added, which are all that differ.
+
+Uploads are parsed one stroke at a time as the body arrives. Each stroke is
+compacted, simplified, serialized and fed to the compressor, so only the compressed
+state is ever held whole. History is compacted like other saves: a clear or
+undo starts the state over as it arrives, and when erasers were seen a second
+pass over the compressed state leaves out the strokes they cover.
+"""
+import os
+import json
+import zlib
+import codecs
+import hashlib
+from datetime import datetime
+from typing import AsyncIterator, List
+from sqlalchemy import select, func
+from sqlalchemy.orm import defer
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import HTTPException
+from app.models.db import CanvasSnapshot, AsyncSessionLocal, SNAPSHOT_CODEC, SNAPSHOT_GZIP_LEVEL
+from .stroke_codec import StrokeCompactor, expand_strokes
+from .stroke_simplify import simplify_strokes
+from .history_compaction import HISTORY_TYPES, CoveredStrokes, fold_history
+from .state_cache import state_cache
+from .drawings_service import apply_delta
+
+# Bytes read from the database, and roughly sent, per step
+CANVAS_STREAM_CHUNK_BYTES = int(os.getenv("CANVAS_STREAM_CHUNK_BYTES", "65536"))
+# Largest single stroke an upload may contain
+CANVAS_STREAM_MAX_ITEM_BYTES = int(os.getenv("CANVAS_STREAM_MAX_ITEM_BYTES", str(4 * 1024 * 1024)))
+
+
+class JSONArrayReader:
+    """Incremental parser for a JSON array: feed() text, get back finished items"""
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._started = False
+        self._done = False
+
+    def feed(self, text: str) -> List:
+        self._buffer += text
+        items = []
+        position = 0
+        buffer = self._buffer
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position >= len(buffer) or self._done:
+                break
+            if not self._started:
+                if buffer[position] != "[":
+                    raise ValueError("Canvas state must be a JSON array")
+                self._started = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                self._done = True
+                position += 1
+                continue
+            try:
+                item, end = self._decoder.raw_decode(buffer, position)
+            except ValueError:
+                break  # Incomplete; wait for more text
+            if end >= len(buffer):
+                break  # A number could still go on; wait for the next character
+            items.append(item)
+            position = end
+        self._buffer = buffer[position:]
+        if len(self._buffer) > CANVAS_STREAM_MAX_ITEM_BYTES:
+            raise ValueError("Stroke too large")
+        return items
+
+    def close(self) -> List:
+        items = self.feed(" ")
+        if not self._done or self._buffer.strip():
+            raise ValueError("Canvas state is not a complete JSON array")
+        return items
+
+
+class _StateWriter:
+    """Serializes strokes into stored form as they come: "[a,b,...]", encoded
+    like encode_state, plus the state's etag"""
+
+    def __init__(self):
+        self._hash = hashlib.blake2b(digest_size=16)
+        self._compressor = zlib.compressobj(SNAPSHOT_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS) \
+            if SNAPSHOT_CODEC == "gzip" else None
+        self._parts = []
+        self._first = True
+        self._write("[")
+
+    def _write(self, text: str):
+        data = text.encode()
+        self._hash.update(data)
+        self._parts.append(self._compressor.compress(data) if self._compressor else text)
+
+    def add(self, strokes: List):
+        for stroke in strokes:
+            self._write(("" if self._first else ",") + json.dumps(stroke, separators=(",", ":")))
+            self._first = False
+
+    def close(self):
+        """Returns (codec, state_data, state_text, etag)"""
+        self._write("]")
+        if self._compressor:
+            self._parts.append(self._compressor.flush())
+            return "gzip", b"".join(self._parts), None, self._hash.hexdigest()
+        return None, None, "".join(self._parts), self._hash.hexdigest()
+
+
+async def save_canvas_stream_service(db: AsyncSession, room_id: str, chunks: AsyncIterator[bytes]):
+    """Store a streamed strokes array as the room's latest autosave (a keyframe)"""
+    reader = JSONArrayReader()
+    compactor = StrokeCompactor()
+    writer, covered = _StateWriter(), CoveredStrokes()
+    text = codecs.getincrementaldecoder("utf-8")()
+
+    def add(items):
+        nonlocal writer, covered
+        for item in simplify_strokes(items):
+            if isinstance(item, dict) and item.get("type") in HISTORY_TYPES:
+                # Replaces everything before it, as fold_history does
+                writer, covered = _StateWriter(), CoveredStrokes()
+                kept = fold_history([item])
+            else:
+                kept = [item]
+            writer.add(kept)
+            for stroke in kept:
+                covered.note(stroke)
+
+    try:
+        async for chunk in chunks:
+            for item in reader.feed(text.decode(chunk)):
+                add(compactor.add(item))
+        for item in reader.feed(text.decode(b"", final=True)) + reader.close():
+            add(compactor.add(item))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    add(compactor.close())
+
+    stored = writer.close()
+    if covered.start():
+        stored = _without_covered(*stored, covered)
+    codec, data, state_text, etag = stored
+    snapshot = CanvasSnapshot(
+        room_id=room_id, created_at=datetime.now(), autosave=True, kind="key", depth=0,
+        codec=codec, state_data=data, state_text=state_text, etag=etag
+    )
+    db.add(snapshot)
+    await db.commit()
+    state_cache.invalidate_room(room_id)
+    return snapshot
+
+
+def _without_covered(codec, data, state_text, etag, covered: CoveredStrokes):
+    """A _StateWriter's output written again without the strokes covered finds hidden"""
+    reader = JSONArrayReader()
+    writer = _StateWriter()
+    for piece in _written_text(codec, data, state_text):
+        writer.add([stroke for stroke in reader.feed(piece) if not covered.hidden(stroke)])
+    writer.add([stroke for stroke in reader.close() if not covered.hidden(stroke)])
+    return writer.close()
+
+
+def _written_text(codec, data, state_text):
+    """Text of a _StateWriter's output, decompressed a slice at a time"""
+    step = CANVAS_STREAM_CHUNK_BYTES
+    if codec != "gzip":
+        for i in range(0, len(state_text), step):
+            yield state_text[i:i + step]
+        return
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    text = codecs.getincrementaldecoder("utf-8")()
+    for i in range(0, len(data), step):
+        yield text.decode(decompressor.decompress(data[i:i + step]))
+    yield text.decode(decompressor.flush(), final=True)
+
+
+async def snapshot_stream_plan(db: AsyncSession, snapshot_id: int):
+    """What streaming a version takes, without loading any full state.
+
+    Returns (snapshot, keyframe, pieces, rest): the version's state is
+    `pieces` in order, where an int is the keyframe's stroke at that index and
+    a 1-tuple holds a stroke the chain added, followed by the keyframe's
+    strokes from index `rest` on (none when rest is None). A keyframe itself
+    is ([], 0).
+    """
+    without_state = (defer(CanvasSnapshot.state_data), defer(CanvasSnapshot.state_text))
+    snapshot = await db.scalar(select(CanvasSnapshot).options(*without_state).where(CanvasSnapshot.id == snapshot_id))
+    if not snapshot:
+        raise HTTPException(status_code=404, detail="Snapshot not found.")
+    if snapshot.is_keyframe:
+        return snapshot, snapshot, [], 0
+
+    # Deltas only hold what changed, so the chain's payloads are small
+    chain = await db.scalars(select(CanvasSnapshot).where(
+        CanvasSnapshot.key_id == snapshot.key_id, CanvasSnapshot.kind == "delta"
+    ))
+    by_id = {row.id: row for row in chain}
+    path = []
+    current = snapshot.id
+    while current in by_id:
+        path.append(by_id[current])
+        current = by_id[current].parent_id
+    keyframe = await db.scalar(select(CanvasSnapshot).options(*without_state).where(CanvasSnapshot.id == current))
+
+    pieces, rest = [], 0
+    for row in reversed(path):
+        pieces, rest = _apply_planned(pieces, rest, json.loads(row.payload))
+    return snapshot, keyframe, pieces, rest
+
+
+def _apply_planned(pieces: list, rest, delta: dict):
+    """apply_delta on a plan. Keyframe strokes past `pieces` are spelled out as
+    indexes only as far as the delta reaches."""
+    if "keep" in delta:
+        reach = delta["keep"]
+        added = [(stroke,) for stroke in delta["add"]]
+    else:
+        added = [[index, (stroke,)] for index, stroke in delta["add"]]
+        removed = set(delta["remove"])
+        reach = max(removed) + 1 if removed else 0
+        if added:
+            # Old strokes up to the last one kept ahead of the last addition
+            position = kept = 0
+            while kept < added[-1][0] - (len(added) - 1):
+                kept += position not in removed
+                position += 1
+            reach = max(reach, position)
+    if rest is not None and reach > len(pieces):
+        extra = reach - len(pieces)
+        pieces = pieces + list(range(rest, rest + extra))
+        rest += extra
+    return apply_delta(pieces, {**delta, "add": added}), None if "keep" in delta else rest
+
+
+async def _stored_text(db: AsyncSession, keyframe: CanvasSnapshot) -> AsyncIterator[str]:
+    """A keyframe's state text, read and decoded one slice at a time"""
+    gzipped = keyframe.codec == "gzip"
+    column = CanvasSnapshot.state_data if gzipped else CanvasSnapshot.state_text
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    text = codecs.getincrementaldecoder("utf-8")()
+    offset = 1
+    while True:
+        piece = await db.scalar(
+            select(func.substr(column, offset, CANVAS_STREAM_CHUNK_BYTES)).where(CanvasSnapshot.id == keyframe.id)
+        )
+        if not piece:
+            break
+        offset += len(piece)
+        yield text.decode(decompressor.decompress(piece)) if gzipped else piece
+    if gzipped:
+        yield text.decode(decompressor.flush(), final=True)
+
+
+async def stream_snapshot(keyframe: CanvasSnapshot, pieces: list, rest, strokes: str) -> AsyncIterator[bytes]:
+    """Body of a streamed download, from a snapshot_stream_plan, chunk by chunk.
+
+    Runs after the handler has returned, so it opens its own session.
+    """
+    async with AsyncSessionLocal() as db:
+        if not pieces and rest == 0 and strokes == "compact":
+            # Stored as-is; nothing to parse
+            async for text in _stored_text(db, keyframe):
+                if text:
+                    yield text.encode()
+            return
+
+        out = ["["]
+        size = 1
+        first = True
+
+        def take(items):
+            nonlocal size, first
+            for item in expand_strokes(items) if strokes != "compact" else items:
+                piece = json.dumps(item) if first else "," + json.dumps(item)
+                out.append(piece)
+                size += len(piece)
+                first = False
+
+        # Keyframe indexes in a plan only go up, so one pass over it serves them all
+        stored = _stored_strokes(db, keyframe)
+        wanted = iter(pieces)
+        piece = next(wanted, None)
+        while piece is not None:
+            if isinstance(piece, tuple):
+                take(piece)
+            else:
+                async for index, item in stored:
+                    if index == piece:
+                        take([item])
+                        break
+            piece = next(wanted, None)
+            if size >= CANVAS_STREAM_CHUNK_BYTES:
+                yield "".join(out).encode()
+                out, size = [], 0
+        if rest is not None:
+            async for index, item in stored:
+                if index >= rest:
+                    take([item])
+                if size >= CANVAS_STREAM_CHUNK_BYTES:
+                    yield "".join(out).encode()
+                    out, size = [], 0
+        await stored.aclose()
+        out.append("]")
+        yield "".join(out).encode()
+
+
+async def _stored_strokes(db: AsyncSession, keyframe: CanvasSnapshot) -> AsyncIterator[tuple]:
+    """(index, stroke) for each of a keyframe's strokes, parsed as they're read"""
+    reader = JSONArrayReader()
+    index = 0
+    async for text in _stored_text(db, keyframe):
+        for item in reader.feed(text):
+            yield index, item
+            index += 1
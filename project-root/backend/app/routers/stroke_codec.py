@@ -0,0 +1,159 @@
+"""
+Compact encoding for freehand strokes.
+
+Legacy clients describe a brush stroke as many separate segments:
+
+    {"type": "brush", "fromX": 10, "fromY": 10, "toX": 12, "toY": 11, "color": "#555", "thickness": 4}
+
+The compact form opens the stroke once with its style and start point and
+then lists integer deltas, one (dx, dy) pair per point:
+
+    {"type": "stroke", "tool": "brush", "color": "#555", "thickness": 4, "x": 10, "y": 10, "d": [2, 1, ...]}
+
+This is what canvas state is stored as, after stroke_simplify has dropped
+the points that don't visibly change a stroke. expand_strokes turns it back
+into legacy segments for clients that only understand those.
+"""
+import json
+from typing import List, Optional
+from .stroke_simplify import simplify_strokes
+
+# Segment types that can be chained into a compact stroke
+FREEHAND_TYPES = {"brush", "eraser", "draw"}
+
+# Extra fields a segment may carry that have to match to stay in one stroke
+_CARRIED_FIELDS = ("sender", "sender_name")
+
+
+def _point(value) -> int:
+    return int(round(value))
+
+
+def _segment_key(segment: dict) -> tuple:
+    return (segment.get("type"), segment.get("color"), segment.get("thickness")) + tuple(
+        segment.get(field) for field in _CARRIED_FIELDS
+    )
+
+
+class StrokeCompactor:
+    """Chain consecutive freehand segments into compact strokes.
+
+    Segments join the current stroke when they share tool, style and sender
+    and start where the previous one ended. Everything else, including
+    strokes that are already compact, passes through in order.
+
+    Entries go in one at a time; add() returns the ones that are final and
+    close() the rest, so a state never has to be held whole.
+    """
+
+    def __init__(self):
+        self._current = None
+        self._last_key = None
+        self._last_end = None
+
+    def add(self, segment) -> List[dict]:
+        done = []
+        if not isinstance(segment, dict) or segment.get("type") not in FREEHAND_TYPES:
+            return self.close() + [segment]
+        try:
+            from_x, from_y = _point(segment["fromX"]), _point(segment["fromY"])
+            to_x, to_y = _point(segment["toX"]), _point(segment["toY"])
+        except (KeyError, TypeError, ValueError):
+            return self.close() + [segment]
+
+        key = _segment_key(segment)
+        if self._current is not None and key == self._last_key and (from_x, from_y) == self._last_end:
+            self._current["d"].extend((to_x - self._last_end[0], to_y - self._last_end[1]))
+        else:
+            done = self.close()
+            self._current = {
+                "type": "stroke",
+                "tool": segment["type"],
+                "color": segment.get("color"),
+                "thickness": segment.get("thickness"),
+                "x": from_x,
+                "y": from_y,
+                "d": [to_x - from_x, to_y - from_y]
+            }
+            for field in _CARRIED_FIELDS:
+                if field in segment:
+                    self._current[field] = segment[field]
+        self._last_key = key
+        self._last_end = (to_x, to_y)
+        return done
+
+    def close(self) -> List[dict]:
+        current, self._current = self._current, None
+        return [current] if current is not None else []
+
+
+def compact_strokes(strokes: List[dict]) -> List[dict]:
+    """Chain consecutive freehand segments into compact strokes (see StrokeCompactor)"""
+    compactor = StrokeCompactor()
+    result = []
+    for segment in strokes:
+        result.extend(compactor.add(segment))
+    return result + compactor.close()
+
+
+def expand_points(stroke: dict, deltas: list) -> List[dict]:
+    """Turn a run of (dx, dy) deltas into legacy segments.
+
+    Starts from stroke["x"], stroke["y"] and leaves them at the last point,
+    so this can be called repeatedly as a live stroke grows.
+    """
+    segments = []
+    x, y = stroke["x"], stroke["y"]
+    for i in range(0, len(deltas) - 1, 2):
+        to_x, to_y = x + int(deltas[i]), y + int(deltas[i + 1])
+        segment = {
+            "type": stroke["tool"],
+            "fromX": x,
+            "fromY": y,
+            "toX": to_x,
+            "toY": to_y,
+            "color": stroke.get("color"),
+            "thickness": stroke.get("thickness")
+        }
+        for field in _CARRIED_FIELDS:
+            if field in stroke:
+                segment[field] = stroke[field]
+        segments.append(segment)
+        x, y = to_x, to_y
+    stroke["x"], stroke["y"] = x, y
+    return segments
+
+
+def expand_strokes(strokes: List[dict]) -> List[dict]:
+    """Turn compact strokes back into legacy segments; other entries pass through"""
+    result = []
+    for stroke in strokes:
+        if isinstance(stroke, dict) and stroke.get("type") == "stroke":
+            result.extend(expand_points(dict(stroke), stroke.get("d") or []))
+        else:
+            result.append(stroke)
+    return result
+
+
+def compact_state_json(state_json: str) -> str:
+    """Compact and simplify a serialized canvas state; anything that isn't a
+    list is kept as-is"""
+    strokes = _parse_state(state_json)
+    if strokes is None:
+        return state_json
+    return json.dumps(simplify_strokes(compact_strokes(strokes)), separators=(",", ":"))
+
+
+def expand_state_json(state_json: str) -> str:
+    strokes = _parse_state(state_json)
+    if strokes is None:
+        return state_json
+    return json.dumps(expand_strokes(strokes))
+
+
+def _parse_state(state_json: str) -> Optional[list]:
+    try:
+        strokes = json.loads(state_json)
+    except (TypeError, ValueError):
+        return None
+    return strokes if isinstance(strokes, list) else None
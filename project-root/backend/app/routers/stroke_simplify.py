@@ -0,0 +1,113 @@
+"""
+Simplification of freehand strokes before they are stored.
+
+A brush stroke arrives as one point per mouse event, most of them nearly in
+line with their neighbours. Ramer-Douglas-Peucker keeps a stroke's start
+and end, then recursively keeps the point furthest from the line between
+two kept points while it is more than CANVAS_SIMPLIFY_TOLERANCE pixels
+off. Every line drawn from the result is within the tolerance of the
+original path, so at sub-pixel tolerances nothing visibly changes.
+
+The recursion runs level by level: every open span of every stroke in a
+state is measured in one NumPy pass, so the Python loop only runs once per
+level rather than once per stroke.
+"""
+import os
+from typing import List, Optional
+import numpy as np
+
+# Pixels a simplified stroke may stray from the drawn one; 0 turns it off
+CANVAS_SIMPLIFY_TOLERANCE = float(os.getenv("CANVAS_SIMPLIFY_TOLERANCE", "0.75"))
+
+
+def simplify_mask(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """Which points of an (n, 2) polyline Ramer-Douglas-Peucker keeps"""
+    if len(points) == 0:
+        return np.zeros(0, dtype=bool)
+    return _spans_mask(points, np.array([0]), np.array([len(points) - 1]), tolerance)
+
+
+def _spans_mask(points: np.ndarray, starts: np.ndarray, ends: np.ndarray, tolerance: float) -> np.ndarray:
+    """RDP over several polylines stacked in one (n, 2) array, polyline i
+    running from points[starts[i]] to points[ends[i]]"""
+    keep = np.zeros(len(points), dtype=bool)
+    keep[starts] = True
+    keep[ends] = True
+    while len(starts):
+        inner = ends - starts - 1
+        open_spans = inner > 0
+        starts, ends, inner = starts[open_spans], ends[open_spans], inner[open_spans]
+        if not len(starts):
+            break
+        # Every interior point of every open span, tagged with its span
+        span = np.repeat(np.arange(len(starts)), inner)
+        offsets = np.cumsum(inner) - inner
+        index = starts[span] + 1 + np.arange(inner.sum()) - offsets[span]
+
+        # Distance from each point to its span's chord (a segment, not a line,
+        # so a stroke that doubles back keeps its turning point)
+        a, b = points[starts[span]], points[ends[span]]
+        chord = b - a
+        length = (chord ** 2).sum(axis=1)
+        along = np.divide(((points[index] - a) * chord).sum(axis=1), length,
+                          out=np.zeros(len(index)), where=length > 0)
+        nearest = a + np.clip(along, 0, 1)[:, None] * chord
+        distance = np.hypot(*(points[index] - nearest).T)
+
+        furthest = np.maximum.reduceat(distance, offsets)
+        split = furthest > tolerance
+        # First point in each span at its span's furthest distance
+        at_max = np.flatnonzero(distance == furthest[span])
+        _, first = np.unique(span[at_max], return_index=True)
+        pivot = index[at_max[first]][split]
+        keep[pivot] = True
+        starts, ends = np.concatenate([starts[split], pivot]), np.concatenate([pivot, ends[split]])
+    return keep
+
+
+def _stroke_points(stroke) -> Optional[np.ndarray]:
+    """A compact stroke's absolute points, or None if it has too few to drop any"""
+    if not isinstance(stroke, dict) or stroke.get("type") != "stroke":
+        return None
+    deltas = stroke.get("d")
+    if not isinstance(deltas, list) or len(deltas) < 4:
+        return None
+    try:
+        steps = np.asarray(deltas[: len(deltas) // 2 * 2], dtype=np.int64).reshape(-1, 2)
+        start = np.array([[int(stroke["x"]), int(stroke["y"])]], dtype=np.int64)
+    except (KeyError, TypeError, ValueError):
+        return None
+    return np.concatenate([start, start + np.cumsum(steps, axis=0)])
+
+
+def _simplified(stroke: dict, points: np.ndarray, keep: np.ndarray) -> dict:
+    if keep.all():
+        return stroke
+    return {**stroke, "d": np.diff(points[keep], axis=0).ravel().tolist()}
+
+
+def simplify_stroke(stroke: dict, tolerance: float = CANVAS_SIMPLIFY_TOLERANCE) -> dict:
+    """A compact stroke with the points RDP drops taken out of "d".
+    Returns the stroke itself when nothing is dropped."""
+    points = _stroke_points(stroke) if tolerance > 0 else None
+    if points is None:
+        return stroke
+    return _simplified(stroke, points, simplify_mask(points.astype(np.float64), tolerance))
+
+
+def simplify_strokes(strokes: List, tolerance: float = CANVAS_SIMPLIFY_TOLERANCE) -> List:
+    """Simplify every compact stroke in a list in one pass; other entries
+    pass through"""
+    if tolerance <= 0:
+        return strokes
+    found = [(i, points) for i, points in enumerate(map(_stroke_points, strokes)) if points is not None]
+    if not found:
+        return strokes
+    stacked = np.concatenate([points for _, points in found])
+    ends = np.cumsum([len(points) for _, points in found]) - 1
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    keep = _spans_mask(stacked.astype(np.float64), starts, ends, tolerance)
+    result = list(strokes)
+    for (i, points), start, end in zip(found, starts, ends):
+        result[i] = _simplified(strokes[i], points, keep[start:end + 1])
+    return result
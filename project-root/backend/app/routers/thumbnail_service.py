@@ -0,0 +1,121 @@
+"""
+Small preview images of each room's canvas for the room list.
+
+list_my_rooms returns the last thumbnail rendered for each room inline, as a
+data: URI, and asks for a refresh; it never waits for one. A refresh reads
+the etag of the room's latest state in the background, and loads and
+re-renders the state only if it changed since the last thumbnail
+(thumbnails are keyed by the etag, since autosaves rewrite the same
+snapshot row).
+
+A room is re-rendered at most once per THUMBNAIL_DEBOUNCE_SECONDS. A refresh
+asked for sooner is held until that much time has passed, and any further
+asks in between share it, so a room that autosaves every few seconds still
+costs one render per interval. A room with no saved state, or nothing
+drawn yet, is held the same way.
+"""
+import os
+import time
+import json
+import base64
+import asyncio
+from typing import Dict, Iterable
+from app.models.db import AsyncSessionLocal, state_etag
+from .state_cache import LRUCache
+from .save_buffer import save_buffer
+from .tile_renderer import render_region
+from .spatial_index import StrokeIndex
+from .tile_service import tile_service
+
+THUMBNAIL_WIDTH = int(os.getenv("THUMBNAIL_WIDTH", "240"))
+THUMBNAIL_HEIGHT = int(os.getenv("THUMBNAIL_HEIGHT", "140"))
+THUMBNAIL_DEBOUNCE_SECONDS = float(os.getenv("THUMBNAIL_DEBOUNCE_SECONDS", "60"))
+THUMBNAIL_CACHE_SIZE = int(os.getenv("THUMBNAIL_CACHE_SIZE", "1024"))  # Rooms whose thumbnail is kept
+# Canvas area a thumbnail always covers, matching the drawing page's canvas;
+# drawings that reach further out are shrunk to fit
+THUMBNAIL_CANVAS_WIDTH = 1200
+THUMBNAIL_CANVAS_HEIGHT = 700
+THUMBNAIL_BACKGROUND = "#ffffff"
+
+
+class ThumbnailService:
+    def __init__(self):
+        self.thumbnails = LRUCache(size=THUMBNAIL_CACHE_SIZE)  # room: (state etag, data URI or None, rendered at)
+        self._scheduled: Dict[str, asyncio.TimerHandle] = {}
+        self._running: Dict[str, asyncio.Task] = {}
+        self.stats = {"requested": 0, "rendered": 0, "unchanged": 0, "failed": 0}
+
+    def thumbnail(self, room_id: str):
+        """The room's last rendered thumbnail as a data: URI, or None"""
+        entry = self.thumbnails.get(room_id)
+        return entry[1] if entry is not None else None
+
+    # ==================== SCHEDULING ====================
+    def request_refresh(self, room_ids: Iterable[str]):
+        """Bring these rooms' thumbnails up to date in the background"""
+        for room_id in room_ids:
+            self.stats["requested"] += 1
+            if room_id in self._scheduled or room_id in self._running:
+                continue  # Already coming
+            entry = self.thumbnails.get(room_id)
+            wait = 0 if entry is None else entry[2] + THUMBNAIL_DEBOUNCE_SECONDS - time.monotonic()
+            if wait > 0:
+                loop = asyncio.get_running_loop()
+                self._scheduled[room_id] = loop.call_later(wait, self._start, room_id)
+            else:
+                self._start(room_id)
+
+    def _start(self, room_id: str):
+        self._scheduled.pop(room_id, None)
+        task = asyncio.ensure_future(self._refresh(room_id))
+        self._running[room_id] = task
+        task.add_done_callback(lambda _: self._running.pop(room_id, None))
+
+    def shutdown(self):
+        for handle in self._scheduled.values():
+            handle.cancel()
+        self._scheduled.clear()
+    # ====================================================
+
+    # ==================== RENDERING ====================
+    async def _refresh(self, room_id: str):
+        try:
+            async with AsyncSessionLocal() as db:
+                etag = await save_buffer.etag(db, room_id)
+                entry = self.thumbnails.get(room_id)
+                if entry is not None and entry[0] == etag:
+                    self.stats["unchanged"] += 1
+                    return
+                snapshot = await save_buffer.load(db, room_id) if etag is not None else None
+            png = None
+            if snapshot is not None:
+                # It may have moved on since the etag was read
+                etag = snapshot.etag or state_etag(snapshot.state_json)
+                png = await self._render(StrokeIndex(json.loads(snapshot.state_json), etag))
+            uri = "data:image/png;base64," + base64.b64encode(png).decode() if png else None
+            self.thumbnails.put(room_id, (etag, uri, time.monotonic()))
+            self.stats["rendered"] += 1
+        except Exception as e:
+            self.stats["failed"] += 1
+            print(f"Thumbnail refresh failed for room {room_id}: {e}")
+
+    async def _render(self, rendered) -> bytes:
+        """Fit the canvas area, grown to take in every stroke, into the thumbnail"""
+        extent = rendered.extent()
+        if extent is None:
+            return None
+        x0, y0 = min(0.0, extent[0]), min(0.0, extent[1])
+        x1, y1 = max(THUMBNAIL_CANVAS_WIDTH, extent[2]), max(THUMBNAIL_CANVAS_HEIGHT, extent[3])
+        scale = min(THUMBNAIL_WIDTH / (x1 - x0), THUMBNAIL_HEIGHT / (y1 - y0))
+        # Center the drawing when its shape doesn't match the thumbnail's
+        x0 -= (THUMBNAIL_WIDTH / scale - (x1 - x0)) / 2
+        y0 -= (THUMBNAIL_HEIGHT / scale - (y1 - y0)) / 2
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            tile_service.executor(), render_region, rendered.strokes, x0, y0,
+            THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT, scale, THUMBNAIL_BACKGROUND
+        )
+    # ===================================================
+
+
+thumbnail_service = ThumbnailService()
@@ -0,0 +1,136 @@
+"""
+Raster rendering of canvas state with Pillow and NumPy.
+
+Draws strokes the way DrawingCanvas.drawStroke does (segments, compact
+strokes, rectangles, ellipses, text) into an RGBA image of one region of the
+canvas. render_region runs in the tile service's process pool, so everything
+here is plain functions on plain data.
+"""
+import io
+from typing import List
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+# Rendered this many times larger, then scaled down, for smooth edges
+SUPERSAMPLE = 2
+
+SEGMENT_TYPES = {"draw", "brush", "eraser"}
+
+
+def stroke_points(stroke: dict):
+    """A stroke's polyline as an (n, 2) float array, or None if it has none"""
+    kind = stroke.get("type")
+    try:
+        if kind == "stroke":
+            d = np.asarray(stroke.get("d") or [], dtype=np.float64)
+            steps = d[: len(d) // 2 * 2].reshape(-1, 2)
+            start = np.array([[stroke["x"], stroke["y"]]], dtype=np.float64)
+            return np.concatenate([start, start + np.cumsum(steps, axis=0)])
+        if kind in SEGMENT_TYPES or kind in ("rectangle", "ellipse"):
+            return np.array([[stroke["fromX"], stroke["fromY"]], [stroke["toX"], stroke["toY"]]], dtype=np.float64)
+        if kind == "text":
+            size = float(stroke.get("fontSize") or 20)
+            x, y = float(stroke["x"]), float(stroke["y"])
+            # Rough text extent: baseline at y, ~0.6em per character
+            width = size * 0.6 * len(str(stroke.get("value", "")))
+            return np.array([[x, y - size], [x + width, y + size * 0.3]], dtype=np.float64)
+    except (KeyError, TypeError, ValueError):
+        return None
+    return None
+
+
+def stroke_bounds(strokes: List[dict]) -> np.ndarray:
+    """(n, 4) array of min_x, min_y, max_x, max_y per stroke, padded by line
+    width; strokes that draw nothing get an empty box that matches no region"""
+    bounds = np.full((len(strokes), 4), np.nan)
+    for index, stroke in enumerate(strokes):
+        if not isinstance(stroke, dict):
+            continue
+        points = stroke_points(stroke)
+        if points is None or not len(points):
+            continue
+        try:
+            pad = float(stroke.get("thickness") or 1) / 2 + 1
+        except (TypeError, ValueError):
+            pad = 1
+        bounds[index, :2] = points.min(axis=0) - pad
+        bounds[index, 2:] = points.max(axis=0) + pad
+    return bounds
+
+
+def in_region(bounds: np.ndarray, x0: float, y0: float, x1: float, y1: float) -> np.ndarray:
+    """Indexes of the strokes whose box overlaps [x0, x1) x [y0, y1), in order"""
+    with np.errstate(invalid="ignore"):
+        hit = (bounds[:, 2] >= x0) & (bounds[:, 0] < x1) & (bounds[:, 3] >= y0) & (bounds[:, 1] < y1)
+    return np.flatnonzero(hit)
+
+
+def _color(value):
+    try:
+        return ImageColor.getrgb(value) if value else (0, 0, 0)
+    except ValueError:
+        return None
+
+
+def _draw_stroke(draw: ImageDraw.ImageDraw, stroke: dict, origin: np.ndarray, scale: float,
+                 color=None, grow: int = 0):
+    points = stroke_points(stroke)
+    color = color if color is not None else _color(stroke.get("color"))
+    if points is None or color is None:
+        return
+    points = (points - origin) * scale
+    try:
+        width = max(1, int(round(float(stroke.get("thickness") or 1) * scale)) + grow)
+    except (TypeError, ValueError):
+        width = max(1, int(round(scale)) + grow)
+    kind = stroke["type"]
+    if kind == "stroke" or kind in SEGMENT_TYPES:
+        flat = points.ravel().tolist()
+        if len(points) == 1:
+            draw.ellipse([flat[0] - width / 2, flat[1] - width / 2, flat[0] + width / 2, flat[1] + width / 2], fill=color)
+        else:
+            draw.line(flat, fill=color, width=width, joint="curve")
+    elif kind in ("rectangle", "ellipse"):
+        (x0, y0), (x1, y1) = points.min(axis=0), points.max(axis=0)
+        if kind == "rectangle":
+            draw.rectangle([x0, y0, x1, y1], outline=color, width=width)
+        else:
+            draw.ellipse([x0, y0, x1, y1], outline=color, width=width)
+    elif kind == "text":
+        size = max(1, int(float(stroke.get("fontSize") or 20) * scale))
+        x, y = (np.array([stroke["x"], stroke["y"]], dtype=np.float64) - origin) * scale
+        draw.text((x, y), str(stroke.get("value", "")), fill=color,
+                  font=ImageFont.load_default(size), anchor="ls")
+
+
+def paint_mask(draw: ImageDraw.ImageDraw, strokes: List[dict], x0: float, y0: float, grow: int = 0):
+    """Paint the pixels the strokes cover onto an "L" image at 255, 1:1 from
+    (x0, y0), without anti-aliasing. Lines are drawn grow pixels wider; text
+    counts as its whole box."""
+    origin = np.array([x0, y0], dtype=np.float64)
+    for stroke in strokes:
+        if stroke.get("type") == "text":
+            points = stroke_points(stroke)
+            if points is not None:
+                draw.rectangle((points - origin).ravel().tolist(), fill=255)
+        else:
+            _draw_stroke(draw, stroke, origin, 1, color=255, grow=grow)
+
+
+def render_region(strokes: List[dict], x0: float, y0: float, width: int, height: int,
+                  scale: float, background=None) -> bytes:
+    """PNG of the canvas region starting at (x0, y0), scale output pixels per
+    canvas pixel, width x height output pixels. Transparent unless a
+    background color is given."""
+    factor = SUPERSAMPLE
+    fill = _color(background) if background else None
+    image = Image.new("RGBA", (width * factor, height * factor), fill + (255,) if fill else (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    origin = np.array([x0, y0], dtype=np.float64)
+    for stroke in strokes:
+        _draw_stroke(draw, stroke, origin, scale * factor)
+    if factor > 1:
+        image = image.resize((width, height), Image.LANCZOS)
+    out = io.BytesIO()
+    image.save(out, "PNG")
+    return out.getvalue()
@@ -0,0 +1,111 @@
+"""
+Cached PNG tiles of a room's canvas, rendered in a process pool.
+
+Tiles are CANVAS_TILE_SIZE pixels square. At level z one tile pixel covers
+2**z canvas pixels, so level 0 is full size and each level up halves it.
+
+Rooms' strokes come from the spatial index (see spatial_index). When it
+reports that a region of a room changed, only the cached tiles overlapping
+that region are dropped; every other cached tile is still correct and is
+served as-is.
+"""
+import os
+import asyncio
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict
+from .state_cache import LRUCache
+from .spatial_index import StrokeIndex, room_indexes
+from .tile_renderer import render_region
+
+CANVAS_TILE_SIZE = int(os.getenv("CANVAS_TILE_SIZE", "256"))
+CANVAS_TILE_LEVELS = int(os.getenv("CANVAS_TILE_LEVELS", "5"))           # Levels 0 .. LEVELS-1
+CANVAS_TILE_CACHE_SIZE = int(os.getenv("CANVAS_TILE_CACHE_SIZE", "2048"))  # Tiles kept, all rooms
+CANVAS_RENDER_WORKERS = int(os.getenv("CANVAS_RENDER_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+# Tiles further out than this from the origin aren't served
+CANVAS_TILE_MAX_INDEX = 4096
+
+
+class TileService:
+    def __init__(self):
+        self.tiles = LRUCache(size=CANVAS_TILE_CACHE_SIZE)  # (room, z, x, y): (png, etag)
+        self._rendering: Dict[tuple, asyncio.Future] = {}   # Renders in flight, shared by requests
+        self._pool = None
+        self.stats = {"rendered": 0, "invalidated": 0}
+        room_indexes.listeners.append(self._drop_tiles)
+
+    def executor(self) -> ProcessPoolExecutor:
+        """Process pool for rendering, shared with thumbnails; started on first use"""
+        if self._pool is None:
+            # spawn, not fork: the server process has threads (DB drivers, executors)
+            self._pool = ProcessPoolExecutor(
+                max_workers=CANVAS_RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    # ==================== INVALIDATION ====================
+    def _drop_tiles(self, room_id: str, region=None):
+        def touched(key, value):
+            room, z, x, y = key
+            if room != room_id:
+                return False
+            if region is None:
+                return True
+            span = CANVAS_TILE_SIZE * 2 ** z
+            return x * span <= region[2] and (x + 1) * span > region[0] and \
+                y * span <= region[3] and (y + 1) * span > region[1]
+        before = len(self.tiles)
+        self.tiles.discard_where(touched)
+        self.stats["invalidated"] += before - len(self.tiles)
+    # ======================================================
+
+    # ==================== RENDERING ====================
+    async def tile(self, room_id: str, snapshot, z: int, x: int, y: int):
+        """(png, etag) for one tile of the room's current state"""
+        rendered = room_indexes.sync(room_id, snapshot)
+        key = (room_id, z, x, y)
+        cached = self.tiles.get(key)
+        if cached is not None:
+            return cached
+
+        flight = key + (rendered.etag,)
+        future = self._rendering.get(flight)
+        if future is None:
+            future = asyncio.ensure_future(self._render(rendered, z, x, y))
+            self._rendering[flight] = future
+            future.add_done_callback(lambda _: self._rendering.pop(flight, None))
+        png = await asyncio.shield(future)
+        result = (png, f'"{hashlib.blake2b(png, digest_size=12).hexdigest()}"')
+        # Only cache if the room didn't change while this was rendering
+        if room_indexes.current(room_id) is rendered:
+            self.tiles.put(key, result)
+        return result
+
+    async def _render(self, rendered: StrokeIndex, z: int, x: int, y: int) -> bytes:
+        span = CANVAS_TILE_SIZE * 2 ** z
+        x0, y0 = x * span, y * span
+        strokes = [rendered.strokes[i] for i in rendered.query(x0, y0, x0 + span, y0 + span)]
+        loop = asyncio.get_running_loop()
+        png = await loop.run_in_executor(
+            self.executor(), render_region, strokes, x0, y0, CANVAS_TILE_SIZE, CANVAS_TILE_SIZE, 1 / 2 ** z
+        )
+        self.stats["rendered"] += 1
+        return png
+    # ===================================================
+
+    def info(self, room_id: str, snapshot) -> dict:
+        return {
+            "room_id": room_id,
+            "tile_size": CANVAS_TILE_SIZE,
+            "levels": CANVAS_TILE_LEVELS,
+            "bounds": room_indexes.sync(room_id, snapshot).extent()
+        }
+
+
+tile_service = TileService()
@@ -3,7 +3,9 @@ from dotenv import load_dotenv
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query
 from typing import Dict, List
 import json
+import asyncio
 from jose import JWTError, jwt
+from .backplane import backplane, WORKER_ID
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,8 +16,16 @@ router = APIRouter()
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 
+def signaling_channel(room_id: str) -> str:
+    return f"webrtc:{room_id}"
+
 class WebRTCSignalingManager:
-    """Manages WebRTC signaling connections for video/audio calls"""
+    """Manages WebRTC signaling connections for video/audio calls.
+    
+    Peers of one room may be connected to different workers. Messages for
+    peers that aren't local are published once on the backplane, and the
+    worker holding them delivers.
+    """
     
     def __init__(self):
         self.connections: Dict[str, Dict[int, WebSocket]] = {}  # room_id: {user_id: websocket}
@@ -23,11 +33,7 @@ class WebRTCSignalingManager:
     async def connect(self, room_id: str, user_id: int, websocket: WebSocket):
         """Add a new peer connection to the room"""
         await websocket.accept()
-        
-        if room_id not in self.connections:
-            self.connections[room_id] = {}
-        
-        self.connections[room_id][user_id] = websocket
+        self.add(room_id, user_id, websocket)
         
         # Notify other peers that a new user joined
         await self.broadcast_to_room(
@@ -39,6 +45,17 @@ class WebRTCSignalingManager:
             exclude_user=user_id
         )
     
+    def add(self, room_id: str, user_id, websocket: WebSocket):
+        """Register an accepted peer socket"""
+        if room_id not in self.connections:
+            self.connections[room_id] = {}
+            backplane.subscribe(
+                signaling_channel(room_id),
+                lambda data: self._on_backplane_message(room_id, data)
+            )
+        
+        self.connections[room_id][user_id] = websocket
+    
     def disconnect(self, room_id: str, user_id: int):
         """Remove peer from room"""
         if room_id in self.connections and user_id in self.connections[room_id]:
@@ -47,26 +64,58 @@ class WebRTCSignalingManager:
             # Clean up empty rooms
             if not self.connections[room_id]:
                 del self.connections[room_id]
+                backplane.unsubscribe(signaling_channel(room_id))
+    
+    def has_user(self, room_id: str, user_id) -> bool:
+        return user_id in self.connections.get(room_id, {})
     
     async def broadcast_to_room(self, room_id: str, message: dict, exclude_user: int = None):
         """Send message to all peers in room except excluded user"""
-        if room_id not in self.connections:
-            return
-        
-        for user_id, ws in self.connections[room_id].items():
-            if user_id != exclude_user:
-                try:
-                    await ws.send_json(message)
-                except Exception as e:
-                    print(f"Error sending to user {user_id}: {e}")
+        await self._deliver(room_id, message, exclude_user=exclude_user)
+        self._publish(room_id, message, exclude_user=exclude_user)
     
     async def send_to_user(self, room_id: str, target_user_id: int, message: dict):
         """Send message to specific user in room"""
-        if room_id in self.connections and target_user_id in self.connections[room_id]:
+        if self.has_user(room_id, target_user_id):
+            await self._deliver(room_id, message, target_user=target_user_id)
+        else:
+            self._publish(room_id, message, target_user=target_user_id)
+    
+    # ==================== BACKPLANE ====================
+    async def _deliver(self, room_id: str, message: dict, target_user=None, exclude_user=None):
+        """Send to local peers: one target, or everyone but exclude_user"""
+        for user_id, ws in list(self.connections.get(room_id, {}).items()):
+            if user_id == exclude_user or (target_user is not None and user_id != target_user):
+                continue
             try:
-                await self.connections[room_id][target_user_id].send_json(message)
+                await ws.send_json(message)
             except Exception as e:
-                print(f"Error sending to user {target_user_id}: {e}")
+                print(f"Error sending to user {user_id}: {e}")
+    
+    def _publish(self, room_id: str, message: dict, target_user=None, exclude_user=None):
+        if not backplane.distributed:
+            return
+        backplane.publish(signaling_channel(room_id), json.dumps({
+            "o": WORKER_ID,
+            "to": target_user,
+            "x": exclude_user,
+            "m": message
+        }).encode())
+    
+    def _on_backplane_message(self, room_id: str, data: bytes):
+        try:
+            envelope = json.loads(data)
+            origin, message = envelope["o"], envelope["m"]
+            target_user, exclude_user = envelope.get("to"), envelope.get("x")
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Bad signaling backplane message for room {room_id}: {e}")
+            return
+        if origin == WORKER_ID:
+            return
+        asyncio.create_task(self._deliver(
+            room_id, message, target_user=target_user, exclude_user=exclude_user
+        ))
+    # ===================================================
 
 # Global signaling manager instance
 signaling_manager = WebRTCSignalingManager()
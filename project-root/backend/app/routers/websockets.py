@@ -1,11 +1,23 @@
 import os
+import re
+import asyncio
+import itertools
+from collections import deque
 from dotenv import load_dotenv
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query
-from typing import List, Dict
+from fastapi.concurrency import run_in_threadpool
+from typing import List, Dict, Optional
 import json
 from jose import JWTError, jwt
 from datetime import datetime
 from sqlalchemy.orm import Session
+from app.models.db import AsyncSessionLocal
+from .save_buffer import save_buffer
+from . import ws_binary
+from .stroke_codec import FREEHAND_TYPES, expand_points
+from .history_compaction import HISTORY_TYPES, fold_history, drop_covered
+from .backplane import backplane, WORKER_ID
+from .webrtc import signaling_manager
 
 # Load environment variables from .env file
 load_dotenv()
@@ -16,44 +28,1049 @@ router = APIRouter()
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 
+# Outbound queue settings. Every socket gets its own bounded queue drained by a
+# writer task, so broadcasting never waits on a slow client.
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# What happens when a socket's queue hits the high-water mark:
+# "disconnect" closes the slow client, "drop" discards new messages and flags it
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "disconnect")
+
+# Fast relay: drawing and other pass-through messages are forwarded without a
+# json.loads/json.dumps round trip. Sender fields are spliced onto the raw text.
+WS_FAST_RELAY = os.getenv("WS_FAST_RELAY", "true").lower() == "true"
+# Live compact strokes: opened once, then extended with delta-encoded points
+STROKE_MESSAGE_TYPES = {"stroke_start", "stroke_points", "stroke_end"}
+# Strokes a single connection may have open at once
+MAX_OPEN_STROKES = 32
+# Undo and redo of the sender's own strokes, applied by the server
+UNDO_REQUEST_TYPES = {"undo", "redo"}
+# Message types the server has to parse and rebuild itself
+PARSED_MESSAGE_TYPES = {"chat", "caption"} | STROKE_MESSAGE_TYPES | UNDO_REQUEST_TYPES
+# Clients send JSON.stringify({type: ..., ...}), so "type" is the first key
+_MESSAGE_TYPE_PREFIX = re.compile(r'\s*\{\s*"type"\s*:\s*"([^"\\]*)"\s*[,}]')
+# Client-chosen key shared by every op of one stroke
+_STROKE_KEY = re.compile(r'"strokeId"\s*:\s*(\d+)\s*[,}]')
+
+# Cursor coalescing: the latest position per user is batched into one
+# "cursors" frame per room per tick. 0 relays every cursor message as-is.
+WS_CURSOR_HZ = float(os.getenv("WS_CURSOR_HZ", "25"))
+
+# Draw batching (opt-in): draw ops are collected per room for this many
+# milliseconds and sent as one "draw_batch" frame. 0 sends each op on its own.
+WS_DRAW_BATCH_MS = float(os.getenv("WS_DRAW_BATCH_MS", "0"))
+
+# Message types that add something to the canvas
+DRAW_MESSAGE_TYPES = {"draw", "brush", "eraser", "rectangle", "ellipse", "text"}
+# What the server broadcasts for an undo or redo; both go into the log
+STROKE_HISTORY_TYPES = {"remove_stroke", "restore_stroke"}
+# Message types that change the canvas and go into the room's operation log
+LOGGED_MESSAGE_TYPES = DRAW_MESSAGE_TYPES | HISTORY_TYPES
+# Client messages relayed to the room as they are, with the sender attached.
+# Anything else that isn't in PARSED_MESSAGE_TYPES is dropped, so a client
+# can't pass off what only the server sends (sync, remove_stroke, members...)
+RELAYED_CLIENT_TYPES = DRAW_MESSAGE_TYPES | HISTORY_TYPES | {"cursor", "video_call_started"}
+# A room's log is compacted (erased strokes dropped) in the background once it
+# has grown by this many ops since it last was. 0 never does.
+WS_LOG_COMPACT_OPS = int(os.getenv("WS_LOG_COMPACT_OPS", "1000"))
+
+# Undo/redo: how many of their own strokes a user can undo in a room, and the
+# most a room's stacks may hold across all users (one per undoable stroke plus
+# one per op kept for redo)
+WS_UNDO_DEPTH = int(os.getenv("WS_UNDO_DEPTH", "50"))
+WS_UNDO_ROOM_LIMIT = int(os.getenv("WS_UNDO_ROOM_LIMIT", "5000"))
+
+# Presence: joins and leaves in a room are gathered for this many milliseconds
+# and sent as one member_joined and one member_left frame. 0 sends each at once.
+WS_PRESENCE_COALESCE_MS = float(os.getenv("WS_PRESENCE_COALESCE_MS", "50"))
+# A join or leave passed between workers, to be sent in their next presence frames
+PRESENCE_EVENT_TYPE = "presence_event"
+
+# Logged ops are numbered per room; this many of the latest are kept so a
+# client that reconnects can get just what it missed instead of a full sync
+WS_REPLAY_BUFFER = int(os.getenv("WS_REPLAY_BUFFER", "1024"))
+
+# With a distributed backplane, a worker's first joiner in a room gets the log
+# from a worker already serving the room (it has ops not saved yet), waiting
+# this long for the answer before seeding from the saved canvas instead
+WS_LOG_PEER_TIMEOUT_MS = float(os.getenv("WS_LOG_PEER_TIMEOUT_MS", "1000"))
+# Passed between workers on the room channel: a request for a room's log and
+# the answer, each naming the one worker it is for
+LOG_REQUEST_TYPE = "log_request"
+LOG_STATE_TYPE = "log_state"
+
+def is_valid_json(text: str) -> bool:
+    try:
+        json.loads(text)
+        return True
+    except ValueError:
+        return False
+
+def room_channel(room: str) -> str:
+    return f"room:{room}"
+
+def presence_key(room: str) -> str:
+    return f"presence:{room}"
+
+class Frame:
+    """One outbound message, transcoded at most once per wire format.
+
+    Everyone gets the JSON text unless they negotiated the binary subprotocol
+    and the message has a binary form; that form is built lazily, the first
+    time a binary client needs it, and then shared by all of them. Compact
+    stroke messages also carry their legacy expansion: the draw segments sent
+    to clients that didn't ask for compact strokes. Ops that can be undone
+    carry their stroke id and the user who drew them.
+    """
+    __slots__ = ("text", "_binary", "_to_binary", "legacy", "draw_user_id", "sid", "owner")
+
+    def __init__(self, text: str, binary: bytes = None, to_binary=None, legacy: List[str] = None):
+        self.text = text
+        self._binary = binary
+        self._to_binary = to_binary
+        self.legacy = legacy
+        self.draw_user_id = None  # Set on relayed draw ops, whose binary form comes from the text
+        self.sid = None
+        self.owner = None
+
+    def binary(self):
+        if self._to_binary is not None:
+            self._binary = self._to_binary()
+            self._to_binary = None
+        return self._binary
+
+def frame_text(frame) -> str:
+    return frame if isinstance(frame, str) else frame.text
+
+def with_seq(frame, seq: int):
+    """Splice a sequence number onto a frame's JSON. Frames are changed in
+    place; their binary form has no room for it and stays as it is."""
+    suffix = ', "seq": %d}' % seq
+    if isinstance(frame, str):
+        return frame[:-1] + suffix
+    frame.text = frame.text[:-1] + suffix
+    if frame.legacy:
+        frame.legacy = [text[:-1] + suffix for text in frame.legacy]
+    return frame
+
+def draw_frame(text: str, user_id: int, sid: str = None, owner: str = None) -> Frame:
+    """Wrap a relayed draw op; the binary record is packed only if needed"""
+    def to_binary():
+        try:
+            return ws_binary.encode_draw(json.loads(text), user_id)
+        except ValueError:
+            return None
+    frame = Frame(text, to_binary=to_binary)
+    frame.draw_user_id = user_id
+    frame.sid, frame.owner = sid, owner
+    return frame
+
+_connection_numbers = itertools.count(1)
+_log_numbers = itertools.count(1)
+
+class StrokeIds:
+    """Hands out the stroke ids for one connection's ops.
+
+    An id is the connection's prefix plus the client's "strokeId" key, so
+    every segment of one freehand stroke shares it and the client can tell
+    which of its own strokes an id means. Ops without a key are a stroke each.
+    """
+
+    def __init__(self):
+        self.prefix = f"{WORKER_ID[:8]}.{next(_connection_numbers)}."
+        self._untagged = itertools.count(1)
+
+    def for_key(self, key=None) -> str:
+        if key is None:
+            return f"{self.prefix}n{next(self._untagged)}"
+        return f"{self.prefix}{key}"
+
+    def for_message(self, message_data: dict) -> str:
+        key = message_data.get("strokeId")
+        return self.for_key(key if type(key) is int and key >= 0 else None)
+
+    def for_raw(self, raw_data: str) -> str:
+        """for_message on a client message that hasn't been parsed"""
+        match = _STROKE_KEY.search(raw_data)
+        return self.for_key(match.group(1) if match else None)
+
+def batch_frame(text: str, frames: list) -> Frame:
+    """A batch has a binary form only if every op in it does"""
+    def to_binary():
+        records = [frame.binary() if isinstance(frame, Frame) else None for frame in frames]
+        if None in records:
+            return None
+        return b"".join(records)
+    return Frame(text, to_binary=to_binary)
+
+def stroke_frame(message_data: dict, open_strokes: dict, user_info: dict, stroke_ids: StrokeIds):
+    """Build the outbound frame for a compact stroke message, or None if invalid.
+
+    open_strokes holds this connection's strokes in progress (id: style, last
+    point and stroke id), which is what stroke_points deltas are expanded
+    against. Every compact stroke gets a fresh stroke id, since clients may
+    reuse theirs once a stroke has ended.
+    """
+    message_type = message_data.get("type")
+    stroke_id = message_data.get("id")
+    message_data["sender"] = user_info["email"]
+    message_data["sender_name"] = user_info["full_name"]
+
+    if message_type == "stroke_start":
+        if message_data.get("tool") not in FREEHAND_TYPES:
+            return None
+        if stroke_id not in open_strokes and len(open_strokes) >= MAX_OPEN_STROKES:
+            return None
+        try:
+            x, y = int(round(message_data["x"])), int(round(message_data["y"]))
+        except (KeyError, TypeError, ValueError):
+            return None
+        open_strokes[stroke_id] = {
+            "tool": message_data["tool"],
+            "color": message_data.get("color"),
+            "thickness": message_data.get("thickness"),
+            "x": x,
+            "y": y,
+            "sender": user_info["email"],
+            "sender_name": user_info["full_name"],
+            "sid": stroke_ids.for_key()
+        }
+        message_data["sid"] = open_strokes[stroke_id]["sid"]
+        return Frame(json.dumps(message_data), binary=b"", legacy=[])
+
+    if message_type == "stroke_points":
+        stroke = open_strokes.get(stroke_id)
+        deltas = message_data.get("d")
+        if stroke is None or not isinstance(deltas, list):
+            return None
+        try:
+            segments = expand_points(stroke, [int(delta) for delta in deltas])
+        except (TypeError, ValueError):
+            return None
+        records = [ws_binary.encode_draw(segment, user_info["user_id"]) for segment in segments]
+        message_data["sid"] = stroke["sid"]
+        for segment in segments:
+            segment["sid"] = stroke["sid"]
+        frame = Frame(
+            json.dumps(message_data),
+            binary=None if None in records else b"".join(records),
+            legacy=[json.dumps(segment) for segment in segments]
+        )
+        frame.sid, frame.owner = stroke["sid"], user_info["email"]
+        return frame
+
+    stroke = open_strokes.pop(stroke_id, None)
+    if stroke is not None:
+        message_data["sid"] = stroke["sid"]
+    return Frame(json.dumps(message_data), binary=b"", legacy=[])
+
+class RoomOpLog:
+    """Append-only log of a room's canvas operations, kept as encoded frames.
+
+    Relayed frames are stored exactly as they went out, so a late joiner's
+    sync costs a string join instead of a database round trip. A clear or
+    undo replaces everything before it, so the log restarts from what it
+    leaves on the canvas.
+
+    Every op that goes in is numbered, and the last WS_REPLAY_BUFFER of them
+    are kept as sent for clients resuming a dropped connection. Numbers only
+    mean something within one log's stream: it is local to the worker and
+    starts over when the room empties.
+
+    It also keeps each user's undo and redo stacks of stroke ids. Both are
+    changed only by what goes into the log (new strokes, remove_stroke and
+    restore_stroke), so every worker's copy of a room agrees. When the room's
+    stacks hold more than WS_UNDO_ROOM_LIMIT, whoever holds the most loses
+    their oldest entry.
+    """
+
+    def __init__(self, ops: List[str] = None):
+        self.ops: List[str] = list(ops or [])
+        self.sids: List[Optional[str]] = [None] * len(self.ops)  # Stroke id of each op; None can't be undone
+        self.validated = len(self.ops)  # ops[:validated] are known to be valid JSON
+        self.compacted = len(self.ops)  # Length of the log right after it was last compacted
+        self.edits = 0  # Bumped whenever ops already in the log change, not just grow
+        self.undo: Dict[str, List[str]] = {}    # user: stroke ids they can undo, oldest first
+        self.redo: Dict[str, List[tuple]] = {}  # user: (stroke id, frames) they can redo, oldest first
+        self.held: Dict[str, int] = {}          # user: entries they hold, redo entries counting each frame
+        self.stream = f"{WORKER_ID}.{next(_log_numbers)}"
+        self.seq = 0  # Number of the latest op
+        self.recent = deque(maxlen=WS_REPLAY_BUFFER)  # (seq, frame) of the latest ops
+
+    def sequence(self, frame):
+        """Number the next op and keep it for replay"""
+        self.seq += 1
+        frame = with_seq(frame, self.seq)
+        self.recent.append((self.seq, frame))
+        return frame
+
+    def missed(self, stream: str, seq: int, stroke_prefix: str):
+        """The ops after seq, as texts the way sync sends them, for a client
+        resuming this stream; None if the replay buffer no longer has them.
+        The client's own draw ops, those whose stroke id starts with the
+        prefix its dropped connection had, are left out: it never got them
+        from the server and already has them. Its other tabs' ops are not.
+
+        The legacy segments one compact stroke message expands into share
+        its seq, so they are replayed, or skipped, together."""
+        if stream != self.stream or not 0 <= seq <= self.seq or seq < self.seq - len(self.recent):
+            return None
+        texts = []
+        for op_seq, frame in self.recent:
+            if op_seq <= seq or (isinstance(frame, Frame) and frame.sid is not None
+                                 and frame.sid.startswith(stroke_prefix)):
+                continue
+            if isinstance(frame, Frame) and frame.legacy is not None:
+                texts.extend(frame.legacy)
+            else:
+                texts.append(frame_text(frame))
+        return [text for text in texts if is_valid_json(text)]
+
+    def append(self, frame: str, sid: str = None, owner: str = None):
+        match = _MESSAGE_TYPE_PREFIX.match(frame)
+        if match and match.group(1) in STROKE_HISTORY_TYPES:
+            self._apply_stroke_history(match.group(1), frame)
+            return
+        if match and match.group(1) in HISTORY_TYPES:
+            try:
+                strokes = fold_history([json.loads(frame)])
+            except ValueError:
+                strokes = None  # Malformed; sync_frame drops it
+            if strokes is not None:
+                self.ops = [json.dumps(stroke) for stroke in strokes]
+                self.sids = [None] * len(self.ops)
+                self.validated = self.compacted = len(self.ops)
+                self.undo, self.redo, self.held = {}, {}, {}
+                self.edits += 1
+                return
+        self.ops.append(frame)
+        self.sids.append(sid)
+        if sid is not None and owner is not None:
+            self._push_undo(owner, sid)
+            self._drop_redo(owner)  # A new stroke ends what could be redone
+
+    def export(self) -> dict:
+        """The ops and undo/redo stacks, for another worker's copy of the room"""
+        self.validate()
+        return {"ops": self.ops, "sids": self.sids, "undo": self.undo, "redo": self.redo, "held": self.held}
+
+    @classmethod
+    def imported(cls, state: dict) -> "RoomOpLog":
+        """A log carrying on from another worker's export, in a stream of its own"""
+        log = cls(state["ops"])
+        log.sids = list(state["sids"])
+        log.undo = state["undo"]
+        log.redo = {owner: [tuple(entry) for entry in stack] for owner, stack in state["redo"].items()}
+        log.held = state["held"]
+        return log
+
+    # ==================== UNDO / REDO ====================
+    def undo_target(self, owner: str):
+        """The user's latest stroke still in the log, or None.
+        Strokes compacted or cleared away since are dropped from the stack."""
+        stack = self.undo.get(owner) or []
+        while stack:
+            if stack[-1] in self.sids:
+                return stack[-1]
+            stack.pop()
+            self._release(owner, 1)
+        return None
+
+    def redo_target(self, owner: str):
+        """(stroke id, frames) of the user's last undone stroke, or None"""
+        stack = self.redo.get(owner)
+        return stack[-1] if stack else None
+
+    def remove(self, sid: str, owner: str):
+        """Take a stroke's ops out of the log and onto its owner's redo stack"""
+        removed, before_validated = [], 0
+        ops, sids = [], []
+        for position, (op, op_sid) in enumerate(zip(self.ops, self.sids)):
+            if op_sid == sid:
+                removed.append(op)
+                before_validated += position < self.validated
+            else:
+                ops.append(op)
+                sids.append(op_sid)
+        self.ops, self.sids = ops, sids
+        self.validated -= before_validated
+        self.compacted = min(self.compacted, len(self.ops))
+        self.edits += 1
+        stack = self.undo.get(owner) or []
+        if sid in stack:
+            stack.remove(sid)
+            self._release(owner, 1)
+        frames = [op for op in removed if is_valid_json(op)]
+        if frames:
+            self.redo.setdefault(owner, []).append((sid, frames))
+            self._hold(owner, len(frames))
+
+    def restore(self, sid: str, owner: str, frames: List[str]):
+        """Put an undone stroke back on top of the log"""
+        stack = self.redo.get(owner) or []
+        for position in range(len(stack) - 1, -1, -1):
+            if stack[position][0] == sid:
+                self._release(owner, len(stack.pop(position)[1]))
+                break
+        self.ops.extend(frames)
+        self.sids.extend([sid] * len(frames))
+        self._push_undo(owner, sid)
+
+    def _apply_stroke_history(self, kind: str, frame: str):
+        try:
+            message = json.loads(frame)
+        except ValueError:
+            return
+        sid, owner = message.get("sid"), message.get("sender")
+        if not isinstance(sid, str) or not isinstance(owner, str):
+            return
+        if kind == "remove_stroke":
+            self.remove(sid, owner)
+        elif isinstance(message.get("ops"), list):
+            self.restore(sid, owner, [json.dumps(op) for op in message["ops"] if isinstance(op, dict)])
+
+    def _push_undo(self, owner: str, sid: str):
+        stack = self.undo.setdefault(owner, [])
+        if sid in stack[-MAX_OPEN_STROKES:]:
+            return  # Another op of a stroke that's already there
+        stack.append(sid)
+        if len(stack) > WS_UNDO_DEPTH:
+            stack.pop(0)
+        else:
+            self._hold(owner, 1)
+
+    def _drop_redo(self, owner: str):
+        for _, frames in self.redo.pop(owner, []):
+            self._release(owner, len(frames))
+
+    def _hold(self, owner: str, count: int):
+        self.held[owner] = self.held.get(owner, 0) + count
+        while sum(self.held.values()) > WS_UNDO_ROOM_LIMIT:
+            largest = max(self.held, key=self.held.get)
+            if self.redo.get(largest):
+                self._release(largest, len(self.redo[largest].pop(0)[1]))
+            elif self.undo.get(largest):
+                self.undo[largest].pop(0)
+                self._release(largest, 1)
+            else:
+                self.held.pop(largest)
+
+    def _release(self, owner: str, count: int):
+        left = self.held.get(owner, 0) - count
+        if left > 0:
+            self.held[owner] = left
+        else:
+            self.held.pop(owner, None)
+            self.undo.pop(owner, None)
+            self.redo.pop(owner, None)
+    # =====================================================
+
+    @property
+    def due_for_compaction(self) -> bool:
+        return bool(WS_LOG_COMPACT_OPS) and len(self.ops) - self.compacted >= WS_LOG_COMPACT_OPS
+
+    def compaction_input(self):
+        """(validated ops, positions of undoable ones, edits) for kept_positions.
+        Erasers still on an undo stack don't count, since undoing one must
+        bring back what is under it."""
+        self.validate()
+        undoable = {sid for stack in self.undo.values() for sid in stack}
+        skip = {position for position, sid in enumerate(self.sids[:self.validated]) if sid in undoable}
+        return self.ops[:self.validated], skip, self.edits
+
+    @staticmethod
+    def kept_positions(ops: List[str], skip: set) -> Optional[List[int]]:
+        """Positions of the ops left once strokes that later erasers paint over
+        are dropped, or None if nothing is. Touches no log state, so it can
+        run off the event loop."""
+        parsed = [json.loads(op) for op in ops]
+        kept = drop_covered(parsed, skip=skip)
+        if kept is parsed:
+            return None
+        position_of = {id(op): position for position, op in enumerate(parsed)}
+        return [position_of[id(op)] for op in kept]
+
+    def apply_compaction(self, count: int, positions: Optional[List[int]], edits: int) -> bool:
+        """Keep only positions of the first count ops; the rest keep their
+        frames as they are. False, with nothing changed, if the log was edited
+        since the input was taken. Ops only appended since don't matter."""
+        if edits != self.edits:
+            return False
+        if positions is not None:
+            self.ops[:count] = [self.ops[position] for position in positions]
+            self.sids[:count] = [self.sids[position] for position in positions]
+            self.validated -= count - len(positions)
+            self.edits += 1
+        self.compacted = len(self.ops)
+        return True
+
+    def validate(self):
+        """Check fast-relayed ops, once, so a malformed client message can't
+        break every future sync"""
+        if self.validated < len(self.ops):
+            valid = [position for position in range(self.validated, len(self.ops)) if is_valid_json(self.ops[position])]
+            self.ops[self.validated:] = [self.ops[position] for position in valid]
+            self.sids[self.validated:] = [self.sids[position] for position in valid]
+            self.validated = len(self.ops)
+
+    def sync_frame(self) -> str:
+        """Build the late-join frame from the log as it stands; compaction
+        happens in the background between syncs (see ConnectionManager.record_op)"""
+        self.validate()
+        return '{"type": "sync", "ops": [' + ",".join(self.ops) + "]}"
+
+def encode_envelope(frame, log: bool, batch: bool) -> bytes:
+    """Pack a room message for the backplane: a JSON header line, the text,
+    then the binary form if there is one.
+
+    Relayed draw ops carry the sender's id instead of their binary form, so
+    the receiving worker packs it lazily just like the origin would. Ops that
+    can be undone bring their stroke id and owner along for the undo stacks.
+    """
+    header = {"o": WORKER_ID, "log": log, "batch": batch}
+    text = frame_text(frame).encode()
+    binary = b""
+    if isinstance(frame, Frame):
+        header["legacy"] = frame.legacy
+        if frame.sid is not None:
+            header["s"], header["w"] = frame.sid, frame.owner
+        if frame.draw_user_id is not None and frame._to_binary is not None:
+            header["u"] = frame.draw_user_id
+        else:
+            frame_binary = frame.binary()
+            if frame_binary is not None:
+                header["b"] = len(frame_binary)
+                binary = frame_binary
+    header["t"] = len(text)
+    return json.dumps(header, separators=(",", ":")).encode() + b"\n" + text + binary
+
+def decode_envelope(data: bytes):
+    """Unpack a backplane message into (origin, frame, log, batch)"""
+    header_end = data.index(b"\n")
+    header = json.loads(data[:header_end])
+    body = data[header_end + 1:]
+    text = body[:header["t"]].decode()
+    if "u" in header:
+        frame = draw_frame(text, header["u"])
+    else:
+        binary = body[header["t"]:] if "b" in header else None
+        frame = Frame(text, binary=binary, legacy=header.get("legacy"))
+    frame.sid, frame.owner = header.get("s"), header.get("w")
+    return header["o"], frame, header["log"], header["batch"]
+
+class LogSeed:
+    """What a worker hears on a room's channel while it loads the room's log.
+
+    Logged ops are held to be replayed onto the loaded log. When the log
+    comes from a peer, the ops heard before our request came back on the
+    channel are already in it, and so are the peer's own ops heard before
+    its answer; everything else is replayed.
+    """
+
+    def __init__(self):
+        self.held: List[tuple] = []  # (origin worker, frame) of logged ops, in channel order
+        self.request_id: Optional[str] = None
+        self.asked_at = 0            # len(held) when our request came back
+        self.answer = asyncio.get_running_loop().create_future()  # (peer, exported log, len(held) then)
+
+    def hear(self, origin: str, frame: Frame, log: bool):
+        message_type = peek_message_type(frame.text)
+        if origin == WORKER_ID:
+            if message_type == LOG_REQUEST_TYPE:
+                self.asked_at = len(self.held)
+        elif message_type == LOG_STATE_TYPE:
+            answer = json.loads(frame.text)
+            if answer.get("to") == WORKER_ID and answer.get("id") == self.request_id and not self.answer.done():
+                self.answer.set_result((origin, answer["log"], len(self.held)))
+        elif log:
+            self.held.append((origin, frame))
+
+    def replayed(self, peer: str = None, answered_at: int = None) -> list:
+        """Held ops the loaded log doesn't have yet; all of them for a log
+        seeded from the database"""
+        if peer is None:
+            return [frame for _, frame in self.held]
+        return [frame for origin, frame in self.held[self.asked_at:answered_at] if origin != peer] + \
+            [frame for _, frame in self.held[answered_at:]]
+
+async def _load_room_ops(room: str) -> List[str]:
+    """Seed a room's operation log from its last saved canvas state"""
+    async with AsyncSessionLocal() as db:
+        latest = await save_buffer.load(db, room)
+    if not latest:
+        return []
+    return [json.dumps(stroke) for stroke in json.loads(latest.state_json)]
+
 class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[str, List[Dict]] = {}  # Store connection + user info
+        self.room_logs: Dict[str, RoomOpLog] = {}  # Operation log per active room
+        self._log_loading: Dict[str, asyncio.Task] = {}  # Rooms whose log is being loaded
+        self._log_seeds: Dict[str, LogSeed] = {}  # room: what its channel carried meanwhile
+        self._compacting: Dict[str, asyncio.Task] = {}  # Rooms whose log is being compacted off the loop
+        self.pending_cursors: Dict[str, Dict[str, tuple]] = {}  # room: {user email: (cursor, user id)}
+        self._cursor_task: asyncio.Task = None
+        self.pending_draws: Dict[str, List[tuple]] = {}  # room: (draw op, sender's socket) waiting for the batch window
+        self._draw_timers: Dict[str, asyncio.TimerHandle] = {}
+        self.presence_versions: Dict[str, int] = {}  # room: version of this worker's member list
+        self.pending_presence: Dict[str, Dict[str, Optional[dict]]] = {}  # room: {presence id: member, or None if left}
+        self._presence_timers: Dict[str, asyncio.TimerHandle] = {}
 
-    async def connect(self, room: str, websocket: WebSocket, user_info: dict):
-        await websocket.accept()
-        if room not in self.active_connections:
-            self.active_connections[room] = []
+    async def connect(self, room: str, websocket: WebSocket, user_info: dict,
+                      subprotocol: str = None, compact_strokes: bool = False,
+                      stroke_prefix: str = None, resume: tuple = None):
+        await websocket.accept(subprotocol=subprotocol)
+        await self._ensure_room_log(room)
         
         connection_data = {
             "websocket": websocket,
-            "user": user_info
+            "user": user_info,
+            "queue": asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE),
+            "binary": subprotocol == ws_binary.SUBPROTOCOL,
+            "compact": compact_strokes,  # Wants compact stroke messages as-is
+            "slow": False,     # Set while the queue is at the high-water mark
+            "dropped": 0,      # Messages discarded because the queue was full
+            "presence_id": f"{WORKER_ID}:{id(websocket)}",
+            "stroke_prefix": stroke_prefix,
+            "joined": datetime.now().timestamp()
         }
+        connection_data["writer"] = asyncio.create_task(self._writer(connection_data))
         self.active_connections[room].append(connection_data)
         
-        # Send welcome message with current room members
-        await self.send_room_members_update(room)
+        # Stream the current canvas before any live op can reach this socket:
+        # what was missed when resuming (stream, seq, old stroke prefix), if that is still
+        # possible, otherwise all of it. The stroke prefix tells the client
+        # the ids its own strokes will get.
+        room_log = self.room_logs[room]
+        missed = room_log.missed(*resume) if resume else None
+        if missed is None:
+            self._enqueue(room, connection_data, self._sync_text(room_log, connection_data))
+        else:
+            self._enqueue(room, connection_data, '{"type": "resume", "ops": [%s]%s' % (
+                ",".join(missed), self._sync_position(room_log, connection_data)
+            ))
+
+        member = {
+            "user_id": user_info.get("user_id"),
+            "email": user_info["email"],
+            "full_name": user_info["full_name"],
+            "joined": connection_data["joined"]
+        }
+        try:
+            await backplane.presence_add(presence_key(room), connection_data["presence_id"], json.dumps(member))
+        except Exception as e:
+            print(f"Could not record presence in room {room}: {e}")
+
+        # The full member list goes to this socket only; the rest of the room
+        # hears about the join in its next presence frame
+        await self.send_room_members(room, connection_data)
+        member.pop("joined")
+        self.note_presence(room, joined={"id": connection_data["presence_id"], **member})
 
     def disconnect(self, room: str, websocket: WebSocket):
         if room in self.active_connections:
-            self.active_connections[room] = [
-                conn for conn in self.active_connections[room]
-                if conn["websocket"] != websocket
-            ]
+            remaining = []
+            for conn in self.active_connections[room]:
+                if conn["websocket"] == websocket:
+                    conn["writer"].cancel()
+                else:
+                    remaining.append(conn)
+            self.active_connections[room] = remaining
             if len(self.active_connections[room]) == 0:
                 del self.active_connections[room]
+                backplane.unsubscribe(room_channel(room))
+                self.room_logs.pop(room, None)
+                self.pending_draws.pop(room, None)
+                timer = self._draw_timers.pop(room, None)
+                if timer:
+                    timer.cancel()
+                self.pending_presence.pop(room, None)
+                self.presence_versions.pop(room, None)
+                timer = self._presence_timers.pop(room, None)
+                if timer:
+                    timer.cancel()
+                # Nobody left to autosave, so write the room's buffered save now
+                save_buffer.flush_soon(room)
+
+    async def leave(self, room: str, websocket: WebSocket):
+        """Disconnect a socket, drop its presence and tell the room"""
+        conn_data = next(
+            (conn for conn in self.active_connections.get(room, []) if conn["websocket"] == websocket),
+            None
+        )
+        self.disconnect(room, websocket)
+        if conn_data is not None:
+            await self._remove_presence(room, conn_data)
+
+    async def _remove_presence(self, room: str, conn_data: dict):
+        try:
+            await backplane.presence_remove(presence_key(room), conn_data["presence_id"])
+        except Exception as e:
+            print(f"Could not remove presence in room {room}: {e}")
+        self.note_presence(room, left=conn_data["presence_id"])
+
+    # ==================== ROOM OPERATION LOG ====================
+    async def _ensure_room_log(self, room: str):
+        """Load a room's log on first join; concurrent joiners share one load"""
+        while room not in self.room_logs:
+            task = self._log_loading.get(room)
+            if task is None:
+                task = asyncio.create_task(self._load_room_log(room))
+                self._log_loading[room] = task
+            await task
 
-    async def broadcast(self, room: str, message: str, exclude_websocket: WebSocket = None):
-        """Broadcast message to all users in room"""
+    async def _load_room_log(self, room: str):
+        """Subscribe to the room first, so nothing published while the log
+        loads is missed, then take the log from a peer worker or the database
+        and replay what the channel carried meanwhile"""
+        seed = self._log_seeds[room] = LogSeed()
+        backplane.subscribe(room_channel(room), lambda data: self._on_backplane_message(room, data))
+        try:
+            answer = await self._log_from_peer(room, seed) if backplane.distributed else None
+            if answer is not None:
+                peer, state, answered_at = answer
+                room_log, missed = RoomOpLog.imported(state), seed.replayed(peer, answered_at)
+            else:
+                try:
+                    ops = await _load_room_ops(room)
+                except Exception as e:
+                    print(f"Could not load canvas state for room {room}: {e}")
+                    ops = []
+                room_log, missed = RoomOpLog(ops), seed.replayed()
+        finally:
+            self._log_loading.pop(room, None)
+            self._log_seeds.pop(room, None)
+        # From here on the channel is applied live
+        self.room_logs.setdefault(room, room_log)
+        self.active_connections.setdefault(room, [])
+        for frame in missed:
+            self.record_op(room, frame)
+
+    async def _log_from_peer(self, room: str, seed: LogSeed):
+        """(peer, its exported log, where its answer fell among the held ops)
+        from a worker already serving the room, or None if there is none or
+        it doesn't answer within WS_LOG_PEER_TIMEOUT_MS"""
+        try:
+            members = await backplane.presence_list(presence_key(room))
+        except Exception as e:
+            print(f"Could not list presence in room {room}: {e}")
+            return None
+        peers = sorted({member.partition(":")[0] for member in members} - {WORKER_ID})
+        if not peers:
+            return None
+
+        async def ask():
+            # The request must come back to us, to mark what the peer has seen
+            await backplane.subscribed(room_channel(room))
+            seed.request_id = f"{WORKER_ID}.{next(_log_numbers)}"
+            backplane.publish(room_channel(room), encode_envelope(json.dumps({
+                "type": LOG_REQUEST_TYPE, "to": peers[0], "id": seed.request_id
+            }), False, False))
+            return await seed.answer
+
+        try:
+            return await asyncio.wait_for(ask(), WS_LOG_PEER_TIMEOUT_MS / 1000)
+        except asyncio.TimeoutError:
+            print(f"No answer from worker {peers[0]} for the log of room {room}; loading the saved canvas")
+            return None
+
+    def _answer_log_request(self, room: str, origin: str, text: str):
+        """Send this worker's log of the room to the worker that asked for it"""
+        request = json.loads(text)
+        room_log = self.room_logs.get(room)
+        if request.get("to") != WORKER_ID or room_log is None:
+            return
+        backplane.publish(room_channel(room), encode_envelope(json.dumps({
+            "type": LOG_STATE_TYPE, "to": origin, "id": request.get("id"), "log": room_log.export()
+        }), False, False))
+
+    def _sync_text(self, room_log: RoomOpLog, conn_data: dict) -> str:
+        """The room's whole canvas for one connection"""
+        return room_log.sync_frame()[:-1] + self._sync_position(room_log, conn_data)
+
+    @staticmethod
+    def _sync_position(room_log: RoomOpLog, conn_data: dict) -> str:
+        """End of a sync or resume frame: where it leaves the client in the
+        op stream, and the connection's stroke prefix"""
+        return ', "stream": %s, "seq": %d, "stroke_prefix": %s}' % (
+            json.dumps(room_log.stream), room_log.seq, json.dumps(conn_data["stroke_prefix"])
+        )
+
+    def record_op(self, room: str, frame):
+        """Number a relayed canvas operation and append it to the room's log.
+        Returns the numbered frame. Compact stroke frames are logged as their
+        legacy segments."""
+        room_log = self.room_logs.get(room)
+        if room_log is None:
+            return frame
+        frame = room_log.sequence(frame)
+        if not isinstance(frame, Frame):
+            room_log.append(frame)
+        elif frame.legacy is not None:
+            for segment in frame.legacy:
+                room_log.append(segment, frame.sid, frame.owner)
+        else:
+            room_log.append(frame.text, frame.sid, frame.owner)
+        if room_log.due_for_compaction and room not in self._compacting:
+            self._compacting[room] = asyncio.create_task(self._compact_log(room, room_log))
+        return frame
+
+    async def _compact_log(self, room: str, room_log: RoomOpLog):
+        """Compact a room's log in a worker thread. Ops keep arriving
+        meanwhile; if the log was edited instead, the next op tries again."""
+        try:
+            ops, skip, edits = room_log.compaction_input()
+            positions = await run_in_threadpool(RoomOpLog.kept_positions, ops, skip)
+            room_log.apply_compaction(len(ops), positions, edits)
+        except Exception as e:
+            print(f"Could not compact the log of room {room}: {e}")
+            room_log.compacted = len(room_log.ops)
+        finally:
+            self._compacting.pop(room, None)
+
+    async def undo_stroke(self, room: str, user_info: dict):
+        """Remove the user's latest stroke from the room, for everyone"""
+        log = self.room_logs.get(room)
+        sid = log.undo_target(user_info["email"]) if log else None
+        if sid is None:
+            return
+        await self.relay(room, json.dumps({
+            "type": "remove_stroke",
+            "sid": sid,
+            "sender": user_info["email"],
+            "sender_name": user_info["full_name"]
+        }), log=True)
+
+    async def redo_stroke(self, room: str, user_info: dict):
+        """Put back the stroke the user last undid, for everyone"""
+        log = self.room_logs.get(room)
+        entry = log.redo_target(user_info["email"]) if log else None
+        if entry is None:
+            return
+        sid, frames = entry
+        await self.relay(room, '{"type": "restore_stroke", "sid": %s, "ops": [%s], "sender": %s, "sender_name": %s}' % (
+            json.dumps(sid), ",".join(frames), json.dumps(user_info["email"]), json.dumps(user_info["full_name"])
+        ), log=True)
+
+    async def broadcast_clear(self, room: str, user_info: dict = None):
+        """Record a canvas clear made outside the socket and tell the room"""
+        message = {"type": "clear"}
+        if user_info:
+            message["sender"] = user_info["email"]
+            message["sender_name"] = user_info.get("full_name")
+        await self.relay(room, json.dumps(message), log=True)
+    # ============================================================
+
+    # ==================== CURSOR COALESCING ====================
+    def queue_cursor(self, room: str, user_info: dict, cursor: dict):
+        """Keep only the latest cursor per user until the next tick"""
+        self.pending_cursors.setdefault(room, {})[user_info["email"]] = (cursor, user_info["user_id"])
+        if self._cursor_task is None:
+            self._cursor_task = asyncio.create_task(self._cursor_ticker())
+
+    async def _cursor_ticker(self):
+        """Send one batched cursors frame per room every 1 / WS_CURSOR_HZ seconds.
+        Started by the first queued cursor; stops after a tick with none."""
+        interval = 1 / WS_CURSOR_HZ
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                pending, self.pending_cursors = self.pending_cursors, {}
+                if not pending:
+                    return
+                for room, cursors in pending.items():
+                    await self.broadcast(room, self._cursors_frame(list(cursors.values())))
+        finally:
+            self._cursor_task = None
+
+    @staticmethod
+    def _cursors_frame(cursors: list) -> Frame:
+        def to_binary():
+            records = [ws_binary.encode_cursor(cursor, user_id) for cursor, user_id in cursors]
+            return None if None in records else b"".join(records)
+        text = json.dumps({
+            "type": "cursors",
+            "cursors": [cursor for cursor, _ in cursors]
+        })
+        return Frame(text, to_binary=to_binary)
+    # ============================================================
+
+    # ==================== DRAW BATCHING ====================
+    def queue_draw(self, room: str, frame, sender: WebSocket = None):
+        """Hold a draw op until the room's batch window closes. The sender's
+        socket, if it is on this worker, doesn't get the op back."""
+        if room in self.pending_draws:
+            self.pending_draws[room].append((frame, sender))
+            return
+        self.pending_draws[room] = [(frame, sender)]
+        self._draw_timers[room] = asyncio.get_running_loop().call_later(
+            WS_DRAW_BATCH_MS / 1000, self._flush_draws, room
+        )
+
+    def _flush_draws(self, room: str):
+        """Send a room's pending draw ops, in arrival order, as one frame.
+
+        A socket whose own ops are in the batch gets a copy without them,
+        just as an unbatched op isn't sent back to its sender. Ops were
+        relayed without parsing, so the joined frame is checked once and a
+        malformed op is dropped rather than taking the whole batch down.
+        """
+        timer = self._draw_timers.pop(room, None)
+        if timer:
+            timer.cancel()
+        pending = self.pending_draws.pop(room, None)
+        if not pending:
+            return
+        if not is_valid_json(self._batch_text([frame for frame, _ in pending])):
+            pending = [(frame, sender) for frame, sender in pending if is_valid_json(frame_text(frame))]
+            if not pending:
+                return
+        everyone = self._batch_frame([frame for frame, _ in pending])
+        senders = {sender for _, sender in pending if sender is not None}
+        for conn_data in self.active_connections.get(room, []):
+            websocket = conn_data["websocket"]
+            if websocket not in senders:
+                self._enqueue(room, conn_data, everyone)
+                continue
+            others = [frame for frame, sender in pending if sender is not websocket]
+            if others:
+                self._enqueue(room, conn_data, self._batch_frame(others))
+
+    def _batch_frame(self, ops: list) -> Frame:
+        return batch_frame(self._batch_text(ops), ops)
+
+    @staticmethod
+    def _batch_text(ops: list) -> str:
+        return '{"type": "draw_batch", "ops": [' + ",".join(frame_text(op) for op in ops) + "]}"
+    # ========================================================
+
+    # ==================== OUTBOUND QUEUES ====================
+    async def _writer(self, conn_data: dict):
+        """Drain one connection's outbound queue onto its socket"""
+        websocket = conn_data["websocket"]
+        queue = conn_data["queue"]
+        binary_client = conn_data["binary"]
+        compact_client = conn_data["compact"]
+        try:
+            while True:
+                message = await queue.get()
+                if not isinstance(message, Frame):
+                    await websocket.send_text(message)
+                elif compact_client and message.legacy is not None:
+                    await websocket.send_text(message.text)
+                elif binary_client and message.binary() is not None:
+                    if message.binary():
+                        await websocket.send_bytes(message.binary())
+                elif message.legacy is not None:
+                    for text in message.legacy:
+                        await websocket.send_text(text)
+                else:
+                    await websocket.send_text(message.text)
+                if conn_data["slow"] and queue.empty():
+                    conn_data["slow"] = False
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # Socket is gone; the receive loop cleans up on disconnect
+            pass
+
+    def _enqueue(self, room: str, conn_data: dict, message):
+        """Queue a message for one connection without waiting on the socket"""
+        try:
+            conn_data["queue"].put_nowait(message)
+        except asyncio.QueueFull:
+            conn_data["dropped"] += 1
+            if conn_data["slow"]:
+                return
+            conn_data["slow"] = True
+            print(f"Slow consumer in room {room}: {conn_data['user']['email']}")
+            if WS_SLOW_CONSUMER_POLICY == "disconnect":
+                self.disconnect(room, conn_data["websocket"])
+                asyncio.create_task(self._close_slow_consumer(room, conn_data))
+
+    async def _close_slow_consumer(self, room: str, conn_data: dict):
+        """Close a socket that fell too far behind; the client may reconnect"""
+        try:
+            await conn_data["websocket"].close(code=1013, reason="Too slow")
+        except Exception:
+            pass
+        await self._remove_presence(room, conn_data)
+    # ==========================================================
+
+    async def broadcast(self, room: str, message, exclude_websocket: WebSocket = None):
+        """Queue message for all users in room; never waits on a socket"""
+        await self.relay(room, message, exclude_websocket)
+
+    async def relay(self, room: str, message, exclude_websocket: WebSocket = None,
+                    log: bool = False, batch: bool = False):
+        """Deliver a room message here and, when distributed, on every other worker.
+
+        log appends it to the room's operation log and batch lets draw ops wait
+        for the batch window; other workers apply both the same way.
+        """
+        # Packed first: each worker numbers logged ops in its own stream
+        envelope = encode_envelope(message, log, batch) if backplane.distributed else None
+        self._apply(room, message, exclude_websocket, log, batch)
+        if envelope is not None:
+            backplane.publish(room_channel(room), envelope)
+
+    def _apply(self, room: str, message, exclude_websocket: WebSocket = None,
+               log: bool = False, batch: bool = False):
+        if log:
+            message = self.record_op(room, message)
+        if batch and WS_DRAW_BATCH_MS > 0:
+            self.queue_draw(room, message, exclude_websocket)
+            return
+        # Anything sent to the room must not overtake draw ops still batching
+        if room in self.pending_draws:
+            self._flush_draws(room)
+        if log and peek_message_type(frame_text(message)) == "remove_stroke":
+            self._fanout_removal(room, message, exclude_websocket)
+            return
+        self._fanout(room, message, exclude_websocket)
+
+    def _on_backplane_message(self, room: str, data: bytes):
+        """Apply a message another worker relayed to this room"""
+        try:
+            origin, frame, log, batch = decode_envelope(data)
+        except (ValueError, KeyError) as e:
+            print(f"Bad backplane message for room {room}: {e}")
+            return
+        seed = self._log_seeds.get(room)
+        if seed is not None:
+            seed.hear(origin, frame, log)
+            return
+        if origin == WORKER_ID or room not in self.active_connections:
+            return
+        message_type = peek_message_type(frame.text)
+        if message_type == LOG_REQUEST_TYPE:
+            self._answer_log_request(room, origin, frame.text)
+            return
+        if message_type == LOG_STATE_TYPE:
+            return  # An answer for a worker that is still loading
+        if message_type == PRESENCE_EVENT_TYPE:
+            event = json.loads(frame.text)
+            self._queue_presence(room, event.get("joined"), event.get("left"))
+            return
+        self._apply(room, frame, log=log, batch=batch)
+
+    def _fanout(self, room: str, message, exclude_websocket: WebSocket = None):
         if room in self.active_connections:
             for conn_data in self.active_connections[room]:
-                websocket = conn_data["websocket"]
-                if websocket != exclude_websocket:
-                    try:
-                        await websocket.send_text(message)
-                    except:
-                        # Connection might be closed, will be cleaned up on disconnect
-                        pass
+                if conn_data["websocket"] != exclude_websocket:
+                    self._enqueue(room, conn_data, message)
+
+    def _fanout_removal(self, room: str, message, exclude_websocket: WebSocket = None):
+        """remove_stroke for the room. Binary clients got the stroke's ops as
+        DRAW records, which carry no stroke id, so they get the canvas again
+        instead (already without the stroke)."""
+        room_log = self.room_logs.get(room)
+        for conn_data in self.active_connections.get(room, []):
+            if conn_data["websocket"] == exclude_websocket:
+                continue
+            if conn_data["binary"] and room_log is not None:
+                self._enqueue(room, conn_data, self._sync_text(room_log, conn_data))
+            else:
+                self._enqueue(room, conn_data, message)
 
     # ==================== CHAT & CAPTIONS HANDLING ====================
     async def broadcast_chat(self, room: str, chat_data: dict):
@@ -63,11 +1080,7 @@ class ConnectionManager:
                 "type": "chat",
                 "data": chat_data
             })
-            for conn_data in self.active_connections[room]:
-                try:
-                    await conn_data["websocket"].send_text(message)
-                except:
-                    pass
+            await self.broadcast(room, message)
 
     async def broadcast_caption(self, room: str, caption_data: dict):
         """Broadcast live captions to all users in room"""
@@ -76,38 +1089,122 @@ class ConnectionManager:
                 "type": "caption",
                 "data": caption_data
             })
-            for conn_data in self.active_connections[room]:
-                try:
-                    await conn_data["websocket"].send_text(message)
-                except:
-                    pass
+            await self.broadcast(room, message)
     # ==================================================================
 
-    async def send_room_members_update(self, room: str):
-        """Send updated list of room members"""
-        if room not in self.active_connections:
-            return
-        
-        members = []
-        for conn_data in self.active_connections[room]:
-            user = conn_data["user"]
-            members.append({
-                "user_id": user.get("user_id"),
-                "email": user["email"],
-                "full_name": user["full_name"]
-            })
+    # ==================== PRESENCE ====================
+    async def send_room_members(self, room: str, conn_data: dict):
+        """Send one socket the room's full member list, across all workers.
+        Its version is that of the last presence frame this worker sent;
+        later member_joined/member_left frames carry higher ones."""
+        try:
+            entries = await backplane.presence_list(presence_key(room))
+            members = [{"id": presence_id, **json.loads(entry)} for presence_id, entry in entries.items()]
+        except Exception as e:
+            print(f"Could not read presence in room {room}: {e}")
+            members = []
+            for other in self.active_connections.get(room, []):
+                user = other["user"]
+                members.append({
+                    "id": other["presence_id"],
+                    "user_id": user.get("user_id"),
+                    "email": user["email"],
+                    "full_name": user["full_name"],
+                    "joined": other["joined"]
+                })
+        members.sort(key=lambda member: member.pop("joined", 0))
+        # Who it already knows about, so later member_joined frames can leave them out
+        conn_data["roster"] = {member["id"] for member in members}
         
-        update_message = json.dumps({
+        self._enqueue(room, conn_data, json.dumps({
             "type": "room_members_update",
+            "version": self.presence_versions.get(room, 0),
             "members": members
-        })
-        await self.broadcast(room, update_message)
+        }))
+
+    def note_presence(self, room: str, joined: dict = None, left: str = None):
+        """Add a join (member) or leave (presence id) to the room's next
+        presence frame, here and on every other worker"""
+        self._queue_presence(room, joined, left)
+        if backplane.distributed:
+            event = json.dumps({"type": PRESENCE_EVENT_TYPE, "joined": joined, "left": left})
+            backplane.publish(room_channel(room), encode_envelope(event, False, False))
+
+    def _queue_presence(self, room: str, joined: dict = None, left: str = None):
+        if room not in self.active_connections:
+            return
+        pending = self.pending_presence.setdefault(room, {})
+        if joined is not None:
+            pending[joined["id"]] = joined
+        if left is not None:
+            # A join still pending is replaced too: someone may have read
+            # the member from the full list in the meantime
+            pending[left] = None
+        if WS_PRESENCE_COALESCE_MS <= 0:
+            self._flush_presence(room)
+        elif room not in self._presence_timers:
+            self._presence_timers[room] = asyncio.get_running_loop().call_later(
+                WS_PRESENCE_COALESCE_MS / 1000, self._flush_presence, room
+            )
+
+    def _flush_presence(self, room: str):
+        """Send the joins and leaves gathered for a room, under one new version"""
+        timer = self._presence_timers.pop(room, None)
+        if timer:
+            timer.cancel()
+        pending = self.pending_presence.pop(room, None)
+        if not pending or room not in self.active_connections:
+            return
+        version = self.presence_versions[room] = self.presence_versions.get(room, 0) + 1
+        joined = [member for member in pending.values() if member is not None]
+        left = [presence_id for presence_id, member in pending.items() if member is None]
+        if joined:
+            self._send_joined(room, version, joined)
+        if left:
+            self._apply(room, json.dumps({"type": "member_left", "version": version, "ids": left}))
+            for conn_data in self.active_connections[room]:
+                conn_data.get("roster", set()).difference_update(left)
+
+    def _send_joined(self, room: str, version: int, joined: List[dict]):
+        """member_joined for the room. A socket's copy leaves out whoever was
+        already in the full list it was sent (itself, and anyone who joined
+        earlier in the same window)."""
+        if room in self.pending_draws:
+            self._flush_draws(room)
+        frame = json.dumps({"type": "member_joined", "version": version, "members": joined})
+        for conn_data in self.active_connections[room]:
+            roster = conn_data.get("roster")
+            fresh = [member for member in joined if member["id"] not in roster] if roster else joined
+            if len(fresh) == len(joined):
+                self._enqueue(room, conn_data, frame)
+            elif fresh:
+                self._enqueue(room, conn_data, json.dumps({"type": "member_joined", "version": version, "members": fresh}))
+    # ===================================================
 
 manager = ConnectionManager()
 
-# ==================== WEBRTC SIGNALING ====================
-# Store WebRTC connections separately
-webrtc_rooms: Dict[str, Dict[str, Dict]] = {}
+def peek_message_type(raw_data: str):
+    """Read the leading "type" key of a client message without parsing the rest"""
+    match = _MESSAGE_TYPE_PREFIX.match(raw_data)
+    if match and raw_data.rstrip().endswith("}"):
+        return match.group(1)
+    return None
+
+def build_sender_suffix(user_info: dict) -> str:
+    """Encode the sender fields once per connection as a closing JSON fragment"""
+    return ', "sender": %s, "sender_name": %s}' % (
+        json.dumps(user_info["email"]),
+        json.dumps(user_info["full_name"])
+    )
+
+def attach_sender(raw_data: str, sender_suffix: str) -> str:
+    """Splice the cached sender fields onto a raw JSON object.
+
+    Later keys win when clients parse duplicates, so a client can't spoof
+    sender by sending its own. The result is one string shared by every
+    recipient's queue.
+    """
+    return raw_data.rstrip()[:-1] + sender_suffix
 
 def verify_websocket_token(token: str):
     """Verify JWT token for WebSocket connection"""
@@ -124,19 +1221,97 @@ def verify_websocket_token(token: str):
     except JWTError:
         return None
 
+async def handle_binary_message(room_id: str, websocket: WebSocket, user_info: dict, data: bytes,
+                                stroke_ids: StrokeIds):
+    """Apply a frame of binary draw/cursor records from a binary client.
+
+    Each record is decoded once into the JSON shape for JSON clients, and the
+    original record, stamped with the sender's id, is reused for binary ones.
+    Records have no stroke key, so each one is a stroke of its own.
+    """
+    for record, message_data in ws_binary.decode_records(data):
+        record = ws_binary.with_user_id(record, user_info["user_id"])
+        message_data["sender"] = user_info["email"]
+        message_data["sender_name"] = user_info["full_name"]
+        
+        if message_data["type"] == "cursor":
+            message_data["userId"] = user_info["email"]
+            message_data["name"] = user_info["full_name"] or user_info["email"]
+            if WS_CURSOR_HZ > 0:
+                manager.queue_cursor(room_id, user_info, message_data)
+            else:
+                frame = Frame(json.dumps(message_data), binary=record)
+                await manager.broadcast(room_id, frame, exclude_websocket=websocket)
+            continue
+        
+        message_data["sid"] = stroke_ids.for_key()
+        frame = Frame(json.dumps(message_data), binary=record)
+        frame.sid, frame.owner = message_data["sid"], user_info["email"]
+        await manager.relay(room_id, frame, exclude_websocket=websocket, log=True, batch=True)
+
 @router.websocket("/ws/{room_id}")
-async def websocket_endpoint(websocket: WebSocket, room_id: str, token: str = Query(...)):
+async def websocket_endpoint(websocket: WebSocket, room_id: str, token: str = Query(...),
+                             strokes: str = Query("legacy"), stream: str = Query(None),
+                             resume: int = Query(None), prefix: str = Query(None)):
     # Verify JWT token
     user_info = verify_websocket_token(token)
     if not user_info:
         await websocket.close(code=4001, reason="Authentication failed")
         return
     
-    await manager.connect(room_id, websocket, user_info)
+    # Clients offering the binary subprotocol get draw/cursor traffic as records
+    subprotocol = None
+    if ws_binary.SUBPROTOCOL in websocket.scope.get("subprotocols", []):
+        subprotocol = ws_binary.SUBPROTOCOL
+    
+    stroke_ids = StrokeIds()
+    # A reconnecting client names the stream and last seq it saw, and the
+    # stroke prefix it had; without all three it gets a full sync
+    resume_from = (stream, resume, prefix) if None not in (stream, resume, prefix) else None
+    await manager.connect(room_id, websocket, user_info, subprotocol, strokes == "compact",
+                          stroke_ids.prefix, resume_from)
+    sender_suffix = build_sender_suffix(user_info)
+    open_strokes: Dict = {}  # This connection's compact strokes in progress
     
     try:
         while True:
-            raw_data = await websocket.receive_text()
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            if message.get("bytes") is not None:
+                await handle_binary_message(room_id, websocket, user_info, message["bytes"], stroke_ids)
+                continue
+            raw_data = message.get("text") or ""
+            
+            peeked_type = peek_message_type(raw_data)
+            
+            # Cursors are coalesced and sent out on the room's tick
+            if peeked_type == "cursor" and WS_CURSOR_HZ > 0:
+                try:
+                    cursor = json.loads(raw_data)
+                except json.JSONDecodeError:
+                    continue
+                cursor["sender"] = user_info["email"]
+                cursor["sender_name"] = user_info["full_name"]
+                manager.queue_cursor(room_id, user_info, cursor)
+                continue
+            
+            # Relay drawing and other pass-through messages as-is
+            if WS_FAST_RELAY and peeked_type in RELAYED_CLIENT_TYPES:
+                if peeked_type in DRAW_MESSAGE_TYPES:
+                    sid = stroke_ids.for_raw(raw_data)
+                    frame = draw_frame(
+                        attach_sender(raw_data, ', "sid": "%s"%s' % (sid, sender_suffix)),
+                        user_info["user_id"], sid, user_info["email"]
+                    )
+                else:
+                    frame = attach_sender(raw_data, sender_suffix)
+                await manager.relay(
+                    room_id, frame, exclude_websocket=websocket,
+                    log=peeked_type in LOGGED_MESSAGE_TYPES,
+                    batch=peeked_type in DRAW_MESSAGE_TYPES
+                )
+                continue
             
             # Parse incoming message
             try:
@@ -164,12 +1339,34 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, token: str = Qu
                     }
                     await manager.broadcast_caption(room_id, caption_data)
                 
-                else:
+                elif message_type in STROKE_MESSAGE_TYPES:
+                    # Compact strokes; legacy clients get the expanded segments
+                    frame = stroke_frame(message_data, open_strokes, user_info, stroke_ids)
+                    if frame is not None:
+                        await manager.relay(room_id, frame, exclude_websocket=websocket, log=True)
+                
+                elif message_type in UNDO_REQUEST_TYPES and "shapes" not in message_data:
+                    # Undo/redo of the sender's own last stroke; an undo that
+                    # carries shapes is the older whole-canvas form, relayed below
+                    if message_type == "undo":
+                        await manager.undo_stroke(room_id, user_info)
+                    else:
+                        await manager.redo_stroke(room_id, user_info)
+                
+                elif message_type in RELAYED_CLIENT_TYPES:
                     # Handle drawing and other messages (existing functionality)
                     message_data["sender"] = user_info["email"]
                     message_data["sender_name"] = user_info["full_name"]
-                    enhanced_message = json.dumps(message_data)
-                    await manager.broadcast(room_id, enhanced_message, exclude_websocket=websocket)
+                    if message_type in DRAW_MESSAGE_TYPES:
+                        message_data["sid"] = stroke_ids.for_message(message_data)
+                        enhanced_message = Frame(json.dumps(message_data))
+                        enhanced_message.sid, enhanced_message.owner = message_data["sid"], user_info["email"]
+                    else:
+                        enhanced_message = json.dumps(message_data)
+                    await manager.relay(
+                        room_id, enhanced_message, exclude_websocket=websocket,
+                        log=message_type in LOGGED_MESSAGE_TYPES
+                    )
                 # ==============================================================================
                 
             except json.JSONDecodeError:
@@ -178,9 +1375,8 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, token: str = Qu
                 await manager.broadcast(room_id, enhanced_message, exclude_websocket=websocket)
     
     except WebSocketDisconnect:
-        manager.disconnect(room_id, websocket)
-        # Send updated member list after someone leaves
-        await manager.send_room_members_update(room_id)
+        # Drops presence and sends the updated member list
+        await manager.leave(room_id, websocket)
 
 # ==================== WEBRTC VIDEO CALL SIGNALING ====================
 @router.websocket("/webrtc/{room_id}")
@@ -203,28 +1399,16 @@ async def webrtc_signaling(websocket: WebSocket, room_id: str, token: str = Quer
 
     await websocket.accept()
     
-    # Initialize room if needed
-    if room_id not in webrtc_rooms:
-        webrtc_rooms[room_id] = {}
-    
-    # Add user to room
-    webrtc_rooms[room_id][user_email] = {
-        "websocket": websocket,
-        "userName": user_name
-    }
+    # Peers may sit on other workers, so delivery goes through signaling_manager
+    signaling_manager.add(room_id, user_email, websocket)
     
     try:
         # Notify others that user joined
-        for uid, client_data in webrtc_rooms[room_id].items():
-            if uid != user_email:
-                try:
-                    await client_data["websocket"].send_json({
-                        "type": "user-joined",
-                        "userId": user_email,
-                        "userName": user_name
-                    })
-                except:
-                    pass
+        await signaling_manager.broadcast_to_room(room_id, {
+            "type": "user-joined",
+            "userId": user_email,
+            "userName": user_name
+        }, exclude_user=user_email)
         
         # Handle incoming messages
         while True:
@@ -233,59 +1417,34 @@ async def webrtc_signaling(websocket: WebSocket, room_id: str, token: str = Quer
             
             if msg_type == "join":
                 # User sent join message with their info
-                webrtc_rooms[room_id][user_email]["userName"] = message.get("userName", user_name)
+                user_name = message.get("userName", user_name)
                 continue
             
             if msg_type == "leave":
-                # User is leaving
-                user_leaving_name = message.get("userName", user_name)
-                # Notify others
-                for uid, client_data in webrtc_rooms[room_id].items():
-                    if uid != user_email:
-                        try:
-                            await client_data["websocket"].send_json({
-                                "type": "user-left",
-                                "userId": user_email,
-                                "userName": user_leaving_name
-                            })
-                        except:
-                            pass
+                # User is leaving; others are notified below
+                user_name = message.get("userName", user_name)
                 break
             
             # Forward signaling messages (offer, answer, ice-candidate)
             target_user_id = message.get("targetUserId")
-            if target_user_id and target_user_id in webrtc_rooms[room_id]:
-                try:
-                    forward_msg = {
-                        "type": msg_type,
-                        "fromUserId": user_email,
-                        "userName": webrtc_rooms[room_id][user_email].get("userName", user_name),
-                        "sdp": message.get("sdp"),
-                        "candidate": message.get("candidate")
-                    }
-                    await webrtc_rooms[room_id][target_user_id]["websocket"].send_json(forward_msg)
-                except:
-                    pass
+            if target_user_id:
+                forward_msg = {
+                    "type": msg_type,
+                    "fromUserId": user_email,
+                    "userName": user_name,
+                    "sdp": message.get("sdp"),
+                    "candidate": message.get("candidate")
+                }
+                await signaling_manager.send_to_user(room_id, target_user_id, forward_msg)
                     
     except WebSocketDisconnect:
         pass
     finally:
-        # Clean up
-        if room_id in webrtc_rooms and user_email in webrtc_rooms[room_id]:
-            leaving_user_name = webrtc_rooms[room_id][user_email].get("userName", user_name)
-            del webrtc_rooms[room_id][user_email]
-            
-            # Notify others
-            for uid, client_data in webrtc_rooms[room_id].items():
-                try:
-                    await client_data["websocket"].send_json({
-                        "type": "user-left",
-                        "userId": user_email,
-                        "userName": leaving_user_name
-                    })
-                except:
-                    pass
-            
-            # Clean up empty room
-            if not webrtc_rooms[room_id]:
-                del webrtc_rooms[room_id]
+        # Clean up and notify others
+        if signaling_manager.has_user(room_id, user_email):
+            signaling_manager.disconnect(room_id, user_email)
+            await signaling_manager.broadcast_to_room(room_id, {
+                "type": "user-left",
+                "userId": user_email,
+                "userName": user_name
+            })
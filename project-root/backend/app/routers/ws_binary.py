@@ -0,0 +1,122 @@
+"""
+Compact binary encoding for draw and cursor traffic on /ws/{room_id}.
+
+Clients opt in by offering the "canvus.bin.v1" WebSocket subprotocol.
+A binary frame is a run of fixed-size little-endian records, so a batch is
+simply several records back to back:
+
+    DRAW   (16 bytes)  opcode=1, tool, color, thickness, fromX, fromY, toX, toY, user_id
+    CURSOR (12 bytes)  opcode=2, tool, color, 0,         x,     y,              user_id
+
+Coordinates are rounded to int16, color is an index into PALETTE and tool an
+index into TOOLS. Anything that doesn't fit (text, custom colors, chat...)
+stays JSON, so binary clients must still handle text frames. user_id is the
+sender's id; the server fills it in and ignores whatever the client sent.
+"""
+import struct
+from typing import List, Optional
+
+SUBPROTOCOL = "canvus.bin.v1"
+
+OP_DRAW = 1
+OP_CURSOR = 2
+
+DRAW_RECORD = struct.Struct("<BBBBhhhhI")
+CURSOR_RECORD = struct.Struct("<BBBBhhI")
+RECORD_SIZES = {OP_DRAW: DRAW_RECORD.size, OP_CURSOR: CURSOR_RECORD.size}
+
+# Must match the frontend's TOOLS / COLORS (plus the eraser background color)
+TOOLS = ["brush", "eraser", "rectangle", "ellipse", "draw"]
+PALETTE = ["#e53e3e", "#3182ce", "#38a169", "#f6ad55", "#2d3748", "#555", "#f9fafb"]
+
+_TOOL_INDEX = {tool: i for i, tool in enumerate(TOOLS)}
+_PALETTE_INDEX = {color: i for i, color in enumerate(PALETTE)}
+
+INT16_MIN, INT16_MAX = -32768, 32767
+
+
+def _coord(value) -> int:
+    return max(INT16_MIN, min(INT16_MAX, int(round(value))))
+
+
+def _color_index(color) -> Optional[int]:
+    if not isinstance(color, str):
+        return None
+    return _PALETTE_INDEX.get(color.lower())
+
+
+def encode_draw(op: dict, user_id: int) -> Optional[bytes]:
+    """Pack a draw op as a DRAW record, or None if it doesn't fit the layout"""
+    tool = _TOOL_INDEX.get(op.get("type"))
+    color = _color_index(op.get("color"))
+    if tool is None or color is None:
+        return None
+    try:
+        return DRAW_RECORD.pack(
+            OP_DRAW, tool, color, max(0, min(255, int(op.get("thickness", 1)))),
+            _coord(op["fromX"]), _coord(op["fromY"]),
+            _coord(op["toX"]), _coord(op["toY"]),
+            user_id or 0
+        )
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def encode_cursor(cursor: dict, user_id: int) -> Optional[bytes]:
+    """Pack a cursor message as a CURSOR record, or None if it doesn't fit"""
+    tool = _TOOL_INDEX.get(cursor.get("tool", "brush"))
+    color = _color_index(cursor.get("cursorColor", PALETTE[0]))
+    if tool is None or color is None:
+        return None
+    try:
+        return CURSOR_RECORD.pack(
+            OP_CURSOR, tool, color, 0,
+            _coord(cursor["x"]), _coord(cursor["y"]),
+            user_id or 0
+        )
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def with_user_id(record: bytes, user_id: int) -> bytes:
+    """Stamp the sender's id onto a client-sent record"""
+    return record[:-4] + struct.pack("<I", user_id or 0)
+
+
+def decode_records(data: bytes) -> List[tuple]:
+    """Split a binary frame into (record bytes, decoded message) pairs.
+
+    Decoded messages use the same shape as the JSON protocol. Decoding stops
+    at the first unknown opcode or truncated record.
+    """
+    records = []
+    offset = 0
+    while offset < len(data):
+        opcode = data[offset]
+        size = RECORD_SIZES.get(opcode)
+        if size is None or offset + size > len(data):
+            break
+        record = data[offset:offset + size]
+        offset += size
+        if opcode == OP_DRAW:
+            _, tool, color, thickness, from_x, from_y, to_x, to_y, _ = DRAW_RECORD.unpack(record)
+            if tool >= len(TOOLS) or color >= len(PALETTE):
+                continue
+            records.append((record, {
+                "type": TOOLS[tool],
+                "fromX": from_x, "fromY": from_y,
+                "toX": to_x, "toY": to_y,
+                "color": PALETTE[color],
+                "thickness": thickness
+            }))
+        else:
+            _, tool, color, _, x, y, _ = CURSOR_RECORD.unpack(record)
+            if tool >= len(TOOLS) or color >= len(PALETTE):
+                continue
+            records.append((record, {
+                "type": "cursor",
+                "x": x, "y": y,
+                "tool": TOOLS[tool],
+                "cursorColor": PALETTE[color]
+            }))
+    return records
@@ -0,0 +1,282 @@
+"""
+Room-affinity dispatcher: one front process in front of N local workers.
+
+    python dispatcher.py
+
+Starts DISPATCH_WORKERS uvicorn workers on 127.0.0.1 (ports from
+DISPATCH_BASE_PORT up) and listens on DISPATCH_HOST:DISPATCH_PORT. Room
+traffic (/ws/{room_id}, /webrtc/{room_id} and the REST clear, which
+broadcasts to the live room) is routed by consistent-hashing the room id, so
+every member of a room lands on the same worker's ConnectionManager and no
+backplane is needed. Other HTTP requests are spread round-robin.
+
+Rooms stay pinned to the worker they're on while they have open connections.
+Adding or removing a worker (SIGTTIN / SIGTTOU) only moves the rooms whose
+ring owner changed, and only once they're idle. A removed worker is drained
+first: it gets no new rooms, keeps the ones pinned to it, and is stopped
+once they have all emptied or DISPATCH_DRAIN_SECONDS have passed. A worker
+that dies takes its rooms with it; their members reconnect elsewhere.
+"""
+import os
+import re
+import sys
+import signal
+import asyncio
+import hashlib
+from bisect import bisect
+from itertools import count
+from typing import Dict, List, Optional, Set
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DISPATCH_HOST = os.getenv("DISPATCH_HOST", "0.0.0.0")
+DISPATCH_PORT = int(os.getenv("DISPATCH_PORT", "8000"))
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", str(os.cpu_count() or 1)))
+DISPATCH_BASE_PORT = int(os.getenv("DISPATCH_BASE_PORT", "8100"))
+# Points per worker on the ring; more points spread rooms more evenly
+DISPATCH_VNODES = int(os.getenv("DISPATCH_VNODES", "160"))
+# How long a removed worker may keep serving its open rooms before it's stopped
+DISPATCH_DRAIN_SECONDS = float(os.getenv("DISPATCH_DRAIN_SECONDS", "300"))
+
+# Requests that must reach the worker holding the room
+_ROOM_PATH = re.compile(r"^/(?:ws|webrtc|canvas/clear)/([^/?#]+)")
+MAX_HEADER_BYTES = 64 * 1024
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _close_after_response(head: bytes) -> bytes:
+    """Ask the worker to close a plain HTTP connection after one response.
+
+    Routing happens per connection, so a kept-alive connection could carry a
+    later room request to the wrong worker. WebSocket upgrades are left alone.
+    """
+    lines = head[:-4].split(b"\r\n")
+    if any(line.lower().startswith(b"upgrade:") for line in lines[1:]):
+        return head
+    kept = [line for line in lines if not line.lower().startswith(b"connection:")]
+    return b"\r\n".join(kept + [b"Connection: close"]) + b"\r\n\r\n"
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring with virtual nodes"""
+
+    def __init__(self, vnodes: int = DISPATCH_VNODES):
+        self.vnodes = vnodes
+        self._keys: List[int] = []
+        self._nodes: List[int] = []
+
+    def add(self, node: int):
+        for i in range(self.vnodes):
+            key = _hash(f"{node}:{i}")
+            index = bisect(self._keys, key)
+            self._keys.insert(index, key)
+            self._nodes.insert(index, node)
+
+    def remove(self, node: int):
+        kept = [(key, n) for key, n in zip(self._keys, self._nodes) if n != node]
+        self._keys = [key for key, _ in kept]
+        self._nodes = [n for _, n in kept]
+
+    def node_for(self, key: str) -> Optional[int]:
+        if not self._keys:
+            return None
+        index = bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[index]
+
+
+class Dispatcher:
+    def __init__(self):
+        self.ring = HashRing()
+        self.workers: Dict[int, asyncio.subprocess.Process] = {}  # port: process
+        self.live: List[int] = []       # Ports currently on the ring
+        self.pins: Dict[str, list] = {}  # room: [port, open connections]
+        self.draining: Set[int] = set()  # Ports taken off the ring, waiting for their rooms to empty
+        self._round_robin = count()
+        self._stopping = False
+
+    # ==================== WORKERS ====================
+    async def start_worker(self, port: int):
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--host", "127.0.0.1", "--port", str(port),
+            cwd=BACKEND_DIR, env={**os.environ, "DISPATCH_WORKER": str(port)}
+        )
+        self.workers[port] = process
+        asyncio.create_task(self._watch_worker(port, process))
+        if await self._wait_ready(port, process):
+            self.ring.add(port)
+            self.live.append(port)
+            print(f"Worker on port {port} ready")
+
+    async def _wait_ready(self, port: int, process, timeout: float = 30) -> bool:
+        deadline = asyncio.get_running_loop().time() + timeout
+        while process.returncode is None and asyncio.get_running_loop().time() < deadline:
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.close()
+                return True
+            except OSError:
+                await asyncio.sleep(0.2)
+        return False
+
+    async def _watch_worker(self, port: int, process):
+        await process.wait()
+        self._take_off_ring(port)
+        self._drop_pins(port)
+        if self._stopping or port in self.draining or self.workers.get(port) is not process:
+            return
+        print(f"Worker on port {port} exited ({process.returncode}), restarting")
+        await asyncio.sleep(1)
+        await self.start_worker(port)
+
+    def _take_off_ring(self, port: int):
+        if port in self.live:
+            self.live.remove(port)
+            self.ring.remove(port)
+
+    def _drop_pins(self, port: int):
+        for room in [room for room, pin in self.pins.items() if pin[0] == port]:
+            del self.pins[room]
+
+    async def add_worker(self):
+        port = DISPATCH_BASE_PORT
+        while port in self.workers:
+            port += 1
+        await self.start_worker(port)
+
+    async def remove_worker(self):
+        """Drain the highest-port worker, then stop it"""
+        if len(self.live) <= 1:
+            return
+        port = max(self.live)
+        self.draining.add(port)
+        self._take_off_ring(port)
+        # Its pinned rooms still route to it; new rooms and other requests don't
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + DISPATCH_DRAIN_SECONDS
+        while any(pin[0] == port for pin in self.pins.values()) and loop.time() < deadline:
+            await asyncio.sleep(1)
+        process = self.workers.pop(port)
+        self._drop_pins(port)
+        self.draining.discard(port)
+        if process.returncode is None:
+            process.terminate()
+        print(f"Removed worker on port {port}")
+
+    async def stop(self):
+        self._stopping = True
+        for process in self.workers.values():
+            if process.returncode is None:
+                process.terminate()
+        await asyncio.gather(*(process.wait() for process in self.workers.values()))
+    # =================================================
+
+    # ==================== ROUTING ====================
+    def route(self, path: str):
+        """Pick a worker port for a request path; returns (port, room or None)"""
+        match = _ROOM_PATH.match(path)
+        if match is None:
+            if not self.live:
+                return None, None
+            return self.live[next(self._round_robin) % len(self.live)], None
+        room = match.group(1)
+        pin = self.pins.get(room)
+        if pin is not None:
+            return pin[0], room
+        return self.ring.node_for(room), room
+
+    def _pin(self, room: str, port: int):
+        pin = self.pins.setdefault(room, [port, 0])
+        pin[1] += 1
+
+    def _unpin(self, room: str, port: int):
+        pin = self.pins.get(room)
+        if pin is not None and pin[0] == port:
+            pin[1] -= 1
+            if pin[1] <= 0:
+                del self.pins[room]
+
+    async def handle(self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter):
+        try:
+            head = await client_reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            client_writer.close()
+            return
+
+        request_line = head.split(b"\r\n", 1)[0].decode("latin-1").split(" ")
+        path = request_line[1] if len(request_line) == 3 else "/"
+        port, room = self.route(path)
+        if port is None:
+            client_writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            client_writer.close()
+            return
+
+        try:
+            worker_reader, worker_writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            client_writer.write(b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            client_writer.close()
+            return
+
+        if room is not None:
+            self._pin(room, port)
+        try:
+            worker_writer.write(_close_after_response(head))
+            await asyncio.gather(
+                _pipe(client_reader, worker_writer),
+                _pipe(worker_reader, client_writer)
+            )
+        finally:
+            if room is not None:
+                self._unpin(room, port)
+            worker_writer.close()
+            client_writer.close()
+    # =================================================
+
+
+async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Copy bytes one way until EOF, then half-close the other side"""
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+    except (ConnectionError, OSError):
+        writer.close()
+
+
+async def main():
+    dispatcher = Dispatcher()
+    await asyncio.gather(*(
+        dispatcher.start_worker(DISPATCH_BASE_PORT + i) for i in range(DISPATCH_WORKERS)
+    ))
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    # Same signals gunicorn uses to scale workers up and down
+    loop.add_signal_handler(signal.SIGTTIN, lambda: asyncio.create_task(dispatcher.add_worker()))
+    loop.add_signal_handler(signal.SIGTTOU, lambda: asyncio.create_task(dispatcher.remove_worker()))
+
+    server = await asyncio.start_server(
+        dispatcher.handle, DISPATCH_HOST, DISPATCH_PORT, limit=MAX_HEADER_BYTES
+    )
+    print(f"Dispatching on {DISPATCH_HOST}:{DISPATCH_PORT} to {len(dispatcher.live)} workers")
+    async with server:
+        await stop.wait()
+    await dispatcher.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
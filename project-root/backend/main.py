@@ -1,3 +1,4 @@
+import asyncio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.routers.home import router as home_router
@@ -6,6 +7,12 @@ from app.routers.websockets import router as websocket_router
 from app.routers.drawings import router as drawings_router
 from app.routers.rooms import router as rooms_router
 from app.routers.webrtc import router as webrtc_router  # NEW: Import WebRTC router
+from app.routers.backplane import backplane
+from app.routers.save_buffer import save_buffer
+from app.routers.retention_service import retention_loop, SNAPSHOT_RETENTION_INTERVAL
+from app.routers.tile_service import tile_service
+from app.routers.thumbnail_service import thumbnail_service
+from app.models.db import async_engine
 
 app = FastAPI()
 
@@ -16,6 +23,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Room-Id", "X-Created-At", "ETag", "X-Next-Before"],  # Canvas loads and listings
 )
 
 app.include_router(home_router)
@@ -25,6 +33,35 @@ app.include_router(drawings_router)
 app.include_router(rooms_router)
 app.include_router(webrtc_router)  # NEW: Register WebRTC router
 
+# Background snapshot retention (see retention_service)
+retention_task = None
+
+@app.on_event("startup")
+async def start_retention():
+    global retention_task
+    if SNAPSHOT_RETENTION_INTERVAL > 0:
+        retention_task = asyncio.create_task(retention_loop())
+
+@app.on_event("shutdown")
+async def stop_retention():
+    if retention_task:
+        retention_task.cancel()
+
+@app.on_event("shutdown")
+async def stop_tile_renderer():
+    thumbnail_service.shutdown()
+    tile_service.shutdown()
+
+@app.on_event("startup")
+async def start_backplane():
+    await backplane.start()
+
+@app.on_event("shutdown")
+async def stop_backplane():
+    await save_buffer.flush_all()
+    await backplane.stop()
+    await async_engine.dispose()
+
 @app.get("/")
 async def root():
     return {"message": "Hello from FastAPI"}
@@ -0,0 +1,173 @@
+"""
+Small in-memory server speaking the Redis protocol (RESP), for exercising
+RedisBackplane without a real Redis.
+
+Supports just what the backplane uses: PUBLISH/SUBSCRIBE/UNSUBSCRIBE, the
+presence hash commands (HSET, HDEL, HGETALL), SET with EX, GET, MGET, DEL,
+EXPIRE, plus AUTH/SELECT/PING, which are accepted and ignored. Keys expire
+against a clock the tests can move forward with advance().
+
+Run it directly to point a local server at it:
+    python -m tests.resp_standin [port]      # then BACKPLANE_URL=redis://127.0.0.1:port
+"""
+import sys
+import time
+import asyncio
+from typing import Dict, Optional, Set
+
+from app.routers.backplane import _read_reply
+
+
+def _bulk(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, str):
+        value = value.encode()
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def _array(items) -> bytes:
+    return b"*%d\r\n" % len(items) + b"".join(_bulk(item) for item in items)
+
+
+class RespStandin:
+    """One RESP server on 127.0.0.1; port 0 picks a free port"""
+
+    def __init__(self, port: int = 0):
+        self.port = port
+        self.keys: Dict[bytes, object] = {}  # Strings are bytes, hashes are dicts
+        self.expires: Dict[bytes, float] = {}
+        self.published = 0
+        self._offset = 0.0
+        self._subs: Dict[bytes, Set[asyncio.StreamWriter]] = {}
+        self._clients: Set[asyncio.StreamWriter] = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def url(self) -> str:
+        return f"redis://127.0.0.1:{self.port}/0"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.drop_clients()
+        self._server.close()
+        await self._server.wait_closed()
+
+    def drop_clients(self):
+        """Close every client connection, as a Redis restart would"""
+        for writer in list(self._clients):
+            writer.close()
+        self._clients.clear()
+        self._subs.clear()
+
+    def advance(self, seconds: float):
+        """Move the expiry clock forward"""
+        self._offset += seconds
+
+    # ---- keyspace ----
+    def _now(self) -> float:
+        return time.monotonic() + self._offset
+
+    def _get(self, key: bytes):
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= self._now():
+            self.keys.pop(key, None)
+            self.expires.pop(key, None)
+        return self.keys.get(key)
+
+    def _delete(self, key: bytes) -> int:
+        self.expires.pop(key, None)
+        return 0 if self.keys.pop(key, None) is None else 1
+
+    def _execute(self, name: str, args: list, writer: asyncio.StreamWriter) -> bytes:
+        if name in ("AUTH", "SELECT"):
+            return b"+OK\r\n"
+        if name == "PING":
+            return b"+PONG\r\n"
+        if name == "SUBSCRIBE":
+            reply = b""
+            for channel in args:
+                self._subs.setdefault(channel, set()).add(writer)
+                reply += b"*3\r\n" + _bulk("subscribe") + _bulk(channel) + b":1\r\n"
+            return reply
+        if name == "UNSUBSCRIBE":
+            reply = b""
+            for channel in args:
+                self._subs.get(channel, set()).discard(writer)
+                reply += b"*3\r\n" + _bulk("unsubscribe") + _bulk(channel) + b":0\r\n"
+            return reply
+        if name == "PUBLISH":
+            channel, message = args
+            receivers = list(self._subs.get(channel, ()))
+            for receiver in receivers:
+                receiver.write(b"*3\r\n" + _bulk("message") + _bulk(channel) + _bulk(message))
+            self.published += 1
+            return b":%d\r\n" % len(receivers)
+        if name == "SET":
+            key, value = args[0], args[1]
+            self.keys[key] = value
+            self.expires.pop(key, None)
+            if len(args) >= 4 and args[2].upper() == b"EX":
+                self.expires[key] = self._now() + int(args[3])
+            return b"+OK\r\n"
+        if name == "GET":
+            value = self._get(args[0])
+            return _bulk(value if isinstance(value, bytes) else None)
+        if name == "MGET":
+            values = [self._get(key) for key in args]
+            return _array([value if isinstance(value, bytes) else None for value in values])
+        if name == "DEL":
+            return b":%d\r\n" % sum(self._delete(key) for key in args)
+        if name == "EXPIRE":
+            if self._get(args[0]) is None:
+                return b":0\r\n"
+            self.expires[args[0]] = self._now() + int(args[1])
+            return b":1\r\n"
+        if name == "HSET":
+            fields = self._get(args[0])
+            if fields is None:
+                fields = self.keys[args[0]] = {}
+            added = 0
+            for i in range(1, len(args) - 1, 2):
+                added += args[i] not in fields
+                fields[args[i]] = args[i + 1]
+            return b":%d\r\n" % added
+        if name == "HDEL":
+            fields = self._get(args[0]) or {}
+            removed = sum(fields.pop(field, None) is not None for field in args[1:])
+            if not fields:
+                self._delete(args[0])
+            return b":%d\r\n" % removed
+        if name == "HGETALL":
+            fields = self._get(args[0]) or {}
+            return _array([item for pair in fields.items() for item in pair])
+        return b"-ERR unknown command '%s'\r\n" % name.encode()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._clients.add(writer)
+        try:
+            while True:
+                command = await _read_reply(reader)
+                writer.write(self._execute(command[0].decode().upper(), command[1:], writer))
+                await writer.drain()
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._clients.discard(writer)
+            for receivers in self._subs.values():
+                receivers.discard(writer)
+            writer.close()
+
+
+async def _serve(port: int):
+    standin = RespStandin(port)
+    await standin.start()
+    print(f"RESP stand-in listening on {standin.url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(_serve(int(sys.argv[1]) if len(sys.argv) > 1 else 6379))
@@ -0,0 +1,145 @@
+"""RedisBackplane against the RESP stand-in, with two backplanes as two workers"""
+import asyncio
+
+from app.routers.backplane import BACKPLANE_WORKER_TTL, RedisBackplane
+from tests.resp_standin import RespStandin
+
+
+async def _wait_for(condition, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def _subscribed(standin: RespStandin, channel: str) -> bool:
+    return bool(standin._subs.get(channel.encode()))
+
+
+async def _two_workers():
+    standin = RespStandin()
+    await standin.start()
+    workers = []
+    for worker_id in ("aaaaaaaaaaaa", "bbbbbbbbbbbb"):
+        worker = RedisBackplane(standin.url)
+        worker.worker_id = worker_id
+        await worker.start()
+        workers.append(worker)
+    return standin, workers
+
+
+async def _shutdown(standin: RespStandin, workers):
+    for worker in workers:
+        await worker.stop()
+    await standin.stop()
+
+
+def test_publish_reaches_other_worker():
+    async def scenario():
+        standin, (a, b) = await _two_workers()
+        received = []
+        a.subscribe("room:1", received.append)
+        await _wait_for(lambda: _subscribed(standin, "room:1"))
+        b.publish("room:1", b"hello")
+        b.publish("room:2", b"nobody listens")
+        await _wait_for(lambda: received)
+        assert received == [b"hello"]
+
+        a.unsubscribe("room:1")
+        await _wait_for(lambda: not _subscribed(standin, "room:1"))
+        b.publish("room:1", b"after")
+        await _wait_for(lambda: standin.published == 3)
+        assert received == [b"hello"]
+        await _shutdown(standin, [a, b])
+
+    asyncio.run(scenario())
+
+
+def test_subscribed_waits_for_the_server():
+    async def scenario():
+        standin, (a, b) = await _two_workers()
+        received = []
+        a.subscribe("room:1", received.append)
+        await asyncio.wait_for(a.subscribed("room:1"), timeout=5)
+        # Confirmed, so a publish from here on can't overtake the subscription
+        assert _subscribed(standin, "room:1")
+        b.publish("room:1", b"hello")
+        await _wait_for(lambda: received)
+        await a.subscribed("room:1")
+        await _shutdown(standin, [a, b])
+
+    asyncio.run(scenario())
+
+
+def test_presence_is_shared():
+    async def scenario():
+        standin, (a, b) = await _two_workers()
+        await a.presence_add("presence:1", "m1", "alice")
+        await b.presence_add("presence:1", "m2", "bob")
+        assert await a.presence_list("presence:1") == {"m1": "alice", "m2": "bob"}
+
+        await a.presence_remove("presence:1", "m1")
+        assert await b.presence_list("presence:1") == {"m2": "bob"}
+        assert await b.presence_list("presence:other") == {}
+        await _shutdown(standin, [a, b])
+
+    asyncio.run(scenario())
+
+
+def test_crashed_worker_members_expire():
+    async def scenario():
+        standin, (a, b) = await _two_workers()
+        await a.presence_add("presence:1", "m1", "alice")
+        await b.presence_add("presence:1", "m2", "bob")
+
+        # b dies without removing its members or its heartbeat
+        b._task.cancel()
+        await asyncio.gather(b._task, return_exceptions=True)
+        b._task = None
+        # a keeps joining people, which refreshes the room key
+        await a.presence_add("presence:1", "m3", "carol")
+        assert set(await a.presence_list("presence:1")) == {"m1", "m2", "m3"}
+
+        standin.advance(BACKPLANE_WORKER_TTL + 1)
+        # a's heartbeat lapsed in the jump too; let it beat again
+        await a._command("SET", a._heartbeat_key(a.worker_id), "1", "EX", BACKPLANE_WORKER_TTL)
+        assert await a.presence_list("presence:1") == {"m1": "alice", "m3": "carol"}
+        await _wait_for(lambda: b"m2" not in standin.keys[b"presence:1"])
+        await _shutdown(standin, [a])
+
+    asyncio.run(scenario())
+
+
+def test_stopped_worker_members_drop_at_once():
+    async def scenario():
+        standin, (a, b) = await _two_workers()
+        await b.presence_add("presence:1", "m2", "bob")
+        await b.stop()
+        assert await a.presence_list("presence:1") == {}
+        await _shutdown(standin, [a])
+
+    asyncio.run(scenario())
+
+
+def test_reconnect_restores_subscriptions():
+    async def scenario():
+        standin, (a, b) = await _two_workers()
+        received = []
+        a.subscribe("room:1", received.append)
+        await _wait_for(lambda: _subscribed(standin, "room:1"))
+
+        standin.drop_clients()
+        await _wait_for(lambda: not a._connected.is_set() and not b._connected.is_set())
+        # Dropped rather than raised or queued while the connection is down
+        b.publish("room:1", b"lost")
+        await _wait_for(lambda: b.dropped == 1)
+
+        await _wait_for(lambda: _subscribed(standin, "room:1") and b._connected.is_set())
+        b.publish("room:1", b"back")
+        await _wait_for(lambda: received)
+        assert received == [b"back"]
+        await b.presence_add("presence:1", "m2", "bob")
+        assert await a.presence_list("presence:1") == {"m2": "bob"}
+        await _shutdown(standin, [a, b])
+
+    asyncio.run(scenario())
@@ -0,0 +1,52 @@
+"""Snapshot deltas, applied to full states and to streaming plans"""
+import json
+
+from app.routers.drawings_service import apply_delta, diff_strokes
+from app.routers.state_stream import _apply_planned
+
+
+def _rect(n: int) -> dict:
+    return {"type": "rectangle", "fromX": n, "fromY": 0, "toX": n + 10, "toY": 10}
+
+
+def _planned(keyframe: list, deltas: list) -> list:
+    pieces, rest = [], 0
+    for delta in deltas:
+        pieces, rest = _apply_planned(pieces, rest, json.loads(json.dumps(delta)))
+    state = [keyframe[piece] if isinstance(piece, int) else piece[0] for piece in pieces]
+    return state + (keyframe[rest:] if rest is not None else [])
+
+
+def test_removal_in_the_middle_is_listed():
+    old = [_rect(n) for n in range(6)]
+    new = old[:2] + old[3:] + [_rect(99)]
+    delta = diff_strokes(old, new)
+    assert delta == {"remove": [2], "add": [[5, _rect(99)]]}
+    assert apply_delta(old, delta) == new
+
+
+def test_scattered_changes_round_trip():
+    old = [_rect(n) for n in range(8)]
+    new = [_rect(50)] + old[1:3] + [_rect(51)] + old[4:6] + old[7:]
+    delta = diff_strokes(old, new)
+    assert delta["remove"] == [0, 3, 6]
+    assert apply_delta(old, delta) == new
+    assert diff_strokes(new, new) == {"remove": [], "add": []}
+
+
+def test_prefix_deltas_still_apply():
+    old = [_rect(n) for n in range(4)]
+    assert apply_delta(old, {"keep": 2, "add": [_rect(9)]}) == old[:2] + [_rect(9)]
+
+
+def test_plan_matches_resolved_state():
+    keyframe = [_rect(n) for n in range(10)]
+    states = [
+        keyframe,
+        keyframe[:3] + keyframe[4:] + [_rect(20)],
+        [_rect(21)] + keyframe[:3] + keyframe[5:8] + [_rect(20)],
+    ]
+    deltas = [diff_strokes(a, b) for a, b in zip(states, states[1:])]
+    deltas.append({"keep": 4, "add": [_rect(22)]})
+    assert _planned(keyframe, deltas[:2]) == states[2]
+    assert _planned(keyframe, deltas) == states[2][:4] + [_rect(22)]
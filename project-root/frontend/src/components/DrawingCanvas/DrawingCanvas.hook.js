@@ -3,6 +3,7 @@ import { useRef, useEffect, useState } from "react";
 export const CANVAS_W = 1200;
 export const CANVAS_H = 700;
 export const COLLISION_RADIUS = 24;
+export const RECONNECT_DELAY_MS = 1000;
 export const COLORS = ['#e53e3e', '#3182ce', '#38a169', '#f6ad55', '#2d3748', '#555'];
 export const THICKNESS = [2, 4, 6, 8, 12];
 export const TOOLS = [
@@ -11,10 +12,11 @@ export const TOOLS = [
   { key: 'rectangle', label: 'Rectangle' },
   { key: 'ellipse', label: 'Ellipse' },
   { key: 'text', label: 'Text' },
-  { key: 'undo', label: 'Undo' }
+  { key: 'undo', label: 'Undo' },
+  { key: 'redo', label: 'Redo' }
 ];
 export const TOOL_LABELS = {
-  brush: "Brush", eraser: "Eraser", rectangle: "Rectangle", ellipse: "Ellipse", text: "Text", undo: "Undo"
+  brush: "Brush", eraser: "Eraser", rectangle: "Rectangle", ellipse: "Ellipse", text: "Text", undo: "Undo", redo: "Redo"
 };
 export const CURSORS = {
   brush: "url(\"data:image/svg+xml,<svg xmlns='http://www.w3.org/2000/svg' width='32' height='32'><circle cx='16' cy='16' r='8' fill='white' stroke='blue' stroke-width='3'/></svg>\") 16 16, crosshair",
@@ -22,7 +24,8 @@ export const CURSORS = {
   rectangle: "url(\"data:image/svg+xml,<svg xmlns='http://www.w3.org/2000/svg' width='32' height='32'><rect x='8' y='8' width='16' height='10' stroke='red' fill='white' stroke-width='3'/></svg>\") 16 16, crosshair",
   ellipse: "url(\"data:image/svg+xml,<svg xmlns='http://www.w3.org/2000/svg' width='32' height='32'><ellipse cx='16' cy='16' rx='8' ry='5' stroke='green' fill='white' stroke-width='3'/></svg>\") 16 16, crosshair",
   text: "url(\"data:image/svg+xml,<svg xmlns='http://www.w3.org/2000/svg' width='32' height='32'><text x='4' y='22' font-size='18' font-family='Arial' fill='black'>T</text></svg>\") 6 22, text",
-  undo: "crosshair"
+  undo: "crosshair",
+  redo: "crosshair"
 };
 
 export function useDrawingCanvas({ currentUser, roomId, token }) {
@@ -33,6 +36,14 @@ export function useDrawingCanvas({ currentUser, roomId, token }) {
   // Refs
   const canvasRef = useRef(null);
   const wsRef = useRef(null);
+  // Set once the server has streamed the live canvas over the socket
+  const syncedRef = useRef(false);
+  // Our strokes are numbered; the server names them stroke_prefix + number
+  const strokePrefixRef = useRef(null);
+  const strokeIdRef = useRef(0);
+  // Where we are in the room's op stream: its id and the last seq received
+  const streamRef = useRef(null);
+  const lastSeqRef = useRef(null);
 
   // State
   const [drawing, setDrawing] = useState(false);
@@ -47,6 +58,7 @@ export function useDrawingCanvas({ currentUser, roomId, token }) {
   const [localStrokes, setLocalStrokes] = useState([]);
   const [snapshots, setSnapshots] = useState([]);
   const [loadingSnapshots, setLoadingSnapshots] = useState(false);
+  const [olderSnapshotsCursor, setOlderSnapshotsCursor] = useState(null);
   const [clearing, setClearing] = useState(false);
 
   // Feature states
@@ -76,6 +88,47 @@ export function useDrawingCanvas({ currentUser, roomId, token }) {
     );
   }
 
+  // Fold a server operation log into the list of strokes to draw
+  const replayOps = (ops) => {
+    let strokes = [];
+    ops.forEach(op => {
+      if (op.type === 'clear') strokes = [];
+      else if (op.type === 'undo') strokes = op.shapes || [];
+      else strokes.push(op);
+    });
+    return strokes;
+  };
+
+  // Start numbering a new stroke of ours
+  const nextStrokeId = () => {
+    strokeIdRef.current += 1;
+    return strokeIdRef.current;
+  };
+
+  // The local copy of one of our ops, with the id the server gives its stroke
+  const withStrokeSid = (op) => (
+    strokePrefixRef.current !== null ? { ...op, sid: strokePrefixRef.current + op.strokeId } : op
+  );
+
+  // Merge cursor updates from other users (single or server-batched)
+  const applyRemoteCursors = (cursors) => {
+    const me = currentUser?.email || "anonymous";
+    const updates = {};
+    cursors.forEach(c => {
+      if (c.userId === me) return;
+      updates[c.userId] = {
+        x: c.x,
+        y: c.y,
+        name: c.name,
+        color: c.cursorColor,
+        tool: c.tool
+      };
+    });
+    if (Object.keys(updates).length) {
+      setRemoteCursors(prev => ({ ...prev, ...updates }));
+    }
+  };
+
   const clearAndRedraw = (strokes) => {
     const ctx = canvasRef.current.getContext('2d');
     ctx.clearRect(0, 0, CANVAS_W, CANVAS_H);
@@ -92,6 +145,22 @@ export function useDrawingCanvas({ currentUser, roomId, token }) {
       ctx.lineWidth = stroke.thickness;
       ctx.stroke();
     }
+    if (stroke.type === 'stroke') {
+      // Compact freehand stroke: start point plus (dx, dy) deltas
+      let x = stroke.x;
+      let y = stroke.y;
+      const d = stroke.d || [];
+      ctx.beginPath();
+      ctx.moveTo(x, y);
+      for (let i = 0; i + 1 < d.length; i += 2) {
+        x += d[i];
+        y += d[i + 1];
+        ctx.lineTo(x, y);
+      }
+      ctx.strokeStyle = stroke.color;
+      ctx.lineWidth = stroke.thickness;
+      ctx.stroke();
+    }
     if (stroke.type === 'rectangle') {
       ctx.strokeStyle = stroke.color;
       ctx.lineWidth = stroke.thickness;
@@ -125,12 +194,15 @@ export function useDrawingCanvas({ currentUser, roomId, token }) {
   useEffect(() => {
     async function loadCanvasState() {
       try {
-        const resp = await fetch(`${API_URL}/canvas/load/${roomId}`, {
+        // raw: the body is the stored strokes array, sent still compressed
+        const resp = await fetch(`${API_URL}/canvas/load/${roomId}?strokes=compact&raw=true`, {
           headers: { ...authHeaders }
         });
+        // The socket sync is newer than anything saved in the database
+        if (syncedRef.current) return;
         if (resp.ok) {
-          const data = await resp.json();
-          const strokes = JSON.parse(data.state_json || "[]");
+          const strokes = await resp.json();
+          if (syncedRef.current) return;
           setLocalStrokes(strokes);
           clearAndRedraw(strokes);
         } else {
@@ -138,6 +210,7 @@ export function useDrawingCanvas({ currentUser, roomId, token }) {
           clearAndRedraw([]);
         }
       } catch (e) {
+        if (syncedRef.current) return;
         setLocalStrokes([]);
         clearAndRedraw([]);
       }
@@ -145,20 +218,25 @@ export function useDrawingCanvas({ currentUser, roomId, token }) {
     loadCanvasState();
   }, [roomId, token, clearing]);
 
-  const fetchSnapshots = async () => {
+  // The listing is paged newest first; X-Next-Before is the cursor for older ones
+  const fetchSnapshots = async (before = null) => {
     setLoadingSnapshots(true);
     try {
-      const result = await fetch(`${API_URL}/canvas/snapshots/${roomId}`, {
+      const query = before ? `?before=${encodeURIComponent(before)}` : "";
+      const result = await fetch(`${API_URL}/canvas/snapshots/${roomId}${query}`, {
         headers: { ...authHeaders }
       });
       if (result.ok) {
         const arr = await result.json();
-        setSnapshots(arr);
+        setSnapshots(prev => before ? [...prev, ...arr] : arr);
+        setOlderSnapshotsCursor(result.headers.get("X-Next-Before"));
       }
     } catch (e) {}
     setLoadingSnapshots(false);
   };
 
+  const fetchOlderSnapshots = () => fetchSnapshots(olderSnapshotsCursor);
+
   useEffect(() => {
     fetchSnapshots();
     // eslint-disable-next-line
@@ -187,15 +265,14 @@ export function useDrawingCanvas({ currentUser, roomId, token }) {
 
   const handleRestoreSnapshot = async (snapshot_id) => {
     try {
-      const r = await fetch(`${API_URL}/canvas/snapshot/${snapshot_id}`, {
+      const r = await fetch(`${API_URL}/canvas/snapshot/${snapshot_id}?strokes=compact&raw=true`, {
         headers: { ...authHeaders }
       });
       if (r.ok) {
-        const snap = await r.json();
-        const strokes = JSON.parse(snap.state_json || "[]");
+        const strokes = await r.json();
         setLocalStrokes(strokes);
         clearAndRedraw(strokes);
-        alert(`Loaded version from ${new Date(snap.created_at).toLocaleString()}`);
+        alert(`Loaded version from ${new Date(r.headers.get("X-Created-At")).toLocaleString()}`);
       } else {
         alert("Failed to load snapshot.");
       }
@@ -266,11 +343,31 @@ export function useDrawingCanvas({ currentUser, roomId, token }) {
   };
 
   useEffect(() => {
-    wsRef.current = new window.WebSocket(`${WS_URL}/ws/${roomId}?token=${token}`);
-    const ws = wsRef.current;
-    ws.onopen = () => {};
-    ws.onmessage = (event) => {
-      const msg = JSON.parse(event.data);
+    let closed = false;
+    let retry = null;
+
+    const applyMessage = (msg) => {
+      // Track our place in the room's op stream, to resume from if we drop
+      if (typeof msg.seq === 'number') lastSeqRef.current = msg.seq;
+
+      if (msg.type === 'sync') {
+        syncedRef.current = true;
+        streamRef.current = msg.stream || null;
+        strokePrefixRef.current = msg.stroke_prefix || null;
+        const strokes = replayOps(msg.ops || []);
+        setLocalStrokes(strokes);
+        clearAndRedraw(strokes);
+      }
+      if (msg.type === 'resume') {
+        // Only what we missed while disconnected, on top of what we have
+        strokePrefixRef.current = msg.stroke_prefix || null;
+        (msg.ops || []).forEach(applyMessage);
+        lastSeqRef.current = msg.seq;
+      }
+      if (msg.type === 'clear') {
+        setLocalStrokes([]);
+        clearAndRedraw([]);
+      }
 
       if (
         ['draw', 'brush', 'eraser', 'rectangle', 'ellipse', 'text'].includes(msg.type)
@@ -278,21 +375,38 @@ export function useDrawingCanvas({ currentUser, roomId, token }) {
         drawStroke(msg);
         setLocalStrokes(prev => [...prev, msg]);
       }
+      if (msg.type === 'draw_batch') {
+        // Batches go to the whole room, including our own ops
+        const me = currentUser?.email || 'anonymous';
+        (msg.ops || []).forEach(op => {
+          if (typeof op.seq === 'number') lastSeqRef.current = op.seq;
+        });
+        const ops = (msg.ops || []).filter(op => op.sender !== me);
+        ops.forEach(drawStroke);
+        if (ops.length) setLocalStrokes(prev => [...prev, ...ops]);
+      }
       if (msg.type === "undo") {
         clearAndRedraw(msg.shapes || []);
         setLocalStrokes(msg.shapes || []);
       }
-      if (msg.type === "cursor" && msg.userId !== (currentUser?.email || "anonymous")) {
-        setRemoteCursors(prev => ({
-          ...prev,
-          [msg.userId]: {
-            x: msg.x,
-            y: msg.y,
-            name: msg.name,
-            color: msg.cursorColor,
-            tool: msg.tool
-          }
-        }));
+      if (msg.type === 'remove_stroke') {
+        // Someone's undo, ours included: drop every op of that stroke
+        setLocalStrokes(prev => {
+          const strokes = prev.filter(s => s.sid !== msg.sid);
+          clearAndRedraw(strokes);
+          return strokes;
+        });
+      }
+      if (msg.type === 'restore_stroke') {
+        const ops = msg.ops || [];
+        ops.forEach(drawStroke);
+        setLocalStrokes(prev => [...prev, ...ops]);
+      }
+      if (msg.type === "cursor") {
+        applyRemoteCursors([msg]);
+      }
+      if (msg.type === "cursors") {
+        applyRemoteCursors(msg.cursors || []);
       }
 
       if (msg.type === 'video_call_started' && msg.userId !== (currentUser?.email || 'anonymous')) {
@@ -304,8 +418,29 @@ export function useDrawingCanvas({ currentUser, roomId, token }) {
         }
       }
     };
-    ws.onclose = () => {};
-    return () => ws.close();
+
+    const connect = () => {
+      // After a drop, ask for just the ops after the last one we saw
+      const resume = streamRef.current !== null && lastSeqRef.current !== null && strokePrefixRef.current !== null
+        ? `&stream=${encodeURIComponent(streamRef.current)}&resume=${lastSeqRef.current}`
+          + `&prefix=${encodeURIComponent(strokePrefixRef.current)}`
+        : '';
+      const ws = new window.WebSocket(`${WS_URL}/ws/${roomId}?token=${token}${resume}`);
+      wsRef.current = ws;
+      ws.onopen = () => {};
+      ws.onmessage = (event) => applyMessage(JSON.parse(event.data));
+      ws.onclose = (event) => {
+        // 4001: the token was refused, and will be again
+        if (!closed && event.code !== 4001) retry = setTimeout(connect, RECONNECT_DELAY_MS);
+      };
+    };
+
+    connect();
+    return () => {
+      closed = true;
+      clearTimeout(retry);
+      wsRef.current.close();
+    };
     // eslint-disable-next-line
   }, [roomId, currentUser, showVideoCall]);
 
@@ -323,27 +458,30 @@ export function useDrawingCanvas({ currentUser, roomId, token }) {
     };
   };
 
+  // The server removes our last stroke and tells the whole room
   const handleUndo = () => {
-    const ctx = canvasRef.current.getContext('2d');
-    ctx.clearRect(0, 0, CANVAS_W, CANVAS_H);
     sendWS({ type: 'undo' });
-    setLocalStrokes([]);
+  };
+
+  const handleRedo = () => {
+    sendWS({ type: 'redo' });
   };
 
   const start = e => {
     const { x, y } = getCanvasCoords(e);
-    if (tool === 'undo') {
-      handleUndo();
+    if (tool === 'undo' || tool === 'redo') {
+      if (tool === 'undo') handleUndo();
+      else handleRedo();
       setTool('brush');
       return;
     }
     if (tool === 'text') {
       const value = window.prompt("Enter your text:");
       if (value) {
-        const stroke = { type: 'text', x, y, value, color, fontSize: 20 };
+        const stroke = { type: 'text', x, y, value, color, fontSize: 20, strokeId: nextStrokeId() };
         drawStroke(stroke);
         sendWS(stroke);
-        setLocalStrokes(prev => [...prev, stroke]);
+        setLocalStrokes(prev => [...prev, withStrokeSid(stroke)]);
       }
       return;
     }
@@ -357,6 +495,7 @@ export function useDrawingCanvas({ currentUser, roomId, token }) {
     ctx.lineWidth = thickness;
     ctx.beginPath();
     ctx.moveTo(x, y);
+    nextStrokeId();
     setDrawing(true);
     setLastPosition({ x, y });
   };
@@ -397,10 +536,11 @@ export function useDrawingCanvas({ currentUser, roomId, token }) {
         toX: x,
         toY: y,
         color: drawColor,
-        thickness
+        thickness,
+        strokeId: strokeIdRef.current
       };
       sendWS(payload);
-      setLocalStrokes(prev => [...prev, payload]);
+      setLocalStrokes(prev => [...prev, withStrokeSid(payload)]);
     }
     setLastPosition({ x, y });
   };
@@ -435,11 +575,12 @@ export function useDrawingCanvas({ currentUser, roomId, token }) {
         toX: x,
         toY: y,
         color,
-        thickness
+        thickness,
+        strokeId: nextStrokeId()
       };
       drawStroke(newShape);
       sendWS(newShape);
-      setLocalStrokes(prev => [...prev, newShape]);
+      setLocalStrokes(prev => [...prev, withStrokeSid(newShape)]);
       setShapeStart(null);
     }
   };
@@ -460,6 +601,7 @@ export function useDrawingCanvas({ currentUser, roomId, token }) {
     localStrokes, setLocalStrokes,
     snapshots, setSnapshots,
     loadingSnapshots, setLoadingSnapshots,
+    olderSnapshotsCursor, fetchOlderSnapshots,
     clearing, setClearing,
 
     isChatMinimized, setIsChatMinimized,
@@ -488,6 +630,7 @@ export function useDrawingCanvas({ currentUser, roomId, token }) {
     sendWS,
     getCanvasCoords,
     handleUndo,
+    handleRedo,
     start,
     move,
     stop
@@ -38,6 +38,8 @@ function DrawingCanvas({ currentUser, roomId, token }) {
     loadingSnapshots,
     snapshots,
     fetchSnapshots,
+    olderSnapshotsCursor,
+    fetchOlderSnapshots,
     handleSaveSnapshot,
     handleRestoreSnapshot,
     handleSaveCanvas,
@@ -72,7 +74,7 @@ function DrawingCanvas({ currentUser, roomId, token }) {
             fontWeight: 600, fontSize: 14, cursor: "pointer"
           }}
           disabled={loadingSnapshots}
-          onClick={fetchSnapshots}
+          onClick={() => fetchSnapshots()}
         >Refresh</button>
       </div>
       <div style={{ maxHeight: 120, overflowY: "auto" }}>
@@ -91,6 +93,14 @@ function DrawingCanvas({ currentUser, roomId, token }) {
             )}
           </ul>
         }
+        {olderSnapshotsCursor &&
+          <button style={{
+            background: "none", border: "none", color: "#3182ce",
+            padding: "2px 0", cursor: "pointer", fontWeight: 600
+          }} disabled={loadingSnapshots} onClick={fetchOlderSnapshots}>
+            Load older
+          </button>
+        }
       </div>
       <button
         style={{
@@ -172,6 +172,11 @@ function RoomSelection({ token, currentUser, onRoomSelected, onLogout }) {
                 <div className="rooms-grid">
                   {rooms.map((room) => (
                     <div key={room.room_id} className="room-card">
+                      {room.thumbnail ? (
+                        <img src={room.thumbnail} alt="" className="room-thumbnail" />
+                      ) : (
+                        <div className="room-thumbnail" />
+                      )}
                       <div className="room-info">
                         <h3>{room.name}</h3>
                         <p>Room ID: <code>{room.room_id}</code></p>